@@ -0,0 +1,102 @@
+"""
+Recall against index size for reduced and compressed passage embeddings.
+
+For every reduction method (truncate / pca), kept dimension and storage dtype, the
+passages are reduced with tevatron.retriever.reduction.EmbeddingTransform, indexed with
+FaissFlatSearcher, and the top-k of the queries is compared with exact float32 search
+over the full vectors. Real shards can be given with --passage_reps / --query_reps;
+otherwise synthetic vectors with a decaying spectrum stand in for LLM embeddings.
+
+    python benchmarks/bench_reduction.py --dims 64 128 256 --dtypes float32 float16 int8
+    python benchmarks/bench_reduction.py --passage_reps 'corpus.*.pkl' --query_reps queries.pkl --dims 512 1024
+"""
+import time
+from argparse import ArgumentParser
+
+import numpy as np
+
+from tevatron.retriever.embedding_io import read_embedding_shard, resolve_shard_paths
+from tevatron.retriever.reduction import EmbeddingTransform
+from tevatron.retriever.searcher import FaissFlatSearcher
+
+
+def synthetic_embeddings(rng, num_passages, num_queries, dim, rotate=False):
+    # variance decays along the dimensions, like Matryoshka-trained embeddings;
+    # with --rotate it is spread over random directions, which only PCA can recover
+    spectrum = 1 / np.sqrt(np.arange(1, dim + 1))
+    rotation = np.linalg.qr(rng.standard_normal((dim, dim)))[0] if rotate else np.eye(dim)
+    passages = (rng.standard_normal((num_passages, dim)) * spectrum) @ rotation
+    queries = passages[rng.choice(num_passages, num_queries)] + \
+        0.5 * (rng.standard_normal((num_queries, dim)) * spectrum) @ rotation
+    passages /= np.linalg.norm(passages, axis=1, keepdims=True)
+    queries /= np.linalg.norm(queries, axis=1, keepdims=True)
+    return passages.astype(np.float32), queries.astype(np.float32)
+
+
+def load_embeddings(passage_pattern, query_path):
+    passages = np.concatenate([np.asarray(read_embedding_shard(path)[0], dtype=np.float32)
+                               for path in resolve_shard_paths(passage_pattern)])
+    queries = np.asarray(read_embedding_shard(query_path)[0], dtype=np.float32)
+    return passages, queries
+
+
+def recall(reference, found):
+    return np.mean([len(np.intersect1d(r, f)) / len(r) for r, f in zip(reference, found)])
+
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument('--passage_reps', default=None)
+    parser.add_argument('--query_reps', default=None)
+    parser.add_argument('--num_passages', type=int, default=100000)
+    parser.add_argument('--num_queries', type=int, default=1000)
+    parser.add_argument('--dim', type=int, default=768, help='dimension of the synthetic embeddings')
+    parser.add_argument('--rotate', action='store_true', help='rotate the synthetic embeddings randomly')
+    parser.add_argument('--dims', type=int, nargs='+', default=[64, 128, 256])
+    parser.add_argument('--methods', nargs='+', choices=['truncate', 'pca'], default=['truncate', 'pca'])
+    parser.add_argument('--dtypes', nargs='+', choices=['float32', 'float16', 'bfloat16', 'int8'],
+                        default=['float32', 'float16', 'int8'])
+    parser.add_argument('--depth', type=int, default=100)
+    parser.add_argument('--pca_sample_size', type=int, default=50000)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    if args.passage_reps is not None:
+        passages, queries = load_embeddings(args.passage_reps, args.query_reps)
+    else:
+        passages, queries = synthetic_embeddings(rng, args.num_passages, args.num_queries, args.dim, args.rotate)
+    full_dim = passages.shape[1]
+
+    reference = FaissFlatSearcher(passages, num_shards=1, use_gpu=False)
+    reference.add(passages)
+    start = time.perf_counter()
+    _, reference_ids = reference.search(queries, args.depth)
+    full_ms = (time.perf_counter() - start) * 1000
+    full_bytes = passages.shape[0] * full_dim * 4
+    print(f"{passages.shape[0]} passages, {queries.shape[0]} queries, recall@{args.depth} against "
+          f"{full_dim}-dim float32 flat search ({full_bytes / 2 ** 20:.1f} MiB, {full_ms:.0f} ms)")
+    print(f"{'method':>8} {'dim':>5} {'dtype':>8} {'MiB':>9} {'size':>6} {'recall':>7} {'search ms':>10}")
+
+    sample = passages[rng.choice(len(passages), min(args.pca_sample_size, len(passages)), replace=False)]
+    for method in args.methods:
+        for dim in args.dims:
+            if dim > full_dim:
+                continue
+            if method == 'truncate':
+                transform = EmbeddingTransform.truncate(full_dim, dim)
+            else:
+                transform = EmbeddingTransform.fit_pca(sample, dim)
+            reduced_passages, reduced_queries = transform(passages), transform(queries)
+            for dtype in args.dtypes:
+                searcher = FaissFlatSearcher(reduced_passages, num_shards=1, use_gpu=False, storage=dtype)
+                searcher.add(reduced_passages)
+                start = time.perf_counter()
+                _, ids = searcher.search(reduced_queries, args.depth)
+                elapsed = (time.perf_counter() - start) * 1000
+                size = passages.shape[0] * searcher.shards[0].sa_code_size()
+                print(f"{method:>8} {dim:>5} {dtype:>8} {size / 2 ** 20:>9.1f} {size / full_bytes:>6.1%} "
+                      f"{recall(reference_ids, ids):>7.3f} {elapsed:>10.0f}")
+
+
+if __name__ == '__main__':
+    main()
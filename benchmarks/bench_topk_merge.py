@@ -0,0 +1,65 @@
+"""
+Micro-benchmark for merging per-shard top-k search results.
+
+Compares the full argsort over all num_shards * k candidates that
+FaissFlatSearcher.search used to run with tevatron.retriever.searcher.merge_topk.
+
+    python benchmarks/bench_topk_merge.py --batch_size 128 --shards 2 4 8 --depths 100 1000
+"""
+import time
+from argparse import ArgumentParser
+
+import numpy as np
+
+from tevatron.retriever.searcher import merge_topk
+
+
+def argsort_merge(all_scores, all_indices, k):
+    merged_scores = np.concatenate(all_scores, axis=1)
+    merged_indices = np.concatenate(all_indices, axis=1)
+    top_k_idx = np.argsort(merged_scores, axis=1)[:, -k:][:, ::-1]
+    return np.take_along_axis(merged_scores, top_k_idx, axis=1), np.take_along_axis(merged_indices, top_k_idx, axis=1)
+
+
+def make_shard_results(rng, batch_size, num_shards, k):
+    all_scores, all_indices = [], []
+    for shard in range(num_shards):
+        scores = -np.sort(-rng.standard_normal((batch_size, k)).astype(np.float32), axis=1)
+        indices = rng.integers(0, 10_000_000, size=(batch_size, k), dtype=np.int64)
+        all_scores.append(scores)
+        all_indices.append(indices)
+    return all_scores, all_indices
+
+
+def timeit(fn, repeat):
+    fn()
+    start = time.perf_counter()
+    for _ in range(repeat):
+        fn()
+    return (time.perf_counter() - start) / repeat * 1000
+
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument('--batch_size', type=int, default=128)
+    parser.add_argument('--shards', type=int, nargs='+', default=[2, 4, 8, 16])
+    parser.add_argument('--depths', type=int, nargs='+', default=[10, 100, 1000])
+    parser.add_argument('--repeat', type=int, default=20)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    print(f"{'shards':>6} {'depth':>6} {'argsort ms':>11} {'merge_topk ms':>14} {'speedup':>8}")
+    for num_shards in args.shards:
+        for k in args.depths:
+            all_scores, all_indices = make_shard_results(rng, args.batch_size, num_shards, k)
+            ref_scores, _ = argsort_merge(all_scores, all_indices, k)
+            new_scores, _ = merge_topk(all_scores, all_indices, k)
+            assert np.array_equal(ref_scores, new_scores)
+
+            baseline = timeit(lambda: argsort_merge(all_scores, all_indices, k), args.repeat)
+            merged = timeit(lambda: merge_topk(all_scores, all_indices, k), args.repeat)
+            print(f"{num_shards:>6} {k:>6} {baseline:>11.2f} {merged:>14.2f} {baseline / merged:>7.1f}x")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,88 @@
+"""
+Memory and time of uniCOIL's max-pooling of token weights into vocabulary vectors.
+
+`dense` is the former UniCoilEncoder._weights_to_vec, which scatters every token weight
+into a batch x seq_len x vocab tensor and max-pools over the sequence; `scatter` is the
+current one, which scatter-maxes straight into batch x vocab. Both run forward and
+backward on random token ids and weights, and their outputs and gradients are compared.
+Peak memory is measured on CUDA; on CPU the size of the largest tensor is reported.
+
+    python benchmarks/bench_unicoil_pooling.py --batch_size 128 --seq_len 256
+"""
+import time
+from argparse import ArgumentParser
+
+import torch
+from transformers import BertConfig
+
+from tevatron.retriever.modeling.unicoil import UniCoilEncoder
+
+
+def dense_weights_to_vec(input_ids, tok_weights, vocab_size):
+    tok_weights = torch.relu(tok_weights)
+    tok_emb = torch.zeros(input_ids.size(0), input_ids.size(1), vocab_size, dtype=tok_weights.dtype,
+                          device=input_ids.device)
+    tok_emb = torch.scatter(tok_emb, dim=-1, index=input_ids.unsqueeze(-1), src=tok_weights)
+    tok_emb = torch.max(tok_emb, dim=1).values
+    tok_emb[:, [0, 101, 102, 103]] *= 0
+    return tok_emb
+
+
+def run(pool, input_ids, tok_weights, device, repeats):
+    weights = tok_weights.detach().clone().requires_grad_()
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+        torch.cuda.reset_peak_memory_stats()
+        base = torch.cuda.memory_allocated()
+    start = time.perf_counter()
+    for _ in range(repeats):
+        weights.grad = None
+        output = pool(input_ids, weights)
+        output.sum().backward()
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+        peak = torch.cuda.max_memory_allocated() - base
+    else:
+        peak = None
+    return output.detach(), weights.grad, (time.perf_counter() - start) * 1000 / repeats, peak
+
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument('--batch_size', type=int, default=32)
+    parser.add_argument('--seq_len', type=int, default=128)
+    parser.add_argument('--vocab_size', type=int, default=30522)
+    parser.add_argument('--repeats', type=int, default=5)
+    parser.add_argument('--skip_dense', action='store_true', help='only run the scatter pooling, for sizes where dense does not fit')
+    args = parser.parse_args()
+
+    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+    config = BertConfig(vocab_size=args.vocab_size, hidden_size=8, num_hidden_layers=1, num_attention_heads=1,
+                        intermediate_size=8)
+    encoder = UniCoilEncoder(config)
+    input_ids = torch.randint(0, args.vocab_size, (args.batch_size, args.seq_len), device=device)
+    tok_weights = torch.randn(args.batch_size, args.seq_len, 1, device=device)
+
+    poolings = {'scatter': encoder._weights_to_vec}
+    if not args.skip_dense:
+        poolings['dense'] = lambda ids, w: dense_weights_to_vec(ids, w, args.vocab_size)
+    print(f"batch {args.batch_size} x seq {args.seq_len} x vocab {args.vocab_size} on {device}")
+    print(f"{'pooling':>8} {'largest tensor MiB':>19} {'peak MiB':>9} {'ms':>8}")
+    results = {}
+    for name, pool in poolings.items():
+        results[name] = run(pool, input_ids, tok_weights, device, args.repeats)
+        rows = args.batch_size * (args.seq_len if name == 'dense' else 1)
+        largest = rows * args.vocab_size * 4 / 2 ** 20
+        peak = results[name][3]
+        peak = f'{peak / 2 ** 20:>9.1f}' if peak is not None else f"{'-':>9}"
+        print(f"{name:>8} {largest:>19.1f} {peak} {results[name][2]:>8.1f}")
+    if 'dense' in results:
+        # ties between duplicate tokens may route the gradient differently, the summed gradient per token id matches
+        same_output = torch.allclose(results['dense'][0], results['scatter'][0])
+        grad_sums = [torch.zeros(args.batch_size, args.vocab_size, device=device).scatter_add(
+            1, input_ids, results[name][1].squeeze(-1)) for name in ('dense', 'scatter')]
+        print(f"outputs match: {same_output}, gradients match: {torch.allclose(*grad_sums)}")
+
+
+if __name__ == '__main__':
+    main()
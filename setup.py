@@ -10,7 +10,7 @@ setup(
     author='Luyu Gao',
     author_email='luyug@cs.cmu.edu',
     description='Tevatron: A toolkit for learning and running deep dense retrieval models.',
-    python_requires='>=3.7',
+    python_requires='>=3.8',
     install_requires=[
         "transformers>=4.10.0",
         "datasets>=1.1.3"
@@ -89,6 +89,46 @@ class DataArguments:
 
     rerank_output_path: str = field(default=None, metadata={"help": "where to save the rerank output"})
 
+    rerank_num_workers: int = field(
+        default=1, metadata={"help": "number of reranking processes, each on its own GPU (or on CPU) and with its own "
+                                     "slice of the queries; 0 uses every visible GPU"}
+    )
+
+    rerank_cascade_depth: int = field(
+        default=0,
+        metadata={"help": "if > 0, score every candidate with a cheap first pass and rerank only the top candidates "
+                          "of each query with the model; the others keep their first-pass order below them"}
+    )
+
+    rerank_cascade_scorer: str = field(
+        default='retrieval',
+        metadata={"help": "first pass of the cascade: retrieval (the score field of the rerank input), truncated "
+                          "(the model on inputs cut to rerank_cascade_max_len) or model (rerank_cascade_model_name_or_path)"}
+    )
+
+    rerank_cascade_max_len: int = field(
+        default=128, metadata={"help": "input length of the first pass, for the truncated and model scorers"}
+    )
+
+    rerank_cascade_model_name_or_path: Optional[str] = field(
+        default=None, metadata={"help": "small reranker used as the first pass by the model scorer"}
+    )
+
+    rerank_group_by_length: bool = field(
+        default=False, metadata={"help": "batch pairs of similar token length together to cut padding"}
+    )
+
+    rerank_max_tokens: int = field(
+        default=0, metadata={"help": "if > 0, group by length and fill each batch up to this many padded tokens "
+                                     "instead of using a fixed batch size"}
+    )
+
+    rerank_share_query_prefix: bool = field(
+        default=False,
+        metadata={"help": "run the tokens shared by a batch's pairs (instruction and query) once and reuse their "
+                          "KV cache for every passage, for decoder-only rerankers"}
+    )
+
     rerank_max_len: Optional[int] = field(
         default=512,
         metadata={
@@ -1,6 +1,8 @@
 import logging
 from typing import List, Tuple
 from dataclasses import dataclass
+
+import torch
 from transformers import PreTrainedTokenizer
 from tevatron.reranker.arguments import DataArguments
 
@@ -51,15 +53,9 @@ class RerankerInferenceCollator:
     data_args: DataArguments
     tokenizer: PreTrainedTokenizer
 
-    def __call__(self, features: List[Tuple[str, str]]):
-        """
-        Collate function for encoding.
-        :param features: list of (query_id, text_id, pair) tuples
-        """
-        query_ids = [x[0] for x in features]
-        text_ids = [x[1] for x in features]
-        pairs = [x[2] for x in features]
-        collated_pairs = self.tokenizer(
+    def tokenize(self, pairs: List[str]) -> List[List[int]]:
+        """Token ids of formatted pairs as they are fed to the model, before padding."""
+        input_ids = self.tokenizer(
             pairs,
             padding=False, 
             truncation=True,
@@ -67,14 +63,65 @@ class RerankerInferenceCollator:
             return_attention_mask=False,
             return_token_type_ids=False,
             add_special_tokens=True,
-        )
+        )['input_ids']
         if self.data_args.append_eos_token:
-            collated_pairs['input_ids'] = [x + [self.tokenizer.eos_token_id] for x in collated_pairs['input_ids']]
+            input_ids = [x + [self.tokenizer.eos_token_id] for x in input_ids]
+        return input_ids
+
+    def pair_lengths(self, pairs: List[str]) -> List[int]:
+        return [len(x) for x in self.tokenize(pairs)]
+
+    def __call__(self, features: List[Tuple[str, str]]):
+        """
+        Collate function for encoding.
+        :param features: list of (query_id, text_id, pair) tuples
+        """
+        query_ids = [x[0] for x in features]
+        text_ids = [x[1] for x in features]
+        pairs = [x[2] for x in features]
         collated_pairs = self.tokenizer.pad(
-            collated_pairs,
+            {'input_ids': self.tokenize(pairs)},
             padding=True, 
             pad_to_multiple_of=self.data_args.pad_to_multiple_of,
             return_attention_mask=True,
             return_tensors='pt',
         )
-        return query_ids, text_ids, collated_pairs
\ No newline at end of file
+        return query_ids, text_ids, collated_pairs
+
+
+def common_prefix_length(sequences: List[List[int]]) -> int:
+    """Length of the longest token prefix shared by all sequences, leaving each at least one token."""
+    limit = min(len(x) for x in sequences) - 1
+    first = sequences[0]
+    length = 0
+    while length < limit and all(x[length] == first[length] for x in sequences):
+        length += 1
+    return length
+
+
+@dataclass
+class RerankerPrefixCollator(RerankerInferenceCollator):
+    """
+    Like RerankerInferenceCollator, but splits off the tokens shared by every pair of the
+    batch (the instruction and query, when the batch holds one query's candidates) and
+    returns them separately, so the model can encode them once for the whole batch.
+    """
+
+    def __call__(self, features: List[Tuple[str, str]]):
+        """
+        :param features: list of (query_id, text_id, pair) tuples
+        :return: query ids, text ids, the shared prefix ids and the padded suffixes
+        """
+        query_ids = [x[0] for x in features]
+        text_ids = [x[1] for x in features]
+        input_ids = self.tokenize([x[2] for x in features])
+        prefix_length = common_prefix_length(input_ids)
+        suffixes = self.tokenizer.pad(
+            {'input_ids': [x[prefix_length:] for x in input_ids]},
+            padding=True,
+            pad_to_multiple_of=self.data_args.pad_to_multiple_of,
+            return_attention_mask=True,
+            return_tensors='pt',
+        )
+        return query_ids, text_ids, torch.tensor(input_ids[0][:prefix_length], dtype=torch.long), suffixes
+
@@ -1,6 +1,8 @@
 import random
-from typing import List, Tuple
+from collections import Counter
+from typing import Dict, List, Tuple
 
+import numpy as np
 from datasets import load_dataset
 from torch.utils.data import Dataset
 
@@ -94,6 +96,37 @@ class RerankerInferenceDataset(Dataset):
     def __len__(self):
         return len(self.inference_data)
 
+    def read_column(self, name: str) -> np.ndarray:
+        """All values of one column, read in batches without decoding the other fields."""
+        values = []
+        for batch in self.inference_data.select_columns([name]).iter(batch_size=100000):
+            values.extend(batch[name])
+        return np.array(values)
+
+    def query_order(self) -> List[str]:
+        """Query ids in order of their first candidate."""
+        query_ids, first_rows = np.unique(self.read_column('query_id'), return_index=True)
+        return query_ids[np.argsort(first_rows)].tolist()
+
+    def select_queries(self, num_slices: int, index: int):
+        """
+        Keep the index-th of num_slices consecutive slices of the queries, in order of their
+        first candidate, with all of their candidates; slices hold about the same number of pairs.
+        """
+        query_ids, first_rows, groups, counts = np.unique(
+            self.read_column('query_id'), return_index=True, return_inverse=True, return_counts=True)
+        order = np.argsort(first_rows)
+        # slice of every query, cutting the running candidate count into equal parts
+        ends = np.cumsum(counts[order])
+        query_slice = np.empty(len(query_ids), dtype=np.int64)
+        query_slice[order] = np.minimum((ends - counts[order]) * num_slices // max(ends[-1], 1), num_slices - 1)
+        rows = np.flatnonzero(query_slice[groups.reshape(-1)] == index)
+        self.inference_data = self.inference_data.select(rows)
+
+    def query_candidate_counts(self) -> Dict[str, int]:
+        """Number of candidates of every query."""
+        return Counter(self.read_column('query_id').tolist())
+
     def __getitem__(self, item) -> Tuple[str, str]:
         example = self.inference_data[item]
         query_id = example['query_id']
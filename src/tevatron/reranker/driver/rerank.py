@@ -2,12 +2,15 @@ import logging
 import os
 import sys
 from contextlib import nullcontext
+from collections import Counter
+from dataclasses import replace
 
+import numpy as np
 from tqdm import tqdm
 
 import torch
 
-from torch.utils.data import DataLoader
+from torch.utils.data import DataLoader, Subset
 from transformers import AutoTokenizer
 from transformers import (
     HfArgumentParser,
@@ -17,11 +20,181 @@ from tevatron.reranker.arguments import ModelArguments, DataArguments
 
 from tevatron.reranker.dataset import RerankerInferenceDataset
 from tevatron.reranker.modeling import RerankerModel
-from tevatron.reranker.collator import RerankerInferenceCollator
+from tevatron.reranker.collator import RerankerInferenceCollator, RerankerPrefixCollator
+from tevatron.reranker.ranking import RerankWriter, cascade_survivors, merge_rankings
+from tevatron.retriever.sampler import LengthGroupedBatchSampler
+from tevatron.utils.workers import run_workers, worker_output_path
 
 logger = logging.getLogger(__name__)
 
 
+def load_tokenizer(name_or_path, cache_dir=None):
+    tokenizer = AutoTokenizer.from_pretrained(name_or_path, cache_dir=cache_dir)
+    if tokenizer.pad_token_id is None:
+        tokenizer.pad_token_id = 0
+    tokenizer.padding_side = 'right'
+    return tokenizer
+
+
+def score_batches(model, loader, training_args, device):
+    """Yield the query ids, text ids and scores of every batch of the loader."""
+    for (batch_query_ids, batch_text_ids, *inputs) in tqdm(loader):
+        # the prefix collator returns the shared prefix ids before the batch
+        prefix_ids, batch = inputs if len(inputs) == 2 else (None, inputs[0])
+        with torch.cuda.amp.autocast() if training_args.fp16 else nullcontext():
+            with torch.no_grad():
+                for k, v in batch.items():
+                    batch[k] = v.to(device)
+                if prefix_ids is not None:
+                    scores = model.score_with_prefix(prefix_ids.to(device), batch)
+                else:
+                    scores = model(batch).scores
+                scores = scores.cpu().detach().float().numpy()
+        yield batch_query_ids, batch_text_ids, scores[:, 0]
+
+
+def first_pass_scores(rerank_dataset, model, tokenizer, model_args, data_args, training_args, device):
+    """Cheap scores of every candidate, in dataset order, for the cascade to prune with."""
+    scorer = data_args.rerank_cascade_scorer
+    if scorer == 'retrieval':
+        return rerank_dataset.read_column('score').astype(np.float32)
+    if scorer == 'model':
+        tokenizer = load_tokenizer(data_args.rerank_cascade_model_name_or_path, model_args.cache_dir)
+        model = RerankerModel.load(data_args.rerank_cascade_model_name_or_path, cache_dir=model_args.cache_dir)
+        model = model.to(device)
+        model.eval()
+    elif scorer != 'truncated':
+        raise ValueError(f'Unknown cascade scorer {scorer}')
+    collator = RerankerInferenceCollator(
+        data_args=replace(data_args, rerank_max_len=data_args.rerank_cascade_max_len), tokenizer=tokenizer)
+    loader = DataLoader(
+        rerank_dataset,
+        batch_size=training_args.per_device_eval_batch_size,
+        collate_fn=collator,
+        shuffle=False,
+        drop_last=False,
+        num_workers=training_args.dataloader_num_workers,
+    )
+    return np.concatenate([scores for _, _, scores in score_batches(model, loader, training_args, device)])
+
+
+def compute_pair_lengths(dataset, collator, chunk_size: int = 10000):
+    lengths = []
+    for start in tqdm(range(0, len(dataset), chunk_size), desc='Computing pair lengths'):
+        pairs = [dataset[i][2] for i in range(start, min(start + chunk_size, len(dataset)))]
+        lengths.extend(collator.pair_lengths(pairs))
+    return lengths
+
+
+def rerank(model_args: ModelArguments, data_args: DataArguments, training_args: TrainingArguments,
+           device, num_workers: int = 1, worker_index: int = 0):
+    """Rerank the queries of slice `worker_index` of `num_workers` and write their rankings to rerank_output_path."""
+    tokenizer = load_tokenizer(
+        model_args.tokenizer_name if model_args.tokenizer_name else model_args.model_name_or_path,
+        model_args.cache_dir
+    )
+
+    model = RerankerModel.load(
+        model_args.model_name_or_path,
+        lora_name_or_path=model_args.lora_name_or_path,
+        cache_dir=model_args.cache_dir,
+    )
+
+    rerank_dataset = RerankerInferenceDataset(data_args=data_args)
+    if num_workers > 1:
+        rerank_dataset.select_queries(num_workers, worker_index)
+    if data_args.rerank_share_query_prefix:
+        # the input lists a query's candidates together, so most batches share the query prefix
+        rerank_collator = RerankerPrefixCollator(data_args=data_args, tokenizer=tokenizer)
+    else:
+        rerank_collator = RerankerInferenceCollator(data_args=data_args, tokenizer=tokenizer)
+
+    model = model.to(device)
+    model.eval()
+
+    expected_counts = None
+    tails = None
+    rerank_subset = rerank_dataset
+    if data_args.rerank_cascade_depth > 0:
+        first_scores = first_pass_scores(rerank_dataset, model, tokenizer, model_args, data_args, training_args,
+                                         device)
+        query_ids = rerank_dataset.read_column('query_id')
+        keep = cascade_survivors(query_ids, first_scores, data_args.rerank_cascade_depth)
+        # the pruned candidates of each query, written below the reranked ones
+        pruned = np.flatnonzero(~keep)
+        pruned_queries = query_ids[pruned]
+        order = np.argsort(pruned_queries, kind='stable')
+        qids, starts = np.unique(pruned_queries[order], return_index=True)
+        text_ids = rerank_dataset.read_column('docid')[pruned]
+        tails = {qid: (text_ids[rows], first_scores[pruned][rows])
+                 for qid, rows in zip(qids.tolist(), np.split(order, starts[1:]))}
+        expected_counts = Counter(query_ids[keep].tolist())
+        rerank_subset = Subset(rerank_dataset, np.flatnonzero(keep).tolist())
+        logger.info(f'Cascade keeps {keep.sum()} of {len(keep)} candidates for the full model')
+
+    if data_args.rerank_group_by_length or data_args.rerank_max_tokens > 0:
+        if data_args.rerank_share_query_prefix:
+            logger.warning('Length grouped batches mix queries, so their pairs only share the common instruction')
+        # results are keyed by (query id, docid), so pairs can be scored in any order
+        batch_sampler = LengthGroupedBatchSampler(
+            compute_pair_lengths(rerank_subset, rerank_collator),
+            batch_size=training_args.per_device_eval_batch_size,
+            max_tokens=data_args.rerank_max_tokens,
+            pad_to_multiple_of=data_args.pad_to_multiple_of,
+        )
+        batch_sampler.log_padding(training_args.per_device_eval_batch_size)
+        rerank_loader = DataLoader(
+            rerank_subset,
+            batch_sampler=batch_sampler,
+            collate_fn=rerank_collator,
+            num_workers=training_args.dataloader_num_workers,
+        )
+    else:
+        rerank_loader = DataLoader(
+            rerank_subset,
+            batch_size=training_args.per_device_eval_batch_size,
+            collate_fn=rerank_collator,
+            shuffle=False,
+            drop_last=False,
+            num_workers=training_args.dataloader_num_workers,
+        )
+
+    # every query's ranking is written as soon as its last candidate is scored
+    with open(data_args.rerank_output_path, 'w') as f:
+        writer = RerankWriter(f, expected_counts or rerank_dataset.query_candidate_counts(), tails)
+        for batch_query_ids, batch_text_ids, scores in score_batches(model, rerank_loader, training_args, device):
+            writer.add(batch_query_ids, batch_text_ids, scores)
+        writer.close()
+    logger.info(f'Wrote the rankings of {writer.num_written} queries to {data_args.rerank_output_path}')
+    return writer.num_written
+
+
+def _rerank_worker(worker_index, device, model_args, data_args, training_args, num_workers):
+    logger.info(f"Reranking query slice {worker_index} of {num_workers} on {device}")
+    data_args = replace(
+        data_args, rerank_output_path=worker_output_path(data_args.rerank_output_path, worker_index))
+    num_queries = rerank(model_args, data_args, training_args, device, num_workers, worker_index)
+    return data_args.rerank_output_path, num_queries
+
+
+def launch_workers(model_args: ModelArguments, data_args: DataArguments, training_args: TrainingArguments,
+                   num_workers: int):
+    """
+    Rerank with `num_workers` processes, one per GPU (wrapping around if there are more workers
+    than GPUs) or on CPU. Worker i reranks the i-th slice of the queries, with all of their
+    candidates, into its own run file; the run files are then merged into rerank_output_path
+    with the queries in input order.
+    """
+    runs = run_workers(_rerank_worker, num_workers, training_args.use_cpu,
+                       model_args, data_args, training_args, num_workers)
+    query_order = RerankerInferenceDataset(data_args=data_args).query_order()
+    merge_rankings([path for path, _ in runs], data_args.rerank_output_path, query_order)
+    for path, _ in runs:
+        os.remove(path)
+    logger.info(f"Merged the rankings of {sum(n for _, n in runs)} queries from {num_workers} workers "
+                f"into {data_args.rerank_output_path}")
+
+
 def main():
     parser = HfArgumentParser((ModelArguments, DataArguments, TrainingArguments))
     if len(sys.argv) == 2 and sys.argv[1].endswith(".json"):
@@ -32,8 +205,12 @@ def main():
         data_args: DataArguments
         training_args: TrainingArguments
 
-    if training_args.local_rank > 0 or training_args.n_gpu > 1:
-        raise NotImplementedError('Multi-GPU encoding is not supported.')
+    num_workers = data_args.rerank_num_workers
+    if num_workers == 0:
+        num_workers = max(1, torch.cuda.device_count()) if not training_args.use_cpu else 1
+
+    if training_args.local_rank > 0 or (training_args.n_gpu > 1 and num_workers == 1):
+        raise NotImplementedError('Multi-GPU reranking is only supported through --rerank_num_workers.')
 
     # Setup logging
     logging.basicConfig(
@@ -42,55 +219,11 @@ def main():
         level=logging.INFO if training_args.local_rank in [-1, 0] else logging.WARN,
     )
 
-    tokenizer = AutoTokenizer.from_pretrained(
-        model_args.tokenizer_name if model_args.tokenizer_name else model_args.model_name_or_path,
-        cache_dir=model_args.cache_dir
-    )
-    if tokenizer.pad_token_id is None:
-        tokenizer.pad_token_id = 0
-    tokenizer.padding_side = 'right'
-
-    model = RerankerModel.load(
-        model_args.model_name_or_path,
-        lora_name_or_path=model_args.lora_name_or_path,
-        cache_dir=model_args.cache_dir,
-    )
-
-    rerank_dataset = RerankerInferenceDataset(data_args=data_args)
-    rerank_collator = RerankerInferenceCollator(data_args=data_args, tokenizer=tokenizer)
-
-    rerank_loader = DataLoader(
-        rerank_dataset,
-        batch_size=training_args.per_device_eval_batch_size,
-        collate_fn=rerank_collator,
-        shuffle=False,
-        drop_last=False,
-        num_workers=training_args.dataloader_num_workers,
-    )
-    model = model.to(training_args.device)
-    model.eval()
-    all_results = {}
-
-    for (batch_query_ids, batch_text_ids, batch) in tqdm(rerank_loader):
-        with torch.cuda.amp.autocast() if training_args.fp16 else nullcontext():
-            with torch.no_grad():
-                for k, v in batch.items():
-                    batch[k] = v.to(training_args.device)
-                model_output = model(batch)
-                scores = model_output.scores.cpu().detach().float().numpy()
-                for i in range(len(scores)):
-                    qid = batch_query_ids[i]
-                    docid = batch_text_ids[i]
-                    score = scores[i][0]
-                    if qid not in all_results:
-                        all_results[qid] = []
-                    all_results[qid].append((docid, score))
+    if num_workers > 1:
+        launch_workers(model_args, data_args, training_args, num_workers)
+    else:
+        rerank(model_args, data_args, training_args, training_args.device)
 
-    with open(data_args.rerank_output_path, 'w') as f:
-        for qid in all_results:
-            results = sorted(all_results[qid], key=lambda x: x[1], reverse=True)
-            for docid, score in results:
-                f.write(f'{qid}\t{docid}\t{score}\n')
 
 if __name__ == "__main__":
     main()
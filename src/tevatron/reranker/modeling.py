@@ -1,4 +1,3 @@
-import os
 from dataclasses import dataclass
 from typing import Dict, Optional
 
@@ -58,6 +57,62 @@ class RerankerModel(nn.Module):
             scores = ranker_logits
         )
     
+    def score_with_prefix(self, prefix_ids: Tensor, suffix: Dict[str, Tensor]) -> Tensor:
+        """
+        Scores of pairs that all start with `prefix_ids`, for decoder-only models: the prefix is
+        run once and its KV cache is reused by every suffix. The cache is kept expanded to the
+        batch size and cropped back to the prefix after each batch, so consecutive batches of the
+        same query neither rerun nor copy the prefix, and a new query only runs the tokens it
+        does not share with the last one.
+        """
+        if len(prefix_ids) == 0:
+            return self(suffix).scores
+        input_ids, attention_mask = suffix['input_ids'], suffix['attention_mask']
+        cache = self._prefix_kv_cache(prefix_ids, input_ids.size(0))
+        prefix_mask = attention_mask.new_ones(input_ids.size(0), len(prefix_ids))
+        try:
+            return self.hf_model(
+                input_ids=input_ids,
+                attention_mask=torch.cat([prefix_mask, attention_mask], dim=1),
+                past_key_values=cache,
+                use_cache=True,
+                return_dict=True,
+            ).logits
+        finally:
+            # a negative length drops that many tokens from the end, here the suffixes
+            cache.crop(len(prefix_ids) - cache.get_seq_length())
+
+    def _prefix_kv_cache(self, prefix_ids: Tensor, batch_size: int):
+        """The KV cache of `prefix_ids` repeated `batch_size` times, updated from the cache of the last prefix."""
+        cached_ids, cache, cached_batch_size = getattr(self, '_prefix_cache', (prefix_ids[:0], None, 1))
+        limit = min(len(cached_ids), len(prefix_ids))
+        mismatch = (cached_ids[:limit] != prefix_ids[:limit]).nonzero()
+        shared = int(mismatch[0]) if len(mismatch) else limit
+        if shared < len(cached_ids) or shared < len(prefix_ids):
+            if shared == 0:
+                cache = None
+            else:
+                # the rows of the cache are identical, continue from the first one
+                self._resize_cache(cache, cached_batch_size, 1, prefix_ids.device)
+                cached_batch_size = 1
+                cache.crop(shared - len(cached_ids))
+            if shared < len(prefix_ids):
+                output = self.hf_model(input_ids=prefix_ids[None, shared:], past_key_values=cache, use_cache=True,
+                                       return_dict=True)
+                if getattr(output, 'past_key_values', None) is None:
+                    raise ValueError(f'{type(self.hf_model).__name__} returns no KV cache, '
+                                     f'shared prefixes need a decoder-only model')
+                cache = output.past_key_values
+                cached_batch_size = 1
+        self._resize_cache(cache, cached_batch_size, batch_size, prefix_ids.device)
+        self._prefix_cache = (prefix_ids, cache, batch_size)
+        return cache
+
+    @staticmethod
+    def _resize_cache(cache, current_batch_size: int, batch_size: int, device):
+        if current_batch_size != batch_size:
+            cache.batch_select_indices(torch.zeros(batch_size, dtype=torch.long, device=device))
+
     def gradient_checkpointing_enable(self, **kwargs):
         self.hf_model.base_model.model.gradient_checkpointing_enable(**kwargs)
 
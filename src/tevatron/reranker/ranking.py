@@ -0,0 +1,104 @@
+from typing import Dict, Iterable, Optional, Sequence, TextIO, Tuple
+
+import numpy as np
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+class RerankWriter:
+    """
+    Write `qid docid score` lines for each query, sorted by descending score, as soon as
+    all of its candidates are scored.
+
+    `expected_counts` gives the number of candidates of every query; a query's scores are
+    gathered in a NumPy array of that size, and the query is written and dropped once the
+    array is full, so memory holds only the queries still in flight and an interrupted job
+    leaves every finished query on disk.
+
+    `tails` maps a query to the (docids, scores) of candidates pruned by a cascade, which are
+    written below the scored ones in the order of their first-pass scores, shifted to sit
+    under the lowest score of the query so that the ranking keeps its full depth.
+    """
+
+    def __init__(self, f: TextIO, expected_counts: Dict[str, int],
+                 tails: Optional[Dict[str, Tuple[Sequence[str], np.ndarray]]] = None):
+        self.f = f
+        self.expected_counts = expected_counts
+        self.tails = tails or {}
+        self._pending: Dict[str, list] = {}
+        self.num_written = 0
+
+    def add(self, query_ids: Sequence[str], text_ids: Sequence[str], scores: Iterable[float]):
+        for qid, docid, score in zip(query_ids, text_ids, np.asarray(scores, dtype=np.float32).reshape(-1)):
+            entry = self._pending.get(qid)
+            if entry is None:
+                count = self.expected_counts[qid]
+                entry = self._pending[qid] = [[], np.empty(count, dtype=np.float32)]
+            docids, query_scores = entry
+            query_scores[len(docids)] = score
+            docids.append(docid)
+            if len(docids) == len(query_scores):
+                self._write(qid, docids, query_scores)
+                del self._pending[qid]
+
+    def _write(self, qid, docids, scores):
+        order = np.argsort(-scores, kind='stable')
+        # numpy float32 scalars, which format like the per-pair scores always did
+        self.f.write(''.join(f'{qid}\t{docids[i]}\t{s}\n' for i, s in zip(order.tolist(), scores[order])))
+        if qid in self.tails:
+            tail_docids, tail_scores = self.tails.pop(qid)
+            order = np.argsort(-tail_scores, kind='stable')
+            floor = scores.min() if len(scores) else 0
+            shifted = (tail_scores[order] - tail_scores.max() + floor - 1).astype(np.float32)
+            self.f.write(''.join(f'{qid}\t{tail_docids[i]}\t{s}\n' for i, s in zip(order.tolist(), shifted)))
+        self.f.flush()
+        self.num_written += 1
+
+    def close(self):
+        """Write the queries that did not get all their expected candidates."""
+        if self._pending:
+            logger.warning(f"{len(self._pending)} queries are missing candidates, writing what was scored")
+        for qid, (docids, scores) in self._pending.items():
+            self._write(qid, docids, scores[:len(docids)])
+        self._pending = {}
+
+
+def cascade_survivors(query_ids: np.ndarray, scores: np.ndarray, depth: int) -> np.ndarray:
+    """Mask of the rows among the `depth` highest scored of their query (ties broken by row order)."""
+    _, groups = np.unique(query_ids, return_inverse=True)
+    order = np.lexsort((-scores, groups))
+    group_starts = np.searchsorted(groups[order], groups[order], side='left')
+    keep = np.zeros(len(scores), dtype=bool)
+    keep[order[np.arange(len(order)) - group_starts < depth]] = True
+    return keep
+
+
+def merge_rankings(paths: Sequence[str], output_path: str, query_order: Sequence[str]):
+    """
+    Merge run files whose queries are disjoint into one, with the queries in `query_order`.
+    Each file is scanned once for the byte range of every query, which RerankWriter writes
+    as one block, and the blocks are then copied in order.
+    """
+    blocks = {}
+    for file_index, path in enumerate(paths):
+        with open(path, 'rb') as f:
+            offset = 0
+            for line in f:
+                qid = line.split(b'\t', 1)[0].decode()
+                start, end = blocks.get(qid, (file_index, offset, offset))[1:]
+                assert end == offset, f"Ranking of query {qid} is not contiguous in {path}"
+                blocks[qid] = (file_index, start, offset + len(line))
+                offset += len(line)
+    files = [open(path, 'rb') for path in paths]
+    try:
+        with open(output_path, 'wb') as out:
+            for qid in list(query_order) + sorted(set(blocks) - set(query_order)):
+                if qid not in blocks:
+                    continue
+                file_index, start, end = blocks[qid]
+                files[file_index].seek(start)
+                out.write(files[file_index].read(end - start))
+    finally:
+        for f in files:
+            f.close()
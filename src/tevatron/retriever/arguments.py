@@ -120,6 +120,55 @@ class DataArguments:
 
     encode_is_query: bool = field(default=False)
     encode_output_path: str = field(default=None, metadata={"help": "where to save the encode"})
+    token_cache_dir: Optional[str] = field(
+        default=None, metadata={"help": "directory for pre-tokenized texts, keyed by tokenizer, max length, prefix and "
+                                        "append_eos_token; reused by later encode and train runs"}
+    )
+    encode_num_workers: int = field(
+        default=1, metadata={"help": "number of encoding processes, each on its own GPU (or on CPU) writing its own "
+                                     "shard plus a shard manifest; 0 uses every visible GPU"}
+    )
+    encode_group_by_length: bool = field(
+        default=False, metadata={"help": "batch texts of similar token length together to cut padding; outputs are "
+                                         "restored to dataset order"}
+    )
+    encode_max_tokens: int = field(
+        default=0, metadata={"help": "if > 0, group by length and fill each batch up to this many padded tokens "
+                                     "instead of using a fixed batch size"}
+    )
+    encode_chunk_size: int = field(
+        default=8192, metadata={"help": "number of embeddings kept on the device before they are copied back to the "
+                                        "host in one transfer"}
+    )
+    encode_output_dtype: Optional[str] = field(
+        default=None, metadata={"help": "store embeddings as `float32`, `float16`, `bfloat16` (as uint16 bits) or "
+                                        "`int8` with per-dimension scales; the compressed encodings other than "
+                                        "float16 need encode_output_format npy. Defaults to the model output dtype"}
+    )
+    encode_int8_calibration_size: int = field(
+        default=10000, metadata={"help": "number of texts, sampled across the whole dataset, that the int8 scales "
+                                         "are calibrated on before encoding; every worker shares these scales"}
+    )
+    encode_checkpoint_rows: int = field(
+        default=0, metadata={"help": "save the embeddings encoded so far every this many rows to "
+                                     "<encode_output_path>.parts, so that an interrupted run can be resumed; "
+                                     "0 disables checkpointing"}
+    )
+    encode_resume: bool = field(
+        default=False, metadata={"help": "resume encoding from the parts saved by a previous run with "
+                                         "encode_checkpoint_rows, skipping the rows encoded already"}
+    )
+    encode_output_format: str = field(
+        default='pickle', metadata={"help": "`pickle` for a (reps, ids) pickle, `npy` for a memory mappable shard "
+                                            "directory with a raw .npy matrix, an id table and a header, `sparse` "
+                                            "to encode with a SPLADE model into a CSR shard directory"}
+    )
+    encode_sparse_top_k: Optional[int] = field(
+        default=None, metadata={"help": "with encode_output_format sparse, keep the top k term weights of each text"}
+    )
+    encode_sparse_threshold: float = field(
+        default=0.0, metadata={"help": "with encode_output_format sparse, drop term weights up to this value"}
+    )
 
 
     query_max_len: Optional[int] = field(
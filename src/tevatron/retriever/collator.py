@@ -8,43 +8,56 @@ from tevatron.retriever.arguments import DataArguments
 logger = logging.getLogger(__name__)
 
 
+def tokenize_texts(tokenizer: PreTrainedTokenizer, texts: List[str], max_length: int, append_eos_token: bool):
+    """Tokenize texts without padding, leaving room for and appending the eos token if requested."""
+    tokenized = tokenizer(
+        texts,
+        padding=False, 
+        truncation=True,
+        max_length=max_length-1 if append_eos_token else max_length,
+        return_attention_mask=False,
+        return_token_type_ids=False,
+        add_special_tokens=True,
+    )
+    if append_eos_token:
+        tokenized['input_ids'] = [x + [tokenizer.eos_token_id] for x in tokenized['input_ids']]
+    return tokenized
+
+
+def pretokenized(features: List) -> dict:
+    """Wrap token id arrays (e.g. from a token cache) the way the tokenizer output looks, ready for padding."""
+    return {'input_ids': [x.tolist() for x in features]}
+
+
 @dataclass
 class TrainCollator:
     data_args: DataArguments
     tokenizer: PreTrainedTokenizer
 
+    def tokenize_queries(self, queries: List[str]) -> List[List[int]]:
+        return tokenize_texts(self.tokenizer, queries, self.data_args.query_max_len,
+                              self.data_args.append_eos_token)['input_ids']
+
+    def tokenize_passages(self, passages: List[str]) -> List[List[int]]:
+        return tokenize_texts(self.tokenizer, passages, self.data_args.passage_max_len,
+                              self.data_args.append_eos_token)['input_ids']
+
     def __call__(self, features: List[Tuple[str, List[str]]]):
         """
         Collate function for training.
-        :param features: list of (query, passages) tuples
+        :param features: list of (query, passages) tuples, as texts or as pre-tokenized token id arrays
         :return: tokenized query_ids, passage_ids
         """
         all_queries = [f[0] for f in features]
         all_passages = []
         for f in features:
             all_passages.extend(f[1])
-        q_collated = self.tokenizer(
-            all_queries,
-            padding=False, 
-            truncation=True,
-            max_length=self.data_args.query_max_len-1 if self.data_args.append_eos_token else self.data_args.query_max_len,
-            return_attention_mask=False,
-            return_token_type_ids=False,
-            add_special_tokens=True,
-        )
-        d_collated = self.tokenizer(
-            all_passages,
-            padding=False, 
-            truncation=True,
-            max_length=self.data_args.passage_max_len-1 if self.data_args.append_eos_token else self.data_args.passage_max_len,
-            return_attention_mask=False,
-            return_token_type_ids=False,
-            add_special_tokens=True,
-        )
-
-        if self.data_args.append_eos_token:
-            q_collated['input_ids'] = [q + [self.tokenizer.eos_token_id] for q in q_collated['input_ids']]
-            d_collated['input_ids'] = [d + [self.tokenizer.eos_token_id] for d in d_collated['input_ids']]
+        if isinstance(all_queries[0], str):
+            q_collated = {'input_ids': self.tokenize_queries(all_queries)}
+            d_collated = {'input_ids': self.tokenize_passages(all_passages)}
+        else:
+            q_collated = pretokenized(all_queries)
+            d_collated = pretokenized(all_passages)
         
         q_collated = self.tokenizer.pad(
             q_collated,
@@ -68,25 +81,31 @@ class EncodeCollator:
     data_args: DataArguments
     tokenizer: PreTrainedTokenizer
 
+    def _tokenize(self, texts: List[str]):
+        max_length = self.data_args.query_max_len if self.data_args.encode_is_query else self.data_args.passage_max_len
+        return tokenize_texts(self.tokenizer, texts, max_length, self.data_args.append_eos_token)
+
+    def tokenize(self, texts: List[str]) -> List[List[int]]:
+        return self._tokenize(texts)['input_ids']
+
+    def text_lengths(self, texts: List[str]) -> List[int]:
+        """
+        Token lengths of texts as the collator would feed them to the model, before padding.
+        :param texts: list of formatted texts
+        """
+        return [len(x) for x in self.tokenize(texts)]
+
     def __call__(self, features: List[Tuple[str, str]]):
         """
         Collate function for encoding.
-        :param features: list of (id, text) tuples
+        :param features: list of (id, text) tuples, the text possibly pre-tokenized into a token id array
         """
         text_ids = [x[0] for x in features]
         texts = [x[1] for x in features]
-        max_length = self.data_args.query_max_len if self.data_args.encode_is_query else self.data_args.passage_max_len
-        collated_texts = self.tokenizer(
-            texts,
-            padding=False, 
-            truncation=True,
-            max_length=max_length-1 if self.data_args.append_eos_token else max_length,
-            return_attention_mask=False,
-            return_token_type_ids=False,
-            add_special_tokens=True,
-        )
-        if self.data_args.append_eos_token:
-            collated_texts['input_ids'] = [x + [self.tokenizer.eos_token_id] for x in collated_texts['input_ids']]
+        if isinstance(texts[0], str):
+            collated_texts = self._tokenize(texts)
+        else:
+            collated_texts = pretokenized(texts)
         collated_texts = self.tokenizer.pad(
             collated_texts,
             padding=True, 
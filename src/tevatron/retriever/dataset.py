@@ -1,11 +1,12 @@
 import random
-from typing import List, Tuple
+from typing import Iterator, List, Tuple
 
 from datasets import load_dataset
 from torch.utils.data import Dataset
 
 
 from tevatron.retriever.arguments import DataArguments
+from tevatron.retriever.token_cache import load_or_build_tokenized_texts, token_cache_key
 
 import logging
 logger = logging.getLogger(__name__)
@@ -49,6 +50,53 @@ class TrainDataset(Dataset):
                 index=self.data_args.dataset_shard_index,
             )
         self.trainer = trainer
+        self.query_cache = None
+        self.passage_cache = None
+
+    def use_token_cache(self, collator):
+        """
+        Tokenize every query and every distinct passage (by docid) once with the collator's settings,
+        or load them from `data_args.token_cache_dir`; items are then returned as token id arrays.
+        """
+        fingerprint = self.train_data._fingerprint
+        query_key = token_cache_key(collator.tokenizer, self.data_args.query_max_len, self.data_args.query_prefix,
+                                    self.data_args.append_eos_token, self.data_args.prompt, 'train-query', fingerprint)
+        passage_key = token_cache_key(collator.tokenizer, self.data_args.passage_max_len,
+                                      self.data_args.passage_prefix, self.data_args.append_eos_token,
+                                      'train-passage', fingerprint)
+        self.query_cache = load_or_build_tokenized_texts(
+            self.data_args.token_cache_dir, query_key, self._iter_queries, collator.tokenize_queries,
+            total=len(self.train_data),
+        )
+        self.passage_cache = load_or_build_tokenized_texts(
+            self.data_args.token_cache_dir, passage_key, self._iter_passages, collator.tokenize_passages,
+        )
+        # build the docid index before data loader workers are forked
+        self.passage_cache.row_of(self.passage_cache.ids[0])
+
+    def _iter_queries(self, chunk_size: int = 10000) -> Iterator[Tuple[str, str]]:
+        for start in range(0, len(self.train_data), chunk_size):
+            queries = self.train_data[start:start + chunk_size]['query']
+            for i, query in enumerate(queries, start):
+                yield str(i), format_query(query, self.data_args.query_prefix, self.data_args.prompt)
+
+    def _iter_passages(self, chunk_size: int = 1000) -> Iterator[Tuple[str, str]]:
+        columns = [c for c in ('positive_passages', 'negative_passages', 'new_negatives')
+                   if c in self.train_data.column_names]
+        seen = set()
+        for start in range(0, len(self.train_data), chunk_size):
+            groups = self.train_data.select_columns(columns)[start:start + chunk_size]
+            for column in columns:
+                for passages in groups[column]:
+                    for psg in passages:
+                        if psg['docid'] not in seen:
+                            seen.add(psg['docid'])
+                            yield psg['docid'], format_passage(psg['text'], psg['title'], self.data_args.passage_prefix)
+
+    def _passage(self, psg):
+        if self.passage_cache is not None:
+            return self.passage_cache.get_by_id(psg['docid'])
+        return format_passage(psg['text'], psg['title'], self.data_args.passage_prefix)
 
     def __len__(self):
         return len(self.train_data)
@@ -63,7 +111,10 @@ class TrainDataset(Dataset):
         group_positives = group['positive_passages']
         group_negatives = group['negative_passages']
 
-        formated_query = format_query(query, self.data_args.query_prefix, self.data_args.prompt)
+        if self.query_cache is not None:
+            formated_query = self.query_cache[item]
+        else:
+            formated_query = format_query(query, self.data_args.query_prefix, self.data_args.prompt)
         formated_passages = []
 
         if self.data_args.positive_passage_no_shuffle:
@@ -71,7 +122,7 @@ class TrainDataset(Dataset):
         else:
             pos_psg = group_positives[(_hashed_seed + epoch) % len(group_positives)]
         
-        formated_passages.append(format_passage(pos_psg['text'], pos_psg['title'], self.data_args.passage_prefix))
+        formated_passages.append(self._passage(pos_psg))
 
         negative_size = self.data_args.train_group_size - 1
         if len(group_negatives) < negative_size:
@@ -105,7 +156,7 @@ class TrainDataset(Dataset):
             negs = negs[_offset: _offset + negative_size]
 
         for neg_psg in negs:
-            formated_passages.append(format_passage(neg_psg['text'], neg_psg['title'], self.data_args.passage_prefix))
+            formated_passages.append(self._passage(neg_psg))
 
         return formated_query, formated_passages
 
@@ -127,12 +178,37 @@ class EncodeDataset(Dataset):
                 num_shards=self.data_args.dataset_number_of_shards,
                 index=self.data_args.dataset_shard_index,
             )
+        self.token_cache = None
+        self.cache_offset = 0
+
+    def use_token_cache(self, collator):
+        """
+        Tokenize every text once with the collator's settings, or load them from
+        `data_args.token_cache_dir`; items are then returned as token id arrays.
+        """
+        max_length = self.data_args.query_max_len if self.data_args.encode_is_query else self.data_args.passage_max_len
+        prefix = self.data_args.query_prefix if self.data_args.encode_is_query else self.data_args.passage_prefix
+        key = token_cache_key(collator.tokenizer, max_length, prefix, self.data_args.append_eos_token,
+                              self.data_args.prompt if self.data_args.encode_is_query else '',
+                              'encode-query' if self.data_args.encode_is_query else 'encode-passage',
+                              self.encode_data._fingerprint)
+        self.token_cache = load_or_build_tokenized_texts(
+            self.data_args.token_cache_dir, key,
+            lambda: (self._format(self.encode_data[i]) for i in range(len(self.encode_data))),
+            collator.tokenize,
+            total=len(self.encode_data),
+        )
+
+    def select_slice(self, num_slices: int, index: int):
+        """Keep only the `index`-th of `num_slices` contiguous slices of the data."""
+        bounds = [len(self.encode_data) * i // num_slices for i in range(num_slices + 1)]
+        self.encode_data = self.encode_data.select(range(bounds[index], bounds[index + 1]))
+        self.cache_offset += bounds[index]
 
     def __len__(self):
         return len(self.encode_data)
 
-    def __getitem__(self, item) -> Tuple[str, str]:
-        text = self.encode_data[item]
+    def _format(self, text) -> Tuple[str, str]:
         if self.data_args.encode_is_query:
             text_id = text['query_id']
             formated_text = format_query(text['query'], self.data_args.query_prefix, self.data_args.prompt)
@@ -140,3 +216,9 @@ class EncodeDataset(Dataset):
             text_id = text['docid']
             formated_text = format_passage(text['text'], text['title'], self.data_args.passage_prefix)
         return text_id, formated_text
+
+    def __getitem__(self, item) -> Tuple[str, str]:
+        if self.token_cache is not None:
+            row = self.cache_offset + item
+            return str(self.token_cache.ids[row]), self.token_cache[row]
+        return self._format(self.encode_data[item])
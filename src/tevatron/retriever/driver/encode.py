@@ -1,15 +1,18 @@
+import dataclasses
 import logging
 import os
 import pickle
 import sys
 from contextlib import nullcontext
+from functools import partial
+from typing import Optional
 
 import numpy as np
 from tqdm import tqdm
 
 import torch
 
-from torch.utils.data import DataLoader
+from torch.utils.data import DataLoader, Subset
 from transformers import AutoTokenizer
 from transformers import (
     HfArgumentParser,
@@ -19,32 +22,19 @@ from tevatron.retriever.arguments import ModelArguments, DataArguments, \
     TevatronTrainingArguments as TrainingArguments
 from tevatron.retriever.dataset import EncodeDataset
 from tevatron.retriever.collator import EncodeCollator
-from tevatron.retriever.modeling import EncoderOutput, DenseModel
+from tevatron.retriever.sampler import LengthGroupedBatchSampler
+from tevatron.retriever.transfer import DevicePrefetcher, DeviceOutputBuffer
+from tevatron.retriever.embedding_io import create_embedding_shard, finish_embedding_shard, \
+    write_shard_manifest, shard_manifest_path, EncodeCheckpoint, encode_checkpoint_dir
+from tevatron.retriever.quantization import EmbeddingQuantizer, ENCODINGS, OUTPUT_DTYPES, int8_scales
+from tevatron.retriever.modeling import EncoderOutput, DenseModel, SpladeModel
+from tevatron.retriever.sparse_index import SparseShardWriter
+from tevatron.utils.workers import run_workers, worker_output_path
 
 logger = logging.getLogger(__name__)
 
 
-def main():
-    parser = HfArgumentParser((ModelArguments, DataArguments, TrainingArguments))
-    if len(sys.argv) == 2 and sys.argv[1].endswith(".json"):
-        model_args, data_args, training_args = parser.parse_json_file(json_file=os.path.abspath(sys.argv[1]))
-    else:
-        model_args, data_args, training_args = parser.parse_args_into_dataclasses()
-        model_args: ModelArguments
-        data_args: DataArguments
-        training_args: TrainingArguments
-
-    if training_args.local_rank > 0 or training_args.n_gpu > 1:
-        raise NotImplementedError('Multi-GPU encoding is not supported.')
-
-    # Setup logging
-    logging.basicConfig(
-        format="%(asctime)s - %(levelname)s - %(name)s -   %(message)s",
-        datefmt="%m/%d/%Y %H:%M:%S",
-        level=logging.INFO if training_args.local_rank in [-1, 0] else logging.WARN,
-    )
-
-    # logger.info("Training/evaluation parameters %s", training_args)
+def load_tokenizer(model_args: ModelArguments):
     tokenizer = AutoTokenizer.from_pretrained(
         model_args.tokenizer_name if model_args.tokenizer_name else model_args.model_name_or_path,
         cache_dir=model_args.cache_dir
@@ -53,62 +43,333 @@ def main():
     if tokenizer.pad_token_id is None:
         tokenizer.pad_token_id = tokenizer.eos_token_id
     tokenizer.padding_side = 'right'
+    return tokenizer
 
-    if training_args.bf16:
-        torch_dtype = torch.bfloat16
-    elif training_args.fp16:
-        torch_dtype = torch.float16
+
+def encode(model_args: ModelArguments, data_args: DataArguments, training_args: TrainingArguments,
+           device, num_workers: int = 1, worker_index: int = 0, scales: Optional[np.ndarray] = None):
+    """
+    Encode the dataset (or the `worker_index`-th of `num_workers` contiguous slices of it) and save it.
+    `scales` are the int8 scales shared by all workers; they are calibrated here when not given.
+    """
+    # logger.info("Training/evaluation parameters %s", training_args)
+    tokenizer = load_tokenizer(model_args)
+
+    model = load_dense_model(model_args, training_args)
+    # logger.info("Loaded model %s", model_args.model_name_or_path)
+    encode_dataset, encode_collator = load_encode_data(data_args, tokenizer, num_workers, worker_index)
+
+    checkpoint = EncodeCheckpoint(
+        encode_checkpoint_dir(data_args.encode_output_path),
+        info={
+            'model': model_args.model_name_or_path,
+            'lora': model_args.lora_name_or_path,
+            'dataset': [data_args.dataset_name, data_args.dataset_config, data_args.dataset_path,
+                        data_args.dataset_split, data_args.dataset_number_of_shards, data_args.dataset_shard_index],
+            'encode_is_query': data_args.encode_is_query,
+            'num_rows': len(encode_dataset),
+            # everything that changes the stored embeddings, so that parts of different settings are never mixed
+            'pooling': model_args.pooling,
+            'normalize': model_args.normalize,
+            'torch_dtype': str(model_torch_dtype(training_args)),
+            'max_len': data_args.query_max_len if data_args.encode_is_query else data_args.passage_max_len,
+            'prefix': data_args.query_prefix if data_args.encode_is_query else data_args.passage_prefix,
+            'encode_output_dtype': data_args.encode_output_dtype,
+            'encode_output_format': data_args.encode_output_format,
+        },
+        rows_per_part=data_args.encode_checkpoint_rows,
+    )
+    if data_args.encode_resume:
+        checkpoint.resume()
     else:
-        torch_dtype = torch.float32
-    
-    model = DenseModel.load(
+        checkpoint.reset()
+    quantizer = EmbeddingQuantizer(data_args.encode_output_dtype, scales=checkpoint.load_array('scales')) \
+        if data_args.encode_output_dtype else None
+    if quantizer is not None and quantizer.dtype == 'int8' and quantizer.scales is None:
+        quantizer.scales = scales if scales is not None else calibrate_int8_scales(
+            model, model_args, data_args, training_args, device)
+    # dataset rows still to encode
+    todo = np.setdiff1d(np.arange(len(encode_dataset)), checkpoint.done_rows())
+    encode_loader, encode_rows = build_encode_loader(encode_dataset, encode_collator, todo, data_args, training_args,
+                                                     device)
+    lookup_indices = []
+    # outputs are written straight to their rows in dataset order
+    output = DeviceOutputBuffer(
+        len(encode_dataset),
+        device,
+        chunk_size=data_args.encode_chunk_size,
+        rows=encode_rows,
+        allocate=partial(create_embedding_shard, data_args.encode_output_path)
+        if data_args.encode_output_format == 'npy' else np.empty,
+        on_drain=lambda start, end: checkpoint.add(encode_rows[start:end], lookup_indices[start:end], output.output,
+                                                   scales=quantizer.scales if quantizer is not None else None),
+        convert=quantizer.encode if quantizer is not None else None,
+    )
+    model = model.to(device)
+    model.eval()
+
+    for (batch_ids, batch) in tqdm(DevicePrefetcher(encode_loader, device), position=worker_index):
+        lookup_indices.extend(batch_ids)
+        with torch.cuda.amp.autocast() if training_args.fp16 or training_args.bf16 else nullcontext():
+            with torch.no_grad():
+                if data_args.encode_is_query:
+                    model_output: EncoderOutput = model(query=batch)
+                    output.append(model_output.q_reps)
+                else:
+                    model_output: EncoderOutput = model(passage=batch)
+                    output.append(model_output.p_reps)
+
+    encoded = output.finalize()
+    if quantizer is not None and quantizer.num_clipped > 0:
+        logger.warning(f"{quantizer.num_clipped} values were beyond the calibrated int8 range and clipped")
+    encoded_ids = lookup_indices
+    lookup_indices = [None] * len(encode_dataset)
+    for row, text_id in zip(encode_rows.tolist(), encoded_ids):
+        lookup_indices[row] = text_id
+    if checkpoint.parts:
+        reps = np.load(os.path.join(checkpoint.path, checkpoint.parts[0]['reps']), mmap_mode='r')
+        encoded = output.allocate_output(reps.shape[1], reps.dtype)
+        checkpoint.restore(encoded, lookup_indices)
+
+    if data_args.encode_output_format == 'npy':
+        finish_embedding_shard(data_args.encode_output_path, encoded, lookup_indices, quantizer)
+    else:
+        with open(data_args.encode_output_path, 'wb') as f:
+            # protocol 5 writes the array buffer as is instead of first copying it into a bytes object
+            pickle.dump((encoded, lookup_indices), f, protocol=5)
+    checkpoint.remove()
+    return encoded.shape, encoded.dtype.name
+
+
+def encode_sparse(model_args: ModelArguments, data_args: DataArguments, training_args: TrainingArguments,
+                  device, num_workers: int = 1, worker_index: int = 0):
+    """
+    Encode the dataset (or the `worker_index`-th of `num_workers` contiguous slices of it) with a
+    SPLADE model into a CSR shard directory (see SparseShardWriter). The top-k / threshold selection
+    runs on the device, so only the kept weights are copied back.
+    """
+    tokenizer = load_tokenizer(model_args)
+    model = SpladeModel.load(
+        model_args.model_name_or_path,
+        lora_name_or_path=model_args.lora_name_or_path,
+        cache_dir=model_args.cache_dir,
+        torch_dtype=model_torch_dtype(training_args)
+    )
+    model.set_sparse_output(data_args.encode_sparse_top_k, data_args.encode_sparse_threshold)
+    encode_dataset, encode_collator = load_encode_data(data_args, tokenizer, num_workers, worker_index)
+    encode_loader, _ = build_encode_loader(encode_dataset, encode_collator, np.arange(len(encode_dataset)),
+                                           data_args, training_args, device)
+    model = model.to(device)
+    model.eval()
+
+    vocab_size = model.encoder.config.vocab_size
+    id_to_token = {v: k for k, v in tokenizer.get_vocab().items()}
+    vocab = [id_to_token.get(i, f'[{i}]') for i in range(vocab_size)]
+    # every row is stored with its id, so length grouped batches are written in the order they are encoded
+    with SparseShardWriter(data_args.encode_output_path, vocab) as writer:
+        for (batch_ids, batch) in tqdm(DevicePrefetcher(encode_loader, device), position=worker_index):
+            with torch.cuda.amp.autocast() if training_args.fp16 or training_args.bf16 else nullcontext():
+                with torch.no_grad():
+                    if data_args.encode_is_query:
+                        reps = model(query=batch).q_reps
+                    else:
+                        reps = model(passage=batch).p_reps
+            writer.write(batch_ids, reps)
+    return (len(encode_dataset), vocab_size), 'float16'
+
+
+def load_dense_model(model_args: ModelArguments, training_args: TrainingArguments):
+    return DenseModel.load(
         model_args.model_name_or_path,
         pooling=model_args.pooling,
         normalize=model_args.normalize,
         lora_name_or_path=model_args.lora_name_or_path,
         cache_dir=model_args.cache_dir,
-        torch_dtype=torch_dtype
+        torch_dtype=model_torch_dtype(training_args)
     )
-    # logger.info("Loaded model %s", model_args.model_name_or_path)
+
+
+def calibrate_int8_scales(model: DenseModel, model_args: ModelArguments, data_args: DataArguments,
+                          training_args: TrainingArguments, device, seed: int = 42) -> np.ndarray:
+    """
+    int8 scales of the embeddings of `encode_int8_calibration_size` texts sampled uniformly from the
+    whole dataset rather than from the first encoded chunk, which under length grouping holds only
+    the shortest texts and differs between workers.
+    """
+    encode_dataset, encode_collator = load_encode_data(data_args, load_tokenizer(model_args))
+    size = min(data_args.encode_int8_calibration_size, len(encode_dataset))
+    sample = np.sort(np.random.default_rng(seed).choice(len(encode_dataset), size, replace=False))
+    loader = DataLoader(
+        Subset(encode_dataset, sample),
+        batch_size=training_args.per_device_eval_batch_size,
+        collate_fn=encode_collator,
+        num_workers=training_args.dataloader_num_workers,
+    )
+    model = model.to(device)
+    model.eval()
+    reps = []
+    for (_, batch) in tqdm(DevicePrefetcher(loader, device), desc='Calibrating int8 scales'):
+        with torch.cuda.amp.autocast() if training_args.fp16 or training_args.bf16 else nullcontext():
+            with torch.no_grad():
+                if data_args.encode_is_query:
+                    reps.append(model(query=batch).q_reps.float().cpu().numpy())
+                else:
+                    reps.append(model(passage=batch).p_reps.float().cpu().numpy())
+    logger.info(f"Calibrated int8 scales on {size} of {len(encode_dataset)} texts")
+    return int8_scales(np.concatenate(reps))
+
+
+def model_torch_dtype(training_args: TrainingArguments):
+    if training_args.bf16:
+        return torch.bfloat16
+    elif training_args.fp16:
+        return torch.float16
+    return torch.float32
+
+
+def load_encode_data(data_args: DataArguments, tokenizer, num_workers: int = 1, worker_index: int = 0):
     encode_dataset = EncodeDataset(
         data_args=data_args,
     )
-
     encode_collator = EncodeCollator(
         data_args=data_args,
         tokenizer=tokenizer,
     )
+    if data_args.token_cache_dir:
+        encode_dataset.use_token_cache(encode_collator)
+    if num_workers > 1:
+        encode_dataset.select_slice(num_workers, worker_index)
+    return encode_dataset, encode_collator
 
+
+def build_encode_loader(encode_dataset: EncodeDataset, encode_collator: EncodeCollator, todo: np.ndarray,
+                        data_args: DataArguments, training_args: TrainingArguments, device):
+    """A loader over the dataset rows `todo`, and the dataset row of every text in the order they are encoded."""
+    todo_dataset = Subset(encode_dataset, todo) if len(todo) < len(encode_dataset) else encode_dataset
+    pin_memory = training_args.dataloader_pin_memory and torch.device(device).type == 'cuda'
+    if data_args.encode_group_by_length or data_args.encode_max_tokens > 0:
+        batch_sampler = LengthGroupedBatchSampler(
+            np.asarray(compute_text_lengths(encode_dataset, encode_collator))[todo],
+            batch_size=training_args.per_device_eval_batch_size,
+            max_tokens=data_args.encode_max_tokens,
+            pad_to_multiple_of=data_args.pad_to_multiple_of,
+        )
+        batch_sampler.log_padding(training_args.per_device_eval_batch_size)
+        encode_loader = DataLoader(
+            todo_dataset,
+            batch_sampler=batch_sampler,
+            collate_fn=encode_collator,
+            num_workers=training_args.dataloader_num_workers,
+            pin_memory=pin_memory,
+        )
+        return encode_loader, todo[batch_sampler.order]
     encode_loader = DataLoader(
-        encode_dataset,
+        todo_dataset,
         batch_size=training_args.per_device_eval_batch_size,
         collate_fn=encode_collator,
         shuffle=False,
         drop_last=False,
         num_workers=training_args.dataloader_num_workers,
+        pin_memory=pin_memory,
     )
-    encoded = []
-    lookup_indices = []
-    model = model.to(training_args.device)
-    model.eval()
+    return encode_loader, todo
 
-    for (batch_ids, batch) in tqdm(encode_loader):
-        lookup_indices.extend(batch_ids)
-        with torch.cuda.amp.autocast() if training_args.fp16 or training_args.bf16 else nullcontext():
-            with torch.no_grad():
-                for k, v in batch.items():
-                    batch[k] = v.to(training_args.device)
-                if data_args.encode_is_query:
-                    model_output: EncoderOutput = model(query=batch)
-                    encoded.append(model_output.q_reps.cpu().detach().numpy())
-                else:
-                    model_output: EncoderOutput = model(passage=batch)
-                    encoded.append(model_output.p_reps.cpu().detach().numpy())
 
-    encoded = np.concatenate(encoded)
+def compute_text_lengths(encode_dataset: EncodeDataset, encode_collator: EncodeCollator, chunk_size: int = 10000):
+    if encode_dataset.token_cache is not None:
+        start = encode_dataset.cache_offset
+        return encode_dataset.token_cache.lengths()[start:start + len(encode_dataset)]
+    lengths = []
+    for start in tqdm(range(0, len(encode_dataset), chunk_size), desc='Computing text lengths'):
+        texts = [encode_dataset[i][1] for i in range(start, min(start + chunk_size, len(encode_dataset)))]
+        lengths.extend(encode_collator.text_lengths(texts))
+    return lengths
+
 
-    with open(data_args.encode_output_path, 'wb') as f:
-        pickle.dump((encoded, lookup_indices), f)
+def _encode_worker(worker_index, device, model_args, data_args, training_args, num_workers, scales):
+    logger.info(f"Encoding slice {worker_index} of {num_workers} on {device}")
+    data_args = dataclasses.replace(
+        data_args, encode_output_path=worker_output_path(data_args.encode_output_path, worker_index))
+    if data_args.encode_output_format == 'sparse':
+        shape, dtype = encode_sparse(model_args, data_args, training_args, device, num_workers, worker_index)
+    else:
+        shape, dtype = encode(model_args, data_args, training_args, device, num_workers, worker_index, scales)
+    return data_args.encode_output_path, shape, dtype
+
+
+def launch_workers(model_args: ModelArguments, data_args: DataArguments, training_args: TrainingArguments,
+                   num_workers: int):
+    """
+    Encode with `num_workers` processes, one per GPU (wrapping around if there are more workers
+    than GPUs) or on CPU. Worker i encodes the i-th contiguous slice of the dataset into its own
+    shard, and a manifest listing the shards in dataset order is written next to them.
+    """
+    if data_args.token_cache_dir:
+        # tokenize once here rather than racing to build the same cache in every worker
+        EncodeDataset(data_args).use_token_cache(EncodeCollator(data_args, load_tokenizer(model_args)))
+    scales = None
+    if data_args.encode_output_dtype == 'int8':
+        # one set of scales for all shards, so that they can be searched as one corpus
+        scales = calibrate_int8_scales(load_dense_model(model_args, training_args), model_args, data_args,
+                                       training_args, training_args.device)
+        torch.cuda.empty_cache()
+
+    shards = run_workers(_encode_worker, num_workers, training_args.use_cpu,
+                         model_args, data_args, training_args, num_workers, scales)
+    if data_args.encode_output_format == 'sparse':
+        # sparse shards are listed to the sparse index by a glob instead of a manifest
+        logger.info(f"Wrote {num_workers} sparse shards: {[path for path, _, _ in shards]}")
+        return
+    manifest_path = write_shard_manifest(
+        shard_manifest_path(data_args.encode_output_path),
+        [{'path': path, 'count': shape[0]} for path, shape, _ in shards],
+        dim=shards[0][1][1],
+        dtype=shards[0][2],
+        shard_format=data_args.encode_output_format,
+    )
+    logger.info(f"Wrote {num_workers} shards, described by {manifest_path}")
+
+
+def main():
+    parser = HfArgumentParser((ModelArguments, DataArguments, TrainingArguments))
+    if len(sys.argv) == 2 and sys.argv[1].endswith(".json"):
+        model_args, data_args, training_args = parser.parse_json_file(json_file=os.path.abspath(sys.argv[1]))
+    else:
+        model_args, data_args, training_args = parser.parse_args_into_dataclasses()
+        model_args: ModelArguments
+        data_args: DataArguments
+        training_args: TrainingArguments
+
+    num_workers = data_args.encode_num_workers
+    if num_workers == 0:
+        num_workers = max(1, torch.cuda.device_count()) if not training_args.use_cpu else 1
+
+    if training_args.local_rank > 0 or (training_args.n_gpu > 1 and num_workers == 1):
+        raise NotImplementedError('Multi-GPU encoding is only supported through --encode_num_workers.')
+    if data_args.encode_output_format not in ('pickle', 'npy', 'sparse'):
+        raise ValueError(f'Unknown encode_output_format: {data_args.encode_output_format}')
+    if data_args.encode_output_format == 'sparse' and (
+            data_args.encode_output_dtype or data_args.encode_checkpoint_rows > 0 or data_args.encode_resume):
+        raise ValueError('encode_output_format sparse supports neither encode_output_dtype nor checkpointing')
+    if data_args.encode_output_dtype is not None and data_args.encode_output_dtype not in OUTPUT_DTYPES:
+        raise ValueError(f'Unknown encode_output_dtype: {data_args.encode_output_dtype}')
+    if data_args.encode_output_dtype in ENCODINGS and data_args.encode_output_dtype != 'float16' \
+            and data_args.encode_output_format != 'npy':
+        raise ValueError(f'encode_output_dtype {data_args.encode_output_dtype} needs encode_output_format npy')
+
+    # Setup logging
+    logging.basicConfig(
+        format="%(asctime)s - %(levelname)s - %(name)s -   %(message)s",
+        datefmt="%m/%d/%Y %H:%M:%S",
+        level=logging.INFO if training_args.local_rank in [-1, 0] else logging.WARN,
+    )
+
+    if num_workers > 1:
+        launch_workers(model_args, data_args, training_args, num_workers)
+    elif data_args.encode_output_format == 'sparse':
+        encode_sparse(model_args, data_args, training_args, training_args.device)
+    else:
+        encode(model_args, data_args, training_args, training_args.device)
 
 
 if __name__ == "__main__":
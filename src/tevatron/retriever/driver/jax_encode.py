@@ -103,15 +103,21 @@ def main():
     p_encode_step = pmap(encode_step)
     state = jax_utils.replicate(state)
 
-    encoded = []
+    # written in place, rows past dataset_size belong to the padding batch and are dropped
+    encoded = None
     lookup_indices = []
+    offset = 0
 
     for (batch_ids, batch) in tqdm(encode_loader):
         lookup_indices.extend(batch_ids)
-        batch_embeddings = p_encode_step(shard(batch.data), state)
-        encoded.extend(np.concatenate(batch_embeddings, axis=0))
+        batch_embeddings = np.asarray(p_encode_step(shard(batch.data), state))
+        batch_embeddings = batch_embeddings.reshape(-1, batch_embeddings.shape[-1])[:dataset_size - offset]
+        if encoded is None:
+            encoded = np.empty((dataset_size, batch_embeddings.shape[-1]), dtype=batch_embeddings.dtype)
+        encoded[offset:offset + len(batch_embeddings)] = batch_embeddings
+        offset += len(batch_embeddings)
     with open(data_args.encoded_save_path, 'wb') as f:
-        pickle.dump((encoded[:dataset_size], lookup_indices[:dataset_size]), f)
+        pickle.dump((encoded, lookup_indices[:dataset_size]), f, protocol=5)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,101 @@
+import os
+from argparse import ArgumentParser
+
+from tqdm import tqdm
+
+from tevatron.retriever.driver.search import sample_training_reps
+from tevatron.retriever.embedding_io import create_embedding_shard, finish_embedding_shard, prefetch_shards, \
+    read_embedding_shard, resolve_shard_paths, shard_manifest_path, write_shard_manifest
+from tevatron.retriever.quantization import EmbeddingQuantizer, OUTPUT_DTYPES, STORAGE_DTYPES, int8_scales
+from tevatron.retriever.reduction import EmbeddingTransform
+
+import logging
+logger = logging.getLogger(__name__)
+logging.basicConfig(
+    format="%(asctime)s - %(levelname)s - %(name)s -   %(message)s",
+    datefmt="%m/%d/%Y %H:%M:%S",
+    level=logging.INFO,
+)
+
+
+def reduce_shard(path, reps, lookup, transform, quantizer, chunk_size):
+    """Write the reduced (and optionally compressed) embeddings of one shard, chunk by chunk."""
+    output = None
+    num_clipped = quantizer.num_clipped
+    for start in range(0, reps.shape[0], chunk_size):
+        reduced = quantizer.encode(transform(reps[start:start + chunk_size]))
+        if output is None:
+            output = create_embedding_shard(path, (reps.shape[0], reduced.shape[1]), reduced.dtype)
+        output[start:start + len(reduced)] = reduced
+    if output is None:
+        output = create_embedding_shard(path, (0, transform.output_dim), STORAGE_DTYPES[quantizer.dtype])
+    if quantizer.num_clipped > num_clipped:
+        logger.warning(f'{quantizer.num_clipped - num_clipped} values of {path} were beyond the calibrated int8 '
+                       f'range and clipped')
+    finish_embedding_shard(path, output, lookup, quantizer if quantizer.encoding else None)
+    return output.shape[0]
+
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument('--passage_reps', required=True, help='glob pattern of passage embedding shards, or a shard manifest')
+    parser.add_argument('--output_dir', required=True)
+    parser.add_argument('--method', choices=['truncate', 'pca'], default='truncate',
+                        help='keep the leading dimensions (Matryoshka models) or project onto the top principal directions')
+    parser.add_argument('--dim', type=int, default=None, help='number of dimensions to keep')
+    parser.add_argument('--normalize', action='store_true', help='rescale the reduced vectors to unit length')
+    parser.add_argument('--train_sample_size', type=int, default=100000,
+                        help='number of passage vectors sampled from all shards to fit the PCA and the int8 scales on')
+    parser.add_argument('--transform', default=None,
+                        help='apply a transform saved by an earlier run instead of fitting a new one')
+    parser.add_argument('--output_dtype', choices=OUTPUT_DTYPES, default='float32')
+    parser.add_argument('--chunk_size', type=int, default=65536)
+    args = parser.parse_args()
+
+    index_files = resolve_shard_paths(args.passage_reps)
+    logger.info(f'Pattern match found {len(index_files)} files to reduce.')
+    sample = None
+
+    if args.transform is not None:
+        transform = EmbeddingTransform.load(args.transform)
+    else:
+        if args.dim is None:
+            parser.error('--dim is required unless --transform is given')
+        input_dim = read_embedding_shard(index_files[0])[0].shape[1]
+        if args.method == 'truncate':
+            transform = EmbeddingTransform.truncate(input_dim, args.dim, normalize=args.normalize)
+        else:
+            sample = sample_training_reps(index_files, args.train_sample_size)
+            transform = EmbeddingTransform.fit_pca(sample, args.dim, normalize=args.normalize)
+    if args.output_dtype == 'int8' and sample is None:
+        sample = sample_training_reps(index_files, args.train_sample_size)
+    transform_path = os.path.join(args.output_dir, 'transform')
+    transform.save(transform_path)
+    logger.info(f'Reducing {transform.input_dim} to {transform.output_dim} dimensions with {transform.method}, '
+                f'transform saved to {transform_path}')
+
+    # one quantizer for all shards, with int8 scales calibrated on a sample drawn from every shard
+    scales = int8_scales(transform(sample)) if args.output_dtype == 'int8' else None
+    if scales is not None:
+        logger.info(f'Calibrated int8 scales on {len(sample)} vectors sampled from all shards')
+    quantizer = EmbeddingQuantizer(args.output_dtype, scales)
+    shards = []
+    for i, (p_reps, p_lookup) in enumerate(tqdm(prefetch_shards(index_files), total=len(index_files),
+                                                desc='Reducing shards')):
+        path = os.path.join(args.output_dir, f'shard_{i}')
+        count = reduce_shard(path, p_reps, p_lookup, transform, quantizer, args.chunk_size)
+        shards.append({'path': path, 'count': count})
+
+    manifest_path = write_shard_manifest(
+        shard_manifest_path(os.path.join(args.output_dir, 'embeddings')),
+        shards,
+        dim=transform.output_dim,
+        dtype=args.output_dtype,
+        shard_format='npy',
+        transform=os.path.relpath(transform_path, args.output_dir),
+    )
+    logger.info(f'Wrote {len(shards)} reduced shards, described by {manifest_path}')
+
+
+if __name__ == '__main__':
+    main()
@@ -1,12 +1,13 @@
 import pickle
 
 import numpy as np
-import glob
 from argparse import ArgumentParser
 from itertools import chain
 from tqdm import tqdm
 
-from tevatron.retriever.searcher import FaissFlatSearcher
+from tevatron.retriever.searcher import FaissFlatSearcher, FaissSearcher, ExactRescorer, TwoStageSearcher, load_index
+from tevatron.retriever.embedding_io import read_embedding_shard, prefetch_shards, resolve_shard_paths
+from tevatron.retriever.reduction import EmbeddingTransform
 
 import logging
 logger = logging.getLogger(__name__)
@@ -23,24 +24,99 @@ def search_queries(retriever, q_reps, p_lookup, args):
     else:
         all_scores, all_indices = retriever.search(q_reps, args.depth)
 
-    psg_indices = [[str(p_lookup[x]) for x in q_dd] for q_dd in all_indices]
-    psg_indices = np.array(psg_indices)
+    p_lookup = np.asarray(p_lookup).astype(str, copy=False)
+    psg_indices = lookup_docids(p_lookup, all_indices)
     return all_scores, psg_indices
 
 
-def write_ranking(corpus_indices, corpus_scores, q_lookup, ranking_save_file):
-    with open(ranking_save_file, 'w') as f:
-        for qid, q_doc_scores, q_doc_indices in zip(q_lookup, corpus_scores, corpus_indices):
-            score_list = [(s, idx) for s, idx in zip(q_doc_scores, q_doc_indices)]
-            score_list = sorted(score_list, key=lambda x: x[0], reverse=True)
-            for s, idx in score_list:
-                f.write(f'{qid}\t{idx}\t{s}\n')
-
-
-def pickle_load(path):
-    with open(path, 'rb') as f:
-        reps, lookup = pickle.load(f)
-    return np.array(reps), lookup
+def lookup_docids(p_lookup, indices):
+    """Docids of search results; None where a searcher padded a short result list with id -1."""
+    indices = np.asarray(indices)
+    docids = p_lookup[indices]
+    padded = indices < 0
+    if padded.any():
+        docids = docids.astype(object)
+        docids[padded] = None
+    return docids
+
+
+def drop_padding(corpus_indices, corpus_scores):
+    """Per-query docid and score arrays without the padded results, or the arrays unchanged if nothing is padded."""
+    if corpus_indices.dtype != object:
+        return corpus_indices, corpus_scores
+    found = np.not_equal(corpus_indices, None)
+    return ([row[mask].astype(str) for row, mask in zip(corpus_indices, found)],
+            [row[mask] for row, mask in zip(corpus_scores, found)])
+
+
+def sort_ranking(corpus_indices, corpus_scores):
+    corpus_scores = np.asarray(corpus_scores)
+    corpus_indices = np.asarray(corpus_indices)
+    # search results are already sorted by score, only rows that are not get a (stable) sort
+    unsorted = np.flatnonzero(np.any(corpus_scores[:, 1:] > corpus_scores[:, :-1], axis=1))
+    if len(unsorted) > 0:
+        order = np.argsort(-corpus_scores[unsorted], axis=1, kind='stable')
+        corpus_scores = corpus_scores.copy()
+        corpus_indices = corpus_indices.copy()
+        corpus_scores[unsorted] = np.take_along_axis(corpus_scores[unsorted], order, axis=1)
+        corpus_indices[unsorted] = np.take_along_axis(corpus_indices[unsorted], order, axis=1)
+    return corpus_indices, corpus_scores
+
+
+def write_ranking_rows(f, corpus_indices, corpus_scores, q_lookup, save_format='text'):
+    """Write the rankings of a batch of queries to an open file as `text` (qid docid score), `trec` or `marco` lines."""
+    corpus_indices, corpus_scores = sort_ranking(corpus_indices, corpus_scores)
+    # tolist gives python floats, which format exactly like the numpy scalars did
+    for qid, q_doc_scores, q_doc_indices in zip(q_lookup, corpus_scores.tolist(), corpus_indices.tolist()):
+        if None in q_doc_indices:
+            # padding of a result list shorter than the depth
+            found = [(idx, s) for idx, s in zip(q_doc_indices, q_doc_scores) if idx is not None]
+            q_doc_indices, q_doc_scores = [x[0] for x in found], [x[1] for x in found]
+        if save_format == 'text':
+            f.write(''.join([f'{qid}\t{idx}\t{s}\n' for idx, s in zip(q_doc_indices, q_doc_scores)]))
+        elif save_format == 'trec':
+            f.write(''.join([f'{qid} Q0 {idx} {rank} {s} dense\n'
+                             for rank, (idx, s) in enumerate(zip(q_doc_indices, q_doc_scores), 1)]))
+        elif save_format == 'marco':
+            f.write(''.join([f'{qid}\t{idx}\t{rank}\n' for rank, idx in enumerate(q_doc_indices, 1)]))
+        else:
+            raise ValueError(f'Unknown ranking format: {save_format}')
+
+
+def write_ranking(corpus_indices, corpus_scores, q_lookup, ranking_save_file, save_format='text'):
+    with open(ranking_save_file, 'w', buffering=1 << 20) as f:
+        write_ranking_rows(f, corpus_indices, corpus_scores, q_lookup, save_format)
+
+
+def search_and_write(retriever, q_reps, q_lookup, p_lookup, args):
+    """Search query batch by query batch and append each batch's ranking to the output as soon as it is ready."""
+    p_lookup = np.asarray(p_lookup).astype(str, copy=False)
+    batch_size = args.batch_size if args.batch_size > 0 else q_reps.shape[0]
+    start_idx = 0
+    with open(args.save_ranking_to, 'w', buffering=1 << 20) as f:
+        for batch_scores, batch_indices in retriever.iter_batch_search(q_reps, args.depth, batch_size, args.quiet):
+            end_idx = start_idx + batch_scores.shape[0]
+            write_ranking_rows(f, lookup_docids(p_lookup, batch_indices), batch_scores, q_lookup[start_idx:end_idx],
+                               args.save_format)
+            start_idx = end_idx
+
+
+def apply_transform(transform, reps):
+    """Reduce vectors that still have the transform's input dimension; already reduced ones pass through."""
+    if transform is not None and reps.shape[1] == transform.input_dim != transform.output_dim:
+        return transform(reps)
+    return reps
+
+
+def sample_training_reps(index_files, sample_size, seed=42):
+    """Draw about `sample_size` random passage vectors, spread evenly over all shards."""
+    rng = np.random.default_rng(seed)
+    per_shard = -(-sample_size // len(index_files))
+    sample = []
+    for p_reps, _ in tqdm(prefetch_shards(index_files), desc='Sampling training vectors', total=len(index_files)):
+        rows = np.sort(rng.choice(p_reps.shape[0], min(per_shard, p_reps.shape[0]), replace=False))
+        sample.append(np.asarray(p_reps[rows], dtype=np.float32))
+    return np.concatenate(sample)
 
 
 def pickle_save(obj, path):
@@ -48,48 +124,126 @@ def pickle_save(obj, path):
         pickle.dump(obj, f)
 
 
-def main():
-    parser = ArgumentParser()
-    parser.add_argument('--query_reps', required=True)
-    parser.add_argument('--passage_reps', required=True)
-    parser.add_argument('--batch_size', type=int, default=128)
-    parser.add_argument('--depth', type=int, default=1000)
-    parser.add_argument('--save_ranking_to', required=True)
-    parser.add_argument('--save_text', action='store_true')
-    parser.add_argument('--quiet', action='store_true')
-
-    args = parser.parse_args()
-
+def build_index(args, use_gpu, transform=None):
     # print(f"looking at `{args.passage_reps}`")
-    index_files = glob.glob(args.passage_reps)
+    index_files = resolve_shard_paths(args.passage_reps)
     logger.info(f'Pattern match found {len(index_files)} files; loading them into index.')
 
     # logger.info('Loading pickle')
-    p_reps_0, p_lookup_0 = pickle_load(index_files[0])
+    shards = prefetch_shards(index_files, depth=args.prefetch_shards)
+    p_reps_0, p_lookup_0 = next(shards)
+    p_reps_0 = apply_transform(transform, p_reps_0)
     # logger.info('Loading Faiss')
-    retriever = FaissFlatSearcher(p_reps_0)
+    if args.factory_str is None:
+        retriever = FaissFlatSearcher(p_reps_0, num_shards=args.num_shards, use_gpu=use_gpu, storage=args.index_dtype)
+    else:
+        train_reps = apply_transform(transform, sample_training_reps(index_files, args.train_sample_size)) \
+            if args.train_sample_size > 0 else None
+        retriever = FaissSearcher(p_reps_0, args.factory_str, train_reps=train_reps,
+                                  num_shards=args.num_shards, use_gpu=use_gpu)
 
     # logger.info('Adding shards to index')
-    shards = chain([(p_reps_0, p_lookup_0)], map(pickle_load, index_files[1:]))
+    shards = chain([(p_reps_0, p_lookup_0)], shards)
     if len(index_files) > 1:
         shards = tqdm(shards, desc='Loading shards into index', total=len(index_files))
     look_up = []
     # logger.info('Adding shards to index')
     for p_reps, p_lookup in shards:
-        retriever.add(p_reps)
-        look_up += p_lookup
+        retriever.add(apply_transform(transform, p_reps))
+        look_up.append(np.asarray(p_lookup).astype(str, copy=False))
+    look_up = np.concatenate(look_up)
+
+    if args.save_index is not None:
+        retriever.save(args.save_index, look_up)
+    return retriever, look_up
+
+
+def build_two_stage(retriever, look_up, transform, args):
+    """Wrap the (compressed) index in a searcher that reranks its candidates against the full-precision shards."""
+    rerank_files = resolve_shard_paths(args.rerank_reps)
+    shards, rerank_lookup = [], []
+    for path in rerank_files:
+        reps, lookup = read_embedding_shard(path)
+        if not isinstance(reps, np.memmap):
+            logger.warning(f'{path} is not memory mapped, write full-precision shards with '
+                           f'--encode_output_format npy to keep them out of RAM')
+        shards.append(reps)
+        rerank_lookup.append(np.asarray(lookup).astype(str, copy=False))
+    if not np.array_equal(np.concatenate(rerank_lookup), look_up):
+        raise ValueError('--rerank_reps must hold the same passages in the same order as the index')
+    logger.info(f'Reranking {args.candidate_multiplier} x depth candidates against {len(shards)} shards')
+    return TwoStageSearcher(retriever, ExactRescorer(shards), args.candidate_multiplier, query_transform=transform)
 
-    q_reps, q_lookup = pickle_load(args.query_reps)
-    q_reps = q_reps
 
-    logger.info('Index Search Start')
-    all_scores, psg_indices = search_queries(retriever, q_reps, look_up, args)
-    logger.info('Index Search Finished')
+def main():
+    parser = ArgumentParser()
+    parser.add_argument('--query_reps', required=True)
+    parser.add_argument('--passage_reps', default=None, help='glob pattern of passage embedding shards, or a shard manifest')
+    parser.add_argument('--batch_size', type=int, default=128)
+    parser.add_argument('--depth', type=int, default=1000)
+    parser.add_argument('--save_ranking_to', required=True)
+    parser.add_argument('--save_text', action='store_true')
+    parser.add_argument('--save_format', choices=['text', 'trec', 'marco'], default=None,
+                        help='stream the ranking to --save_ranking_to in this format while searching; '
+                             '--save_text is the same as --save_format text')
+    parser.add_argument('--quiet', action='store_true')
+    parser.add_argument('--device', choices=['auto', 'cpu', 'gpu'], default='auto',
+                        help='where to hold the index; auto uses every visible GPU and falls back to CPU')
+    parser.add_argument('--num_shards', type=int, default=None,
+                        help='number of index shards, defaults to one per GPU, or on CPU one per core for flat search and 1 otherwise')
+    parser.add_argument('--prefetch_shards', type=int, default=2,
+                        help='number of embedding shards read ahead while the current one is added, 0 to disable')
+    parser.add_argument('--factory_str', default=None,
+                        help='FAISS index factory string, e.g. IVF4096,PQ64 or HNSW32; exact flat search if not set')
+    parser.add_argument('--index_dtype', choices=['float32', 'float16', 'bfloat16', 'int8'], default=None,
+                        help='how flat CPU shards store the vectors; defaults to the encoding of compressed '
+                             'embedding shards (encode_output_dtype) and float32 otherwise')
+    parser.add_argument('--train_sample_size', type=int, default=0,
+                        help='train the index on this many vectors sampled from all shards, 0 to train on the first shard')
+    parser.add_argument('--nprobe', type=int, default=None, help='number of IVF lists probed per query')
+    parser.add_argument('--ef_search', type=int, default=None, help='HNSW search depth (efSearch)')
+    parser.add_argument('--save_index', default=None, help='directory to save the built index and docid lookup to')
+    parser.add_argument('--transform', default=None,
+                        help='dimension reduction saved by driver.reduce; applied to the queries, and to passage '
+                             'shards that are not reduced yet')
+    parser.add_argument('--rerank_reps', default=None,
+                        help='full-precision passage shards (glob or manifest, same passages and order as the index); '
+                             'the index then only proposes candidates, which are rescored exactly against these')
+    parser.add_argument('--candidate_multiplier', type=int, default=4,
+                        help='with --rerank_reps, retrieve depth times this many candidates from the index')
+    parser.add_argument('--load_index', default=None,
+                        help='directory of an index saved with --save_index, used instead of --passage_reps')
 
-    if args.save_text:
-        write_ranking(psg_indices, all_scores, q_lookup, args.save_ranking_to)
+    args = parser.parse_args()
+    if (args.passage_reps is None) == (args.load_index is None):
+        parser.error('exactly one of --passage_reps and --load_index is required')
+    use_gpu = None if args.device == 'auto' else args.device == 'gpu'
+    transform = EmbeddingTransform.load(args.transform) if args.transform is not None else None
+
+    if args.load_index is not None:
+        retriever, look_up = load_index(args.load_index, use_gpu=use_gpu)
     else:
+        retriever, look_up = build_index(args, use_gpu, transform)
+    if isinstance(retriever, FaissSearcher):
+        retriever.set_search_params(nprobe=args.nprobe, ef_search=args.ef_search)
+
+    q_reps, q_lookup = read_embedding_shard(args.query_reps)
+    if args.rerank_reps is not None:
+        # the full queries are needed for the rerank, the first stage transforms them itself
+        retriever = build_two_stage(retriever, look_up, transform, args)
+    else:
+        q_reps = apply_transform(transform, q_reps)
+    if args.save_text and args.save_format is None:
+        args.save_format = 'text'
+
+    logger.info('Index Search Start')
+    if args.save_format is not None:
+        search_and_write(retriever, q_reps, q_lookup, look_up, args)
+    else:
+        all_scores, psg_indices = search_queries(retriever, q_reps, look_up, args)
+        psg_indices, all_scores = drop_padding(psg_indices, all_scores)
         pickle_save((all_scores, psg_indices), args.save_ranking_to)
+    logger.info('Index Search Finished')
 
 
 if __name__ == '__main__':
@@ -5,6 +5,8 @@ from argparse import ArgumentParser
 import faiss
 import logging
 
+from tevatron.retriever.reduction import EmbeddingTransform
+
 logger = logging.getLogger(__name__)
 logging.basicConfig(format="%(asctime)s - %(levelname)s - %(name)s - %(message)s",
                     datefmt="%m/%d/%Y %H:%M:%S",
@@ -122,7 +124,10 @@ def main():
     parser.add_argument('--depth', type=int, default=1000)
     parser.add_argument('--save_ranking_to', required=True)
     parser.add_argument('--save_text', action='store_true')
+    parser.add_argument('--transform', default=None,
+                        help='dimension reduction saved by driver.reduce, applied to queries and unreduced passages')
     args = parser.parse_args()
+    transform = EmbeddingTransform.load(args.transform) if args.transform is not None else None
 
     retriever = GPUFaissSearcher()
     look_up = []
@@ -132,6 +137,8 @@ def main():
     for file in glob.glob(args.passage_reps):
         p_reps, p_lookup = pickle_load(file)
         p_reps = p_reps.astype(np.float32)
+        if transform is not None and p_reps.shape[1] == transform.input_dim:
+            p_reps = transform(p_reps)
         check_vector_properties(p_reps, f"Passage vectors from {file}")
         all_p_reps.append(p_reps)
         look_up.extend(p_lookup)
@@ -145,6 +152,8 @@ def main():
 
     q_reps, q_lookup = pickle_load(args.query_reps)
     q_reps = q_reps.astype(np.float32)
+    if transform is not None and q_reps.shape[1] == transform.input_dim:
+        q_reps = transform(q_reps)
     check_vector_properties(q_reps, "Query vectors")
     logger.info(f"Query vectors dtype: {q_reps.dtype}")
 
@@ -0,0 +1,82 @@
+import glob
+import os
+from argparse import ArgumentParser
+from itertools import chain, islice
+
+from tqdm import tqdm
+
+from tevatron.retriever.driver.search import write_ranking_rows
+from tevatron.retriever.sparse_index import SparseIndex, SparseIndexBuilder, is_sparse_shard, iter_sparse_shard, \
+    read_json_vectors, read_tsv_queries
+
+import logging
+logger = logging.getLogger(__name__)
+logging.basicConfig(
+    format="%(asctime)s - %(levelname)s - %(name)s -   %(message)s",
+    datefmt="%m/%d/%Y %H:%M:%S",
+    level=logging.INFO,
+)
+
+
+def build_index(pattern, index_dir, block_size, batch_size=10000):
+    builder = SparseIndexBuilder(block_size=block_size)
+    paths = sorted(glob.glob(pattern))
+    shards = [path for path in paths if is_sparse_shard(path)]
+    for path in tqdm(shards, desc='Indexing sparse shards'):
+        builder.add_sparse_shard(path)
+    if len(shards) < len(paths):
+        docs = chain.from_iterable(read_json_vectors(path) for path in paths if path not in shards)
+        with tqdm(desc='Indexing', unit='doc') as progress:
+            while True:
+                batch = list(islice(docs, batch_size))
+                if not batch:
+                    break
+                builder.add_batch([doc_id for doc_id, _ in batch], [vector for _, vector in batch])
+                progress.update(len(batch))
+    return builder.build(index_dir)
+
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument('--index', required=True, help='directory of the sparse index')
+    parser.add_argument('--corpus', default=None,
+                        help='glob pattern of JSON vector files (id, vector) or sparse shards to build the index from first')
+    parser.add_argument('--block_size', type=int, default=128)
+    parser.add_argument('--queries', default=None,
+                        help='sparse query shard, or query file with `qid<TAB>terms` lines, terms repeated by weight')
+    parser.add_argument('--depth', type=int, default=1000)
+    parser.add_argument('--method', choices=['maxscore', 'accumulator'], default='maxscore')
+    parser.add_argument('--save_ranking_to', default=None)
+    parser.add_argument('--save_format', choices=['text', 'trec', 'marco'], default='text')
+    parser.add_argument('--batch_size', type=int, default=1000, help='queries ranked before each write')
+    parser.add_argument('--quiet', action='store_true')
+    args = parser.parse_args()
+
+    if args.corpus is not None:
+        index = build_index(args.corpus, args.index, args.block_size)
+    elif os.path.isdir(args.index):
+        index = SparseIndex.load(args.index)
+    else:
+        parser.error(f'{args.index} does not exist, give --corpus to build it')
+    logger.info(f'Sparse index with {index.num_docs} docs and {len(index.vocab)} terms')
+
+    if args.queries is None:
+        return
+    if args.save_ranking_to is None:
+        parser.error('--save_ranking_to is required with --queries')
+    queries = iter_sparse_shard(args.queries) if is_sparse_shard(args.queries) else read_tsv_queries(args.queries)
+    with open(args.save_ranking_to, 'w', buffering=1 << 20) as f:
+        while True:
+            batch = list(islice(queries, args.batch_size))
+            if not batch:
+                break
+            scores, rows = index.batch_search([vector for _, vector in batch], args.depth, args.method, args.quiet)
+            # queries that match fewer than depth docs are padded with -1
+            for (qid, _), q_scores, q_rows in zip(batch, scores, rows):
+                found = q_rows >= 0
+                write_ranking_rows(f, index.doc_ids[q_rows[found]][None], q_scores[found][None], [qid],
+                                   args.save_format)
+
+
+if __name__ == '__main__':
+    main()
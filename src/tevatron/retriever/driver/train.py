@@ -78,6 +78,9 @@ def main():
 
     train_dataset = TrainDataset(data_args)
     collator = TrainCollator(data_args, tokenizer)
+    if data_args.token_cache_dir:
+        with training_args.main_process_first(desc="token cache"):
+            train_dataset.use_token_cache(collator)
 
     trainer_cls = GCTrainer if training_args.grad_cache else Trainer
     trainer = trainer_cls(
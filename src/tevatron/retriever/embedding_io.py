@@ -0,0 +1,339 @@
+import glob
+import json
+import os
+import pickle
+import queue
+import shutil
+import threading
+from typing import Callable, Iterable, Iterator, List, Optional, Sequence, Tuple, Union
+
+import numpy as np
+
+from tevatron.retriever.quantization import EmbeddingQuantizer, QuantizedReps
+
+import logging
+logger = logging.getLogger(__name__)
+
+SHARD_FORMAT = 'tevatron-embeddings'
+SHARD_VERSION = 2
+MANIFEST_FORMAT = 'tevatron-shard-manifest'
+MANIFEST_SUFFIX = '.manifest.json'
+HEADER_FILE = 'header.json'
+REPS_FILE = 'reps.npy'
+IDS_FILE = 'ids.npy'
+SCALES_FILE = 'scales.npy'
+
+
+def write_embedding_shard(path: str, reps: np.ndarray, lookup: Sequence,
+                          quantizer: Optional[EmbeddingQuantizer] = None) -> None:
+    """
+    Write an embedding shard as a directory holding
+    - reps.npy: the raw (num_texts, dim) matrix, float16/float32 or the codes of a compressed encoding
+    - ids.npy: a fixed-width string array with the text ids, row aligned with reps
+    - scales.npy: the per-dimension scales of int8 codes
+    - header.json: count, dim, dtype and encoding of the shard
+    The header is written last, so a shard without one is incomplete.
+    """
+    reps = np.asarray(reps)
+    assert reps.ndim == 2, f"Embeddings must be a 2-d matrix, got shape {reps.shape}"
+    os.makedirs(path, exist_ok=True)
+    np.save(os.path.join(path, REPS_FILE), reps)
+    finish_embedding_shard(path, reps, lookup, quantizer)
+
+
+def create_embedding_shard(path: str, shape: Tuple[int, int], dtype) -> np.memmap:
+    """
+    Create the reps.npy of a shard as a writable memory map, so embeddings can be written
+    into it as they are computed; `finish_embedding_shard` completes the shard.
+    """
+    os.makedirs(path, exist_ok=True)
+    return np.lib.format.open_memmap(os.path.join(path, REPS_FILE), mode='w+', dtype=dtype, shape=shape)
+
+
+def finish_embedding_shard(path: str, reps: np.ndarray, lookup: Sequence,
+                           quantizer: Optional[EmbeddingQuantizer] = None) -> None:
+    """Write the ids and the header of a shard whose reps.npy holds `reps`, encoded by `quantizer` if given."""
+    assert reps.shape[0] == len(lookup), f"Got {reps.shape[0]} embeddings but {len(lookup)} ids"
+    if isinstance(reps, np.memmap):
+        reps.flush()
+    np.save(os.path.join(path, IDS_FILE), np.array([str(x) for x in lookup]))
+    encoding = quantizer.encoding if quantizer is not None else None
+    if encoding == 'int8':
+        np.save(os.path.join(path, SCALES_FILE), quantizer.scales)
+    header = {
+        'format': SHARD_FORMAT,
+        'version': SHARD_VERSION,
+        'count': int(reps.shape[0]),
+        'dim': int(reps.shape[1]),
+        'dtype': reps.dtype.name,
+        'encoding': encoding,
+    }
+    with open(os.path.join(path, HEADER_FILE), 'w') as f:
+        json.dump(header, f)
+
+
+def read_shard_header(path: str) -> dict:
+    with open(os.path.join(path, HEADER_FILE)) as f:
+        header = json.load(f)
+    if header.get('format') != SHARD_FORMAT or header.get('version', 0) > SHARD_VERSION:
+        raise ValueError(f"{path} is not a supported embedding shard: {header}")
+    return header
+
+
+def is_embedding_shard(path: str) -> bool:
+    return os.path.isdir(path) and os.path.exists(os.path.join(path, HEADER_FILE))
+
+
+def read_embedding_shard(path: str, mmap: bool = True) -> Tuple[Union[np.ndarray, QuantizedReps], Union[np.ndarray, List]]:
+    """
+    Load (reps, lookup) from an embedding shard directory or a legacy pickle file.
+    Shard matrices are memory mapped read-only unless `mmap` is False, so they can be
+    handed to the index without first being copied into RAM. Compressed shards come
+    back as QuantizedReps wrapping the stored codes.
+    """
+    if os.path.isdir(path):
+        header = read_shard_header(path)
+        reps = np.load(os.path.join(path, REPS_FILE), mmap_mode='r' if mmap else None)
+        lookup = np.load(os.path.join(path, IDS_FILE))
+        assert reps.shape == (header['count'], header['dim']), \
+            f"Shard {path} holds {reps.shape} embeddings, header says {(header['count'], header['dim'])}"
+        encoding = header.get('encoding')
+        if encoding is not None:
+            scales = np.load(os.path.join(path, SCALES_FILE)) if encoding == 'int8' else None
+            reps = QuantizedReps(reps, EmbeddingQuantizer(encoding, scales))
+        return reps, lookup
+    return read_pickle_shard(path)
+
+
+def read_pickle_shard(path: str) -> Tuple[np.ndarray, List]:
+    with open(path, 'rb') as f:
+        reps, lookup = pickle.load(f)
+    # asarray only copies when the pickle holds a list of rows
+    return np.asarray(reps), lookup
+
+
+def shard_manifest_path(output_path: str) -> str:
+    return os.path.splitext(output_path)[0] + MANIFEST_SUFFIX
+
+
+def write_shard_manifest(path: str, shards: List[dict], **info) -> str:
+    """
+    Describe a complete set of embedding shards: their paths (relative to the manifest),
+    row counts in dataset order, and any extra `info` such as dim and dtype.
+    """
+    root = os.path.dirname(os.path.abspath(path))
+    shards = [dict(shard, path=os.path.relpath(os.path.abspath(shard['path']), root)) for shard in shards]
+    manifest = {
+        **info,
+        'format': MANIFEST_FORMAT,
+        'version': SHARD_VERSION,
+        'count': sum(shard['count'] for shard in shards),
+        'shards': shards,
+    }
+    with open(path, 'w') as f:
+        json.dump(manifest, f, indent=2)
+    return path
+
+
+def read_shard_manifest(path: str) -> dict:
+    with open(path) as f:
+        manifest = json.load(f)
+    if manifest.get('format') != MANIFEST_FORMAT:
+        raise ValueError(f"{path} is not an embedding shard manifest")
+    root = os.path.dirname(os.path.abspath(path))
+    for shard in manifest['shards']:
+        shard['path'] = os.path.join(root, shard['path'])
+    return manifest
+
+
+def resolve_shard_paths(pattern: str) -> List[str]:
+    """
+    Expand a shard manifest into its shard paths, or a glob pattern into the matching shards in
+    sorted order, so that ties between equal scores break the same way on every run. Manifests and
+    encode checkpoint directories left next to the shards are skipped.
+    """
+    if pattern.endswith(MANIFEST_SUFFIX):
+        return [shard['path'] for shard in read_shard_manifest(pattern)['shards']]
+    return [path for path in sorted(glob.glob(pattern))
+            if not path.endswith(MANIFEST_SUFFIX) and not is_encode_checkpoint_dir(path)]
+
+
+def warm_up(reps: Union[np.ndarray, QuantizedReps]) -> Union[np.ndarray, QuantizedReps]:
+    """Fault every page of a memory mapped matrix into the page cache by touching one byte per page."""
+    codes = reps.codes if isinstance(reps, QuantizedReps) else reps
+    if isinstance(codes, np.memmap) and codes.size > 0 and codes.flags['C_CONTIGUOUS']:
+        np.asarray(codes).reshape(-1).view(np.uint8)[::mmap_page_size()].max()
+    return reps
+
+
+def mmap_page_size() -> int:
+    try:
+        return os.sysconf('SC_PAGE_SIZE')
+    except (ValueError, OSError, AttributeError):
+        return 4096
+
+
+def prefetch_shards(
+        paths: Iterable[str],
+        load_fn: Callable[[str], Tuple[np.ndarray, Sequence]] = read_embedding_shard,
+        depth: int = 2,
+) -> Iterator[Tuple[np.ndarray, Sequence]]:
+    """
+    Yield `load_fn(path)` for every path while a background thread reads ahead.
+    At most `depth` loaded shards wait in the queue, which caps the extra memory, and
+    memory mapped shards are read into the page cache before they are handed over so
+    that disk reads overlap with whatever the consumer does with the previous shard.
+    """
+    if depth <= 0:
+        for path in paths:
+            yield load_fn(path)
+        return
+
+    loaded = queue.Queue(maxsize=depth)
+    stop = threading.Event()
+    done = object()
+
+    def _put(item):
+        while not stop.is_set():
+            try:
+                loaded.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def _worker():
+        try:
+            for path in paths:
+                reps, lookup = load_fn(path)
+                if not _put((warm_up(reps), lookup)):
+                    return
+        except BaseException as e:
+            _put(e)
+            return
+        _put(done)
+
+    thread = threading.Thread(target=_worker, name='shard-prefetch', daemon=True)
+    thread.start()
+    try:
+        while True:
+            item = loaded.get()
+            if item is done:
+                break
+            if isinstance(item, BaseException):
+                raise item
+            yield item
+    finally:
+        stop.set()
+        thread.join()
+
+
+PROGRESS_FORMAT = 'tevatron-encode-progress'
+PROGRESS_FILE = 'progress.json'
+CHECKPOINT_SUFFIX = '.parts'
+
+
+def encode_checkpoint_dir(output_path: str) -> str:
+    return output_path.rstrip(os.sep) + CHECKPOINT_SUFFIX
+
+
+def is_encode_checkpoint_dir(path: str) -> bool:
+    return os.path.isdir(path) and (path.rstrip(os.sep).endswith(CHECKPOINT_SUFFIX)
+                                    or os.path.isfile(os.path.join(path, PROGRESS_FILE)))
+
+
+class EncodeCheckpoint:
+    """
+    Completed rows of an encoding run, saved in the directory `path` as parts
+    (part_{i}.npy embeddings, part_{i}_rows.npy dataset rows, part_{i}_ids.npy text ids)
+    and listed in progress.json. The progress file is replaced atomically after each part,
+    so a killed run loses at most the rows encoded since its last part, and a part that
+    is not listed yet is simply encoded again. `info` identifies the run (dataset size,
+    model, ...); resuming a checkpoint written with different info is refused.
+    """
+
+    def __init__(self, path: str, info: dict, rows_per_part: int = 0):
+        self.path = path
+        self.info = info
+        self.rows_per_part = rows_per_part
+        self.parts = []
+        self._pending_rows = []
+        self._pending_ids = []
+        self._num_pending = 0
+
+    def resume(self):
+        progress_path = os.path.join(self.path, PROGRESS_FILE)
+        if not os.path.exists(progress_path):
+            logger.info(f"No encoding progress found in {self.path}, starting from scratch")
+            return
+        with open(progress_path) as f:
+            progress = json.load(f)
+        if progress.get('format') != PROGRESS_FORMAT or progress['info'] != self.info:
+            raise ValueError(f"Encoding progress in {self.path} belongs to a different run: {progress.get('info')}")
+        self.parts = progress['parts']
+        logger.info(f"Resuming from {len(self.parts)} parts with {self.num_done} encoded rows in {self.path}")
+
+    def reset(self):
+        if os.path.exists(self.path):
+            logger.warning(f"Discarding the encoding progress in {self.path}")
+            shutil.rmtree(self.path)
+
+    @property
+    def num_done(self) -> int:
+        return sum(part['count'] for part in self.parts)
+
+    def done_rows(self) -> np.ndarray:
+        if not self.parts:
+            return np.zeros(0, dtype=np.int64)
+        return np.concatenate([np.load(os.path.join(self.path, part['rows'])) for part in self.parts])
+
+    def restore(self, output: np.ndarray, lookup: List):
+        """Copy the saved embeddings and ids into their dataset rows of `output` and `lookup`."""
+        for part in self.parts:
+            rows = np.load(os.path.join(self.path, part['rows']))
+            output[rows] = np.load(os.path.join(self.path, part['reps']))
+            for row, text_id in zip(rows.tolist(), np.load(os.path.join(self.path, part['ids'])).tolist()):
+                lookup[row] = text_id
+
+    def load_array(self, name: str) -> Optional[np.ndarray]:
+        """Load an array saved along with the parts, e.g. quantization scales."""
+        path = os.path.join(self.path, f'{name}.npy')
+        return np.load(path) if self.parts and os.path.exists(path) else None
+
+    def add(self, rows: np.ndarray, ids: Sequence, output: np.ndarray, **arrays: Optional[np.ndarray]):
+        """
+        Record that `rows` of `output` now hold the embeddings of texts `ids`; save a part once enough
+        are done. `arrays` the parts depend on are saved with the first part.
+        """
+        if self.rows_per_part <= 0:
+            return
+        if not self.parts and not self._pending_rows:
+            os.makedirs(self.path, exist_ok=True)
+            for name, array in arrays.items():
+                if array is not None:
+                    np.save(os.path.join(self.path, f'{name}.npy'), array)
+        self._pending_rows.append(np.asarray(rows, dtype=np.int64))
+        self._pending_ids.extend(str(x) for x in ids)
+        self._num_pending += len(rows)
+        if self._num_pending >= self.rows_per_part:
+            self._save_part(output)
+
+    def _save_part(self, output: np.ndarray):
+        os.makedirs(self.path, exist_ok=True)
+        i = len(self.parts)
+        rows = np.concatenate(self._pending_rows)
+        part = {'reps': f'part_{i}.npy', 'rows': f'part_{i}_rows.npy', 'ids': f'part_{i}_ids.npy', 'count': len(rows)}
+        np.save(os.path.join(self.path, part['reps']), output[rows])
+        np.save(os.path.join(self.path, part['rows']), rows)
+        np.save(os.path.join(self.path, part['ids']), np.array(self._pending_ids))
+        self.parts.append(part)
+        self._pending_rows, self._pending_ids, self._num_pending = [], [], 0
+
+        progress = {'format': PROGRESS_FORMAT, 'info': self.info, 'parts': self.parts}
+        tmp_path = os.path.join(self.path, PROGRESS_FILE + '.tmp')
+        with open(tmp_path, 'w') as f:
+            json.dump(progress, f)
+        os.replace(tmp_path, os.path.join(self.path, PROGRESS_FILE))
+
+    def remove(self):
+        shutil.rmtree(self.path, ignore_errors=True)
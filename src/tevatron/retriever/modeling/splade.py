@@ -1,3 +1,5 @@
+from typing import Optional
+
 import torch
 import logging
 from transformers import AutoModelForMaskedLM
@@ -6,12 +8,44 @@ from .encoder import EncoderModel
 logger = logging.getLogger(__name__)
 
 
+def sparsify(reps: torch.Tensor, top_k: Optional[int] = None, threshold: float = 0.0) -> torch.Tensor:
+    """
+    Keep the weights above `threshold` (and among the `top_k` largest of their row) of a
+    batch x vocab tensor, as a sparse CSR tensor on the same device.
+    """
+    if top_k is not None and top_k < reps.size(1):
+        values, indices = reps.topk(top_k, dim=1)
+        # CSR rows list their columns in ascending order
+        indices, order = indices.sort(dim=1)
+        values = values.gather(1, order)
+        keep = values > threshold
+        indices, values = indices[keep], values[keep]
+    else:
+        keep = reps > threshold
+        indices, values = keep.nonzero()[:, 1], reps[keep]
+    crow_indices = torch.zeros(reps.size(0) + 1, dtype=torch.int64, device=reps.device)
+    crow_indices[1:] = keep.sum(dim=1).cumsum(0)
+    return torch.sparse_csr_tensor(crow_indices, indices, values, size=reps.shape, check_invariants=False)
+
+
 class SpladeModel(EncoderModel):
     TRANSFORMER_CLS = AutoModelForMaskedLM
+    # sparse output at inference, see set_sparse_output
+    sparse_output = False
+    sparse_top_k = None
+    sparse_threshold = 0.0
+
+    def set_sparse_output(self, top_k: Optional[int] = None, threshold: float = 0.0):
+        """Return sparse CSR reps (see sparsify) instead of dense batch x vocab ones when not training."""
+        self.sparse_output = True
+        self.sparse_top_k = top_k
+        self.sparse_threshold = threshold
 
     def encode_query(self, qry):
         qry_out = self.encoder(**qry, return_dict=True).logits
         aggregated_psg_out, _ = torch.max(torch.log(1 + torch.relu(qry_out)) * qry['attention_mask'].unsqueeze(-1), dim=1)
+        if self.sparse_output and not self.training:
+            return sparsify(aggregated_psg_out, self.sparse_top_k, self.sparse_threshold)
         return aggregated_psg_out
     
     def encode_passage(self, psg):
@@ -29,14 +29,15 @@ class UniCoilEncoder(BertPreTrainedModel):
         return self._weights_to_vec(input_ids, tok_weights)
     
     def _weights_to_vec(self, input_ids, tok_weights):
-        input_shape = input_ids.size()
-        tok_weights = torch.relu(tok_weights)
-        tok_emb = torch.zeros(input_shape[0], input_shape[1], self.lm_p.config.vocab_size, dtype=tok_weights.dtype,
-                              device=input_ids.device)
-        tok_emb = torch.scatter(tok_emb, dim=-1, index=input_ids.unsqueeze(-1), src=tok_weights)
+        """Max-pool the token weights into a batch x vocab vector, one scatter without a batch x seq x vocab tensor."""
+        tok_weights = torch.relu(tok_weights).squeeze(-1)
         disabled_token_ids = [0, 101, 102, 103]  # hard code for bert for now, can pass in a tokenizer in the future
-        tok_emb = torch.max(tok_emb, dim=1).values
-        tok_emb[:, disabled_token_ids] *= 0
+        disabled = torch.isin(input_ids, torch.tensor(disabled_token_ids, device=input_ids.device))
+        tok_weights = tok_weights.masked_fill(disabled, 0)
+        tok_emb = torch.zeros(input_ids.size(0), self.config.vocab_size, dtype=tok_weights.dtype,
+                              device=input_ids.device)
+        # the weights are non-negative, so including the zeros leaves absent tokens at 0 and max-pools the rest
+        tok_emb = tok_emb.scatter_reduce(1, input_ids, tok_weights, reduce='amax', include_self=True)
         return tok_emb
 
 
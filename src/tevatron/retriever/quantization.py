@@ -0,0 +1,119 @@
+from typing import Optional
+
+import numpy as np
+
+import logging
+logger = logging.getLogger(__name__)
+
+# how embeddings can be stored: plain float32, or one of the compressed encodings
+OUTPUT_DTYPES = ('float32', 'float16', 'bfloat16', 'int8')
+ENCODINGS = ('float16', 'bfloat16', 'int8')
+STORAGE_DTYPES = {'float32': np.float32, 'float16': np.float16, 'bfloat16': np.uint16, 'int8': np.int8}
+
+
+def float_to_bfloat16(x: np.ndarray) -> np.ndarray:
+    """Round float32 values to bfloat16 (nearest, ties to even) and return their bit patterns as uint16."""
+    bits = np.ascontiguousarray(x, dtype=np.float32).view(np.uint32)
+    return ((bits + 0x7FFF + ((bits >> 16) & 1)) >> 16).astype(np.uint16)
+
+
+def bfloat16_to_float(x: np.ndarray) -> np.ndarray:
+    return (np.asarray(x, dtype=np.uint16).astype(np.uint32) << 16).view(np.float32)
+
+
+def int8_scales(x: np.ndarray) -> np.ndarray:
+    """Per-dimension scales mapping the largest absolute value of each dimension to 127."""
+    scales = np.abs(np.asarray(x, dtype=np.float32)).max(axis=0) / 127
+    scales[scales == 0] = 1
+    return scales.astype(np.float32)
+
+
+def quantize_int8(x: np.ndarray, scales: np.ndarray) -> np.ndarray:
+    return np.clip(np.rint(np.asarray(x, dtype=np.float32) / scales), -127, 127).astype(np.int8)
+
+
+def dequantize_int8(codes: np.ndarray, scales: np.ndarray) -> np.ndarray:
+    return codes.astype(np.float32) * scales
+
+
+class EmbeddingQuantizer:
+    """
+    Convert float embeddings to their stored form and back.
+
+    `float16` and `bfloat16` (kept as uint16 bit patterns, since numpy has no bfloat16)
+    halve the size; `int8` quarters it with a symmetric scale per dimension, x ~= code * scale.
+    The int8 scales are calibrated on the first chunk that is encoded unless given (the
+    encode driver calibrates them on a sample of the whole dataset), and later values beyond
+    the calibrated range are clipped and counted in `num_clipped`.
+    """
+
+    def __init__(self, dtype: str = 'float32', scales: Optional[np.ndarray] = None):
+        if dtype not in OUTPUT_DTYPES:
+            raise ValueError(f"Unknown embedding dtype {dtype}, expected one of {OUTPUT_DTYPES}")
+        self.dtype = dtype
+        self.scales = scales
+        self.num_clipped = 0
+
+    @property
+    def encoding(self) -> Optional[str]:
+        return self.dtype if self.dtype in ENCODINGS else None
+
+    def encode(self, x: np.ndarray) -> np.ndarray:
+        if self.dtype == 'float32':
+            return np.asarray(x, dtype=np.float32)
+        if self.dtype == 'float16':
+            return np.asarray(x, dtype=np.float16)
+        if self.dtype == 'bfloat16':
+            return float_to_bfloat16(x)
+        if self.scales is None:
+            self.scales = int8_scales(x)
+            logger.info(f"Calibrated int8 scales on {x.shape[0]} embeddings")
+        x = np.asarray(x, dtype=np.float32)
+        self.num_clipped += int(np.count_nonzero(np.abs(x) > 127.5 * self.scales))
+        return quantize_int8(x, self.scales)
+
+    def decode(self, codes: np.ndarray) -> np.ndarray:
+        if self.dtype == 'bfloat16':
+            return bfloat16_to_float(codes)
+        if self.dtype == 'int8':
+            return dequantize_int8(codes, self.scales)
+        return np.asarray(codes, dtype=np.float32)
+
+
+class QuantizedReps:
+    """
+    A (num_texts, dim) matrix of stored codes that reads like float32 embeddings.
+
+    Indexing and np.asarray decode to float32, so code that only samples rows keeps
+    working, while searchers that understand the encoding use `codes` directly.
+    """
+
+    def __init__(self, codes: np.ndarray, quantizer: EmbeddingQuantizer):
+        self.codes = codes
+        self.quantizer = quantizer
+
+    @property
+    def encoding(self) -> str:
+        return self.quantizer.encoding
+
+    @property
+    def shape(self):
+        return self.codes.shape
+
+    @property
+    def dtype(self):
+        return np.dtype(np.float32)
+
+    @property
+    def nbytes(self) -> int:
+        return self.codes.nbytes
+
+    def __len__(self):
+        return len(self.codes)
+
+    def __getitem__(self, item) -> np.ndarray:
+        return self.quantizer.decode(self.codes[item])
+
+    def __array__(self, dtype=None, copy=None):
+        reps = self.quantizer.decode(self.codes)
+        return reps if dtype is None else reps.astype(dtype, copy=False)
@@ -0,0 +1,87 @@
+import json
+import os
+from typing import Optional
+
+import numpy as np
+
+import logging
+logger = logging.getLogger(__name__)
+
+TRANSFORM_FORMAT = 'tevatron-embedding-transform'
+TRANSFORM_FILE = 'transform.json'
+MATRIX_FILE = 'matrix.npy'
+
+
+class EmbeddingTransform:
+    """
+    A linear dimension reduction applied identically to passages and queries.
+
+    `truncate` keeps the first `output_dim` dimensions, which is what Matryoshka-trained
+    models are built for. `pca` projects onto the top principal directions of a sample
+    of passages. The projection is not centered: x -> x @ matrix keeps inner products
+    close to the original ones (q.p ~= (q W).(p W)), whereas subtracting the mean would
+    add a per-passage term and change the ranking. With `normalize` the reduced vectors
+    are rescaled to unit length, for models whose scores are cosine similarities.
+    """
+
+    def __init__(self, method: str, input_dim: int, output_dim: int,
+                 matrix: Optional[np.ndarray] = None, normalize: bool = False):
+        if method not in ('truncate', 'pca'):
+            raise ValueError(f"Unknown reduction method {method}")
+        assert output_dim <= input_dim, f"Cannot reduce {input_dim} dimensions to {output_dim}"
+        self.method = method
+        self.input_dim = input_dim
+        self.output_dim = output_dim
+        self.matrix = matrix
+        self.normalize = normalize
+
+    @classmethod
+    def truncate(cls, input_dim: int, output_dim: int, normalize: bool = False) -> 'EmbeddingTransform':
+        return cls('truncate', input_dim, output_dim, normalize=normalize)
+
+    @classmethod
+    def fit_pca(cls, sample: np.ndarray, output_dim: int, normalize: bool = False) -> 'EmbeddingTransform':
+        sample = np.asarray(sample, dtype=np.float32)
+        logger.info(f"Fitting PCA to {output_dim} dimensions on {sample.shape[0]} vectors")
+        centered = sample - sample.mean(axis=0)
+        # eigenvectors of the covariance, in descending order of explained variance
+        eigenvalues, eigenvectors = np.linalg.eigh(centered.T.astype(np.float64) @ centered)
+        order = np.argsort(eigenvalues)[::-1][:output_dim]
+        explained = eigenvalues[order].sum() / max(eigenvalues.sum(), 1e-12)
+        logger.info(f"The {output_dim} principal directions explain {explained:.2%} of the variance")
+        return cls('pca', sample.shape[1], output_dim, eigenvectors[:, order].astype(np.float32), normalize)
+
+    def __call__(self, reps) -> np.ndarray:
+        reps = np.asarray(reps, dtype=np.float32)
+        assert reps.shape[1] == self.input_dim, \
+            f"Transform expects {self.input_dim}-dim vectors, got {reps.shape[1]}"
+        if self.method == 'truncate':
+            reduced = np.ascontiguousarray(reps[:, :self.output_dim])
+        else:
+            reduced = reps @ self.matrix
+        if self.normalize:
+            norms = np.linalg.norm(reduced, axis=1, keepdims=True)
+            reduced /= np.maximum(norms, 1e-12)
+        return reduced
+
+    def save(self, path: str):
+        os.makedirs(path, exist_ok=True)
+        if self.matrix is not None:
+            np.save(os.path.join(path, MATRIX_FILE), self.matrix)
+        with open(os.path.join(path, TRANSFORM_FILE), 'w') as f:
+            json.dump({
+                'format': TRANSFORM_FORMAT,
+                'method': self.method,
+                'input_dim': self.input_dim,
+                'output_dim': self.output_dim,
+                'normalize': self.normalize,
+            }, f)
+
+    @classmethod
+    def load(cls, path: str) -> 'EmbeddingTransform':
+        with open(os.path.join(path, TRANSFORM_FILE)) as f:
+            meta = json.load(f)
+        if meta.get('format') != TRANSFORM_FORMAT:
+            raise ValueError(f"{path} is not an embedding transform")
+        matrix = np.load(os.path.join(path, MATRIX_FILE)) if meta['method'] == 'pca' else None
+        return cls(meta['method'], meta['input_dim'], meta['output_dim'], matrix, meta['normalize'])
@@ -0,0 +1,81 @@
+from typing import Iterator, List, Optional, Sequence
+
+import numpy as np
+from torch.utils.data import Sampler
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+def padded_length(length: int, pad_to_multiple_of: Optional[int] = None) -> int:
+    if pad_to_multiple_of:
+        return -(-length // pad_to_multiple_of) * pad_to_multiple_of
+    return length
+
+
+def count_padded_tokens(lengths: Sequence[int], batches: Sequence[Sequence[int]],
+                        pad_to_multiple_of: Optional[int] = None) -> int:
+    """Number of token positions the model processes when every batch is padded to its longest member."""
+    lengths = np.asarray(lengths)
+    return sum(padded_length(int(lengths[batch].max()), pad_to_multiple_of) * len(batch) for batch in batches)
+
+
+class LengthGroupedBatchSampler(Sampler[List[int]]):
+    """
+    Batch sampler that groups texts of similar token length so that little padding is needed.
+
+    Indices are sorted by length, longest first so that an out-of-memory batch shows up
+    right away, and cut into batches of `batch_size` texts, or, when `max_tokens` is set,
+    into the largest batches whose padded size (batch length x longest length) stays
+    within `max_tokens`. The batches are fixed at construction; `order` gives the
+    dataset indices in the order they are yielded, to put outputs back in dataset order.
+    """
+
+    def __init__(
+            self,
+            lengths: Sequence[int],
+            batch_size: int,
+            max_tokens: Optional[int] = None,
+            pad_to_multiple_of: Optional[int] = None,
+    ):
+        self.lengths = np.asarray(lengths)
+        self.batch_size = batch_size
+        self.max_tokens = max_tokens
+        self.pad_to_multiple_of = pad_to_multiple_of
+        self.batches = self._make_batches()
+
+    def _make_batches(self) -> List[List[int]]:
+        sorted_indices = np.argsort(-self.lengths, kind='stable')
+        if not self.max_tokens:
+            return [sorted_indices[i:i + self.batch_size].tolist()
+                    for i in range(0, len(sorted_indices), self.batch_size)]
+
+        batches = []
+        start = 0
+        while start < len(sorted_indices):
+            longest = padded_length(int(self.lengths[sorted_indices[start]]), self.pad_to_multiple_of)
+            size = max(1, self.max_tokens // max(1, longest))
+            batches.append(sorted_indices[start:start + size].tolist())
+            start += size
+        return batches
+
+    @property
+    def order(self) -> np.ndarray:
+        return np.fromiter((i for batch in self.batches for i in batch), dtype=np.int64, count=len(self.lengths))
+
+    def log_padding(self, sequential_batch_size: int):
+        """Log the padded token count against batching the same texts in dataset order."""
+        sequential = [list(range(i, min(i + sequential_batch_size, len(self.lengths))))
+                      for i in range(0, len(self.lengths), sequential_batch_size)]
+        real = int(self.lengths.sum())
+        before = count_padded_tokens(self.lengths, sequential, self.pad_to_multiple_of)
+        after = count_padded_tokens(self.lengths, self.batches, self.pad_to_multiple_of)
+        logger.info(f"Padded tokens: {before} in dataset order ({1 - real / max(before, 1):.1%} padding), "
+                    f"{after} length grouped ({1 - real / max(after, 1):.1%} padding), "
+                    f"{real} real tokens in {len(self.batches)} batches")
+
+    def __iter__(self) -> Iterator[List[int]]:
+        return iter(self.batches)
+
+    def __len__(self) -> int:
+        return len(self.batches)
@@ -1,124 +1,581 @@
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from typing import Callable, List, Optional, Sequence, Union
+
 import faiss
 import numpy as np
 from tqdm import tqdm
 import logging
 
+from tevatron.retriever.quantization import EmbeddingQuantizer, QuantizedReps, STORAGE_DTYPES, int8_scales
+
 logger = logging.getLogger(__name__)
 
-class FaissFlatSearcher:
-    def __init__(self, init_reps: np.ndarray):
-        self.dim = init_reps.shape[1]
-        # assert self.dim == 4096, "This implementation is optimized for 4096-dimensional vectors"
-        
-        # Get the number of GPUs
-        self.num_gpus = 8 # faiss.get_num_gpus()
-        # breakpoint()
-        # assert self.num_gpus > 0, "No GPUs available"
-        logger.info(f"Number of GPUs available: {self.num_gpus}")
-        
-        # Create GPU resources
-        self.res = [faiss.StandardGpuResources() for _ in range(self.num_gpus)]
-        
-        # max vectors per GPU (40GB limit)
-        self.max_vectors_per_gpu = 1500000 
-        logger.info(f"Max vectors per GPU: {self.max_vectors_per_gpu}")
-
-        # Create a list of GPU indices
-        self.gpu_indices = []
-        for i in range(self.num_gpus):
-            config = faiss.GpuIndexFlatConfig()
-            config.useFloat16 = True  
-            config.device = i
-            index = faiss.GpuIndexFlatIP(self.res[i], self.dim, config)
-            self.gpu_indices.append(index)
-
-        self.current_gpu = 0
-        self.vectors_per_gpu = [0] * self.num_gpus
-
-    def add(self, p_reps: np.ndarray):
-        assert p_reps.shape[1] == self.dim, f"Input vectors must have dimension {self.dim}"
-        remaining_vectors = p_reps.shape[0]
-        start_idx = 0
 
-        while remaining_vectors > 0:
-            # If current GPU index is full, move to next GPU
-            if self.vectors_per_gpu[self.current_gpu] + remaining_vectors > self.max_vectors_per_gpu:
-                vectors_to_add = self.max_vectors_per_gpu - self.vectors_per_gpu[self.current_gpu]
-            else:
-                vectors_to_add = remaining_vectors
+def get_available_cpu_memory() -> int:
+    """Bytes of physical memory currently available to the process."""
+    try:
+        return os.sysconf('SC_AVPHYS_PAGES') * os.sysconf('SC_PAGE_SIZE')
+    except (ValueError, OSError, AttributeError):
+        return 0
 
-            # Add vectors to current GPU
-            self.gpu_indices[self.current_gpu].add(p_reps[start_idx:start_idx + vectors_to_add])
 
-            # Update counters
-            self.vectors_per_gpu[self.current_gpu] += vectors_to_add
-            remaining_vectors -= vectors_to_add
-            start_idx += vectors_to_add
+def get_available_gpu_memory(device: int) -> int:
+    """Bytes of free memory on a GPU, or 0 if it cannot be queried."""
+    try:
+        import torch
+        free, _ = torch.cuda.mem_get_info(device)
+        return free
+    except Exception:
+        return 0
 
-            # Move to next GPU if current one is full
-            if self.vectors_per_gpu[self.current_gpu] == self.max_vectors_per_gpu:
-                self.current_gpu = (self.current_gpu + 1) % self.num_gpus
 
-        logger.info(f"Vectors per GPU after addition: {self.vectors_per_gpu}")
+def get_num_gpus() -> int:
+    get_num = getattr(faiss, 'get_num_gpus', None)
+    return get_num() if get_num is not None else 0
 
-    def search(self, q_reps: np.ndarray, k: int):
-        assert q_reps.shape[1] == self.dim, f"Query vectors must have dimension {self.dim}"
-        assert k > 0, "k must be positive"
-        assert sum(self.vectors_per_gpu) > 0, "No vectors have been added to the index"
 
-        all_scores = []
-        all_indices = []
-        offset = 0
+def is_cpu_only_index(index) -> bool:
+    """Whether FAISS has no GPU version of an index, i.e. it is a graph index (HNSW, NSG) under any pre-transforms."""
+    # downcasts do not own the index, `index` must stay referenced while they are used
+    inner = faiss.downcast_index(index)
+    while isinstance(inner, faiss.IndexPreTransform):
+        inner = faiss.downcast_index(inner.index)
+    return isinstance(inner, (faiss.IndexHNSW, faiss.IndexNSG))
+
+
+def resolve_use_gpu(use_gpu: Optional[bool], cpu_only: bool = False, factory_str: Optional[str] = None) -> bool:
+    """
+    Whether to search on GPU: `use_gpu` if given, otherwise whenever FAISS sees a GPU. Indexes
+    without a GPU version stay on CPU unless GPU search was requested explicitly, which is an error.
+    """
+    num_gpus = get_num_gpus()
+    if use_gpu and num_gpus == 0:
+        raise ValueError("GPU search was requested but FAISS cannot see any GPU")
+    if cpu_only:
+        if use_gpu:
+            raise ValueError(f"The {factory_str} index has no GPU implementation, search it on CPU")
+        if num_gpus > 0:
+            logger.info(f"The {factory_str} index has no GPU implementation, searching on CPU")
+        return False
+    return num_gpus > 0 if use_gpu is None else use_gpu
+
 
-        for i, gpu_index in enumerate(self.gpu_indices):
-            if self.vectors_per_gpu[i] > 0:
-                scores, indices = gpu_index.search(q_reps, min(k, self.vectors_per_gpu[i]))
-                all_scores.append(scores)
-                all_indices.append(indices + offset)
-            offset += self.vectors_per_gpu[i]
+def new_scalar_quantizer_index(dim: int, quantizer: EmbeddingQuantizer):
+    """
+    A flat inner product index over the codes of `quantizer`, which scores queries against
+    the stored float16 / bfloat16 / int8 codes directly instead of float32 copies.
+    """
+    qtype = {
+        'float16': faiss.ScalarQuantizer.QT_fp16,
+        'bfloat16': faiss.ScalarQuantizer.QT_bf16,
+        'int8': faiss.ScalarQuantizer.QT_8bit,
+    }[quantizer.dtype]
+    index = faiss.IndexScalarQuantizer(dim, qtype, faiss.METRIC_INNER_PRODUCT)
+    if quantizer.dtype == 'int8':
+        # QT_8bit decodes code c as vmin + (c + 0.5) / 255 * vdiff, which is (c - 128) * scale for these values
+        scales = quantizer.scales.astype(np.float32)
+        faiss.copy_array_to_vector(np.concatenate([-128.5 * scales, 255 * scales]), index.sq.trained)
+        index.is_trained = True
+    return index
 
-        # Merge results from all GPUs
-        merged_scores = np.concatenate(all_scores, axis=1)
-        merged_indices = np.concatenate(all_indices, axis=1)
 
-        # Sort to get top-k
+def scalar_quantizer_codes(codes: np.ndarray) -> np.ndarray:
+    """The byte layout `new_scalar_quantizer_index` expects for codes stored by EmbeddingQuantizer."""
+    if codes.dtype == np.int8:
+        return (codes.astype(np.int16) + 128).astype(np.uint8)
+    return np.ascontiguousarray(codes).view(np.uint8)
+
+
+def merge_topk(all_scores: List[np.ndarray], all_indices: List[np.ndarray], k: int):
+    """
+    Merge per-shard top-k lists, each sorted by descending score, into the global top-k.
+
+    Because every list is sorted, taking the top ceil(k / num_shards) of each shard already
+    yields k candidates, so the smallest of the shards' ceil(k / num_shards)-th scores is a
+    lower bound on the global k-th score. Only the shard prefixes above that bound are
+    selected from, which is usually ~2k columns instead of num_shards * k.
+    """
+    if len(all_scores) == 1:
+        return all_scores[0][:, :k], all_indices[0][:, :k]
+
+    per_shard = -(-k // len(all_scores))
+    if all(scores.shape[1] >= per_shard for scores in all_scores):
+        bound = np.min([scores[:, per_shard - 1] for scores in all_scores], axis=0)
+        widths = [int((scores >= bound[:, None]).sum(axis=1).max()) for scores in all_scores]
+    else:
+        widths = [scores.shape[1] for scores in all_scores]
+    merged_scores = np.concatenate([scores[:, :w] for scores, w in zip(all_scores, widths)], axis=1)
+    merged_indices = np.concatenate([indices[:, :w] for indices, w in zip(all_indices, widths)], axis=1)
+
+    num_candidates = merged_scores.shape[1]
+    if num_candidates <= 2 * k:
         top_k_idx = np.argsort(merged_scores, axis=1)[:, -k:][:, ::-1]
-        final_scores = np.take_along_axis(merged_scores, top_k_idx, axis=1)
-        final_indices = np.take_along_axis(merged_indices, top_k_idx, axis=1)
+    else:
+        top_k_idx = np.argpartition(merged_scores, num_candidates - k, axis=1)[:, -k:]
+        order = np.argsort(np.take_along_axis(merged_scores, top_k_idx, axis=1), axis=1)[:, ::-1]
+        top_k_idx = np.take_along_axis(top_k_idx, order, axis=1)
 
-        assert final_scores.shape == (q_reps.shape[0], k), f"Unexpected shape of final scores: {final_scores.shape}"
-        assert final_indices.shape == (q_reps.shape[0], k), f"Unexpected shape of final indices: {final_indices.shape}"
+    final_scores = np.take_along_axis(merged_scores, top_k_idx, axis=1)
+    final_indices = np.take_along_axis(merged_indices, top_k_idx, axis=1)
+    return final_scores, final_indices
 
-        return final_scores, final_indices
 
-    def batch_search(self, q_reps: np.ndarray, k: int, batch_size: int, quiet: bool=False):
+class BatchSearchMixin:
+    """Batched search for searchers that define `search(q_reps, k)`, `dim` and `ntotal`."""
+
+    def iter_batch_search(self, q_reps: np.ndarray, k: int, batch_size: int, quiet: bool=False):
+        """Yield (scores, indices) for consecutive batches of queries, so results never have to be held at once."""
         assert q_reps.shape[1] == self.dim, f"Query vectors must have dimension {self.dim}"
-        
+
         num_query = q_reps.shape[0]
-        all_scores = []
-        all_indices = []
-        
         for start_idx in tqdm(range(0, num_query, batch_size), disable=quiet):
             end_idx = min(start_idx + batch_size, num_query)
-            batch_q_reps = q_reps[start_idx:end_idx]
-            
-            batch_scores, batch_indices = self.search(batch_q_reps, k)
-            
+            batch_q_reps = np.ascontiguousarray(q_reps[start_idx:end_idx], dtype=np.float32)
+
+            yield self.search(batch_q_reps, k)
+
+    def batch_search(self, q_reps: np.ndarray, k: int, batch_size: int, quiet: bool=False):
+        num_query = q_reps.shape[0]
+        all_scores = []
+        all_indices = []
+
+        for batch_scores, batch_indices in self.iter_batch_search(q_reps, k, batch_size, quiet):
             all_scores.append(batch_scores)
             all_indices.append(batch_indices)
-        
+
         all_scores = np.concatenate(all_scores, axis=0)
         all_indices = np.concatenate(all_indices, axis=0)
 
+        k = min(k, self.ntotal)
         assert all_scores.shape == (num_query, k), f"Unexpected shape of all scores: {all_scores.shape}"
         assert all_indices.shape == (num_query, k), f"Unexpected shape of all indices: {all_indices.shape}"
 
         return all_scores, all_indices
 
+
+class FaissFlatSearcher(BatchSearchMixin):
+    """
+    Exact inner product search over a corpus split into shards.
+
+    On GPU boxes each visible device holds one shard; otherwise the corpus is split
+    into CPU shards that are searched concurrently from a thread pool (FAISS releases
+    the GIL during search). Every `add` call is spread evenly over the shards, and
+    each shard keeps the global ids of the vectors it holds so that the per-shard
+    top-k can be merged back into corpus order.
+
+    `storage` picks how CPU shards hold the vectors: `float32`, or `float16`, `bfloat16`
+    or `int8` scalar quantizer indexes that score the compressed codes directly. By default
+    it follows the encoding of compressed input (see QuantizedReps) and is float32 otherwise.
+    GPU shards always hold float16/float32 vectors.
+    """
+    # fraction of the free memory that the index may occupy, the rest is left for search buffers
+    memory_fraction = 0.8
+    # used when the free memory of a GPU cannot be queried (~40GB of fp16 4096-dim vectors)
+    default_max_vectors_per_gpu = 1500000
+    # rows converted and added at a time, which bounds the temporary float32 copies
+    add_chunk_size = 1 << 16
+    # whether the shards have no GPU version
+    cpu_only = False
+
+    def __init__(
+            self,
+            init_reps: np.ndarray,
+            num_shards: Optional[int] = None,
+            use_gpu: Optional[bool] = None,
+            use_float16: bool = True,
+            storage: Optional[str] = None,
+    ):
+        self.dim = init_reps.shape[1]
+        self.storage = storage or (init_reps.encoding if isinstance(init_reps, QuantizedReps) else 'float32')
+        if isinstance(init_reps, QuantizedReps) and init_reps.encoding == self.storage:
+            self.quantizer = init_reps.quantizer
+        else:
+            scales = int8_scales(np.asarray(init_reps)) if self.storage == 'int8' else None
+            self.quantizer = EmbeddingQuantizer(self.storage, scales)
+
+        num_gpus = get_num_gpus()
+        self.use_gpu = resolve_use_gpu(use_gpu, self.cpu_only, getattr(self, 'factory_str', None))
+
+        if self.use_gpu:
+            self.num_shards = num_shards or num_gpus
+            self.res = [faiss.StandardGpuResources() for _ in range(num_gpus)]
+            self.shards = [self._new_gpu_index(i % num_gpus, use_float16) for i in range(self.num_shards)]
+            bytes_per_vector = self._bytes_per_vector(use_float16)
+            self.max_vectors_per_shard = []
+            for i in range(self.num_shards):
+                free = get_available_gpu_memory(i % num_gpus)
+                if free > 0:
+                    self.max_vectors_per_shard.append(int(free * self.memory_fraction) // bytes_per_vector)
+                else:
+                    self.max_vectors_per_shard.append(self.default_max_vectors_per_gpu)
+        else:
+            self.num_shards = num_shards or self._default_cpu_shards()
+            self.shards = [self._new_cpu_index() for _ in range(self.num_shards)]
+            free = get_available_cpu_memory()
+            bytes_per_vector = self._bytes_per_vector(use_float16=False)
+            capacity = int(free * self.memory_fraction) // bytes_per_vector // self.num_shards if free > 0 else None
+            self.max_vectors_per_shard = [capacity] * self.num_shards
+
+        logger.info(f"Searching over {self.num_shards} {'GPU' if self.use_gpu else self.storage + ' CPU'} shards")
+        logger.info(f"Max vectors per shard: {self.max_vectors_per_shard}")
+
+        self.vectors_per_shard = [0] * self.num_shards
+        self.shard_ids = [[] for _ in range(self.num_shards)]
+        self._shard_id_arrays = None
+        self.ntotal = 0
+        self._pool = ThreadPoolExecutor(max_workers=self.num_shards) if self.num_shards > 1 else None
+
+    def save(self, path: str, lookup: Sequence):
+        """
+        Write every shard as a CPU FAISS index together with the global ids it holds and
+        the docid lookup table, so that `load_index` can restore the searcher without
+        rebuilding it from the embedding shards.
+        """
+        assert len(lookup) == self.ntotal, f"Lookup has {len(lookup)} ids but the index holds {self.ntotal} vectors"
+        os.makedirs(path, exist_ok=True)
+        for i, (shard, ids) in enumerate(zip(self.shards, self._get_shard_id_arrays())):
+            cpu_shard = faiss.index_gpu_to_cpu(shard) if self.use_gpu else shard
+            faiss.write_index(cpu_shard, os.path.join(path, f'shard_{i}.faiss'))
+            np.save(os.path.join(path, f'shard_{i}_ids.npy'), ids)
+        np.save(os.path.join(path, 'lookup.npy'), np.asarray(lookup).astype(str, copy=False))
+        if not self.use_gpu and self.storage == 'int8':
+            # vectors added after loading are encoded with the same scales
+            np.save(os.path.join(path, 'scales.npy'), self.quantizer.scales)
+        meta = {
+            'searcher': type(self).__name__,
+            'dim': self.dim,
+            'num_shards': self.num_shards,
+            'ntotal': self.ntotal,
+            'factory_str': getattr(self, 'factory_str', None),
+            'storage': 'float32' if self.use_gpu else self.storage,
+        }
+        with open(os.path.join(path, 'meta.json'), 'w') as f:
+            json.dump(meta, f)
+        logger.info(f"Saved {self.num_shards} index shards with {self.ntotal} vectors to {path}")
+
+    def _default_cpu_shards(self) -> int:
+        return os.cpu_count() or 1
+
+    def _bytes_per_vector(self, use_float16: bool) -> int:
+        return self.dim * (2 if use_float16 else np.dtype(STORAGE_DTYPES[self.storage]).itemsize)
+
+    def _new_cpu_index(self):
+        if self.storage != 'float32':
+            return new_scalar_quantizer_index(self.dim, self.quantizer)
+        return faiss.IndexFlatIP(self.dim)
+
+    def _compressed_codes(self, p_reps, start: int, end: int) -> Optional[np.ndarray]:
+        """Rows [start, end) as codes of this searcher's CPU storage, or None if the shards take float32 vectors."""
+        if self.use_gpu or self.storage == 'float32':
+            return None
+        if isinstance(p_reps, QuantizedReps) and p_reps.encoding == self.storage and (
+                self.storage != 'int8' or np.array_equal(p_reps.quantizer.scales, self.quantizer.scales)):
+            return p_reps.codes[start:end]
+        # differently encoded (or scaled) input is decoded and re-encoded
+        return self.quantizer.encode(p_reps[start:end])
+
+    def _add_rows(self, shard, p_reps, start: int, end: int):
+        for chunk_start in range(start, end, self.add_chunk_size):
+            chunk_end = min(chunk_start + self.add_chunk_size, end)
+            codes = self._compressed_codes(p_reps, chunk_start, chunk_end)
+            if codes is not None:
+                shard.add_sa_codes(scalar_quantizer_codes(codes))
+            else:
+                shard.add(np.ascontiguousarray(p_reps[chunk_start:chunk_end], dtype=np.float32))
+
+    def _new_gpu_index(self, device: int, use_float16: bool):
+        config = faiss.GpuIndexFlatConfig()
+        config.useFloat16 = use_float16
+        config.device = device
+        return faiss.GpuIndexFlatIP(self.res[device], self.dim, config)
+
+    def _map(self, fn, *iterables):
+        if self._pool is None:
+            return list(map(fn, *iterables))
+        return list(self._pool.map(partial(self._run_in_shard_thread, fn), *iterables))
+
+    def _run_in_shard_thread(self, fn, *args):
+        # split the cores between the shards so that concurrent shard searches do not oversubscribe; OpenMP
+        # thread counts are per thread, so this only limits the pool's own threads, not the rest of the process
+        if not self.use_gpu:
+            faiss.omp_set_num_threads(max(1, (os.cpu_count() or 1) // self.num_shards))
+        return fn(*args)
+
+    def add(self, p_reps: Union[np.ndarray, QuantizedReps]):
+        assert p_reps.shape[1] == self.dim, f"Input vectors must have dimension {self.dim}"
+        num_vectors = p_reps.shape[0]
+        bounds = np.linspace(0, num_vectors, self.num_shards + 1).astype(np.int64)
+
+        def _add(shard_idx):
+            start, end = bounds[shard_idx], bounds[shard_idx + 1]
+            if end > start:
+                self._add_rows(self.shards[shard_idx], p_reps, start, end)
+
+        self._map(_add, range(self.num_shards))
+
+        for i in range(self.num_shards):
+            start, end = bounds[i], bounds[i + 1]
+            if end > start:
+                self.shard_ids[i].append(np.arange(self.ntotal + start, self.ntotal + end, dtype=np.int64))
+                self.vectors_per_shard[i] += int(end - start)
+                capacity = self.max_vectors_per_shard[i]
+                if capacity is not None and self.vectors_per_shard[i] > capacity:
+                    logger.warning(f"Shard {i} holds {self.vectors_per_shard[i]} vectors, "
+                                   f"more than the {capacity} estimated to fit in memory")
+        self.ntotal += num_vectors
+        self._shard_id_arrays = None
+
+        logger.info(f"Vectors per shard after addition: {self.vectors_per_shard}")
+
+    def _get_shard_id_arrays(self):
+        if self._shard_id_arrays is None:
+            self._shard_id_arrays = [
+                np.concatenate(ids) if ids else np.zeros(0, dtype=np.int64) for ids in self.shard_ids
+            ]
+            self.shard_ids = [[ids] for ids in self._shard_id_arrays]
+        return self._shard_id_arrays
+
+    def search(self, q_reps: np.ndarray, k: int):
+        assert q_reps.shape[1] == self.dim, f"Query vectors must have dimension {self.dim}"
+        assert k > 0, "k must be positive"
+        assert self.ntotal > 0, "No vectors have been added to the index"
+        k = min(k, self.ntotal)
+        shard_id_arrays = self._get_shard_id_arrays()
+        active = [i for i in range(self.num_shards) if self.vectors_per_shard[i] > 0]
+
+        def _search(shard_idx):
+            scores, indices = self.shards[shard_idx].search(q_reps, min(k, self.vectors_per_shard[shard_idx]))
+            ids = shard_id_arrays[shard_idx][indices]
+            # approximate indexes pad with -1 when fewer than k vectors were visited
+            ids[indices < 0] = -1
+            return scores, ids
+
+        results = self._map(_search, active)
+        final_scores, final_indices = merge_topk([r[0] for r in results], [r[1] for r in results], k)
+
+        assert final_scores.shape == (q_reps.shape[0], k), f"Unexpected shape of final scores: {final_scores.shape}"
+        assert final_indices.shape == (q_reps.shape[0], k), f"Unexpected shape of final indices: {final_indices.shape}"
+
+        return final_scores, final_indices
+
+
 class FaissSearcher(FaissFlatSearcher):
-    def __init__(self, init_reps: np.ndarray, factory_str: str):
-        super().__init__(init_reps)
+    """
+    Inner product search with any index built from a FAISS factory string, e.g. `IVF4096,PQ64` or `HNSW32`.
+
+    The index is trained once, on `train_reps` when given (typically a random sample drawn
+    from all corpus shards) and on `init_reps` otherwise, and every shard starts as a copy
+    of the trained, empty index. Graph indexes (HNSW, NSG) have no GPU implementation and stay
+    on CPU unless GPU search is requested explicitly, which is refused.
+    """
+
+    def __init__(
+            self,
+            init_reps: np.ndarray,
+            factory_str: str,
+            train_reps: Optional[np.ndarray] = None,
+            num_shards: Optional[int] = None,
+            use_gpu: Optional[bool] = None,
+            use_float16: bool = True,
+    ):
         self.factory_str = factory_str
+        self.trained_index = faiss.index_factory(init_reps.shape[1], factory_str, faiss.METRIC_INNER_PRODUCT)
+        self.trained_index.verbose = True
+        if not self.trained_index.is_trained:
+            train_reps = init_reps if train_reps is None else train_reps
+            logger.info(f"Training {factory_str} index on {train_reps.shape[0]} vectors")
+            self.trained_index.train(np.ascontiguousarray(train_reps, dtype=np.float32))
+        self.trained_index.verbose = False
+        self.cpu_only = is_cpu_only_index(self.trained_index)
+        # the factory string decides how vectors are compressed
+        super().__init__(init_reps, num_shards=num_shards, use_gpu=use_gpu, use_float16=use_float16,
+                         storage='float32')
         logger.info(f"FaissSearcher initialized with factory string: {factory_str}")
-        # Note: This implementation still uses FaissFlatSearcher
-        # The factory_str is stored but not used in the current version
\ No newline at end of file
+
+    def _default_cpu_shards(self) -> int:
+        # approximate indexes parallelize over queries internally, and each extra shard repeats the probing work
+        return 1
+
+    def _bytes_per_vector(self, use_float16: bool) -> int:
+        try:
+            return max(1, self.trained_index.sa_code_size())
+        except RuntimeError:
+            return super()._bytes_per_vector(use_float16)
+
+    def _new_cpu_index(self):
+        return faiss.clone_index(self.trained_index)
+
+    def _new_gpu_index(self, device: int, use_float16: bool):
+        options = faiss.GpuClonerOptions()
+        options.useFloat16 = use_float16
+        return faiss.index_cpu_to_gpu(self.res[device], device, self.trained_index, options)
+
+    def set_search_params(self, nprobe: Optional[int] = None, ef_search: Optional[int] = None):
+        """Set the IVF probe count and/or the HNSW search depth on every shard."""
+        params = faiss.GpuParameterSpace() if self.use_gpu else faiss.ParameterSpace()
+        for shard in self.shards:
+            if nprobe is not None:
+                params.set_index_parameter(shard, 'nprobe', nprobe)
+            if ef_search is not None:
+                params.set_index_parameter(shard, 'efSearch', ef_search)
+
+
+class ExactRescorer:
+    """
+    Exact inner product scores for candidate ids against full-precision passage vectors.
+
+    The vectors stay in their (memory mapped) embedding shards, with global ids numbering
+    the rows of all shards in order, so only the rows of the candidates are ever read.
+    """
+
+    def __init__(self, shards: Sequence[Union[np.ndarray, QuantizedReps]]):
+        self.shards = list(shards)
+        self.offsets = np.cumsum([0] + [shard.shape[0] for shard in self.shards])
+        self.ntotal = int(self.offsets[-1])
+        self.dim = self.shards[0].shape[1]
+
+    def gather(self, ids: np.ndarray) -> np.ndarray:
+        """float32 vectors of the given (sorted) global ids."""
+        vectors = np.empty((len(ids), self.dim), dtype=np.float32)
+        shard_of = np.searchsorted(self.offsets, ids, side='right') - 1
+        for shard_idx in np.unique(shard_of):
+            mask = shard_of == shard_idx
+            vectors[mask] = self.shards[shard_idx][ids[mask] - self.offsets[shard_idx]]
+        return vectors
+
+    def rescore(self, q_reps: np.ndarray, candidates: np.ndarray, k: int):
+        """
+        Top-k of every query's candidate ids by exact score, sorted by descending score.
+        Candidates may be padded with -1; rows with fewer than k candidates are padded
+        with id -1 and score -inf, like the FAISS searchers do.
+        """
+        k = min(k, candidates.shape[1])
+        # ascending ids break score ties towards the lower id
+        candidates = np.sort(candidates, axis=1)
+        valid = candidates >= 0
+        # the union of all candidates is read from the memory maps once, in order
+        union = np.unique(candidates[valid])
+        if len(union) == 0:
+            return (np.full((q_reps.shape[0], k), -np.inf, dtype=np.float32),
+                    np.full((q_reps.shape[0], k), -1, dtype=np.int64))
+        vectors = self.gather(union)
+        positions = np.searchsorted(union, np.where(valid, candidates, union[0]))
+        q_reps = np.asarray(q_reps, dtype=np.float32)
+        scores = np.matmul(vectors[positions], q_reps[:, :, None])[:, :, 0]
+        scores[~valid] = -np.inf
+        top = np.argsort(-scores, axis=1, kind='stable')[:, :k]
+        final_scores = np.take_along_axis(scores, top, axis=1)
+        final_indices = np.where(np.take_along_axis(valid, top, axis=1), np.take_along_axis(candidates, top, axis=1), -1)
+        return final_scores, final_indices
+
+
+class TwoStageSearcher(BatchSearchMixin):
+    """
+    Retrieve `depth * candidate_multiplier` candidates from a compressed first stage index
+    (PQ / IVF via FaissSearcher, int8 or reduced dimension flat shards, ...) and rerank them
+    exactly against the full-precision vectors of an ExactRescorer.
+    `query_transform` maps full queries to the first stage space, e.g. an EmbeddingTransform.
+    """
+
+    def __init__(self, first_stage: FaissFlatSearcher, rescorer: ExactRescorer, candidate_multiplier: int = 4,
+                 query_transform: Optional[Callable[[np.ndarray], np.ndarray]] = None):
+        assert first_stage.ntotal == rescorer.ntotal, \
+            f"The first stage index holds {first_stage.ntotal} vectors, the rerank shards {rescorer.ntotal}"
+        self.first_stage = first_stage
+        self.rescorer = rescorer
+        self.candidate_multiplier = candidate_multiplier
+        self.query_transform = query_transform
+        self.dim = rescorer.dim
+        self.ntotal = rescorer.ntotal
+
+    def search(self, q_reps: np.ndarray, k: int):
+        first_q_reps = self.query_transform(q_reps) if self.query_transform is not None else q_reps
+        _, candidates = self.first_stage.search(np.ascontiguousarray(first_q_reps, dtype=np.float32),
+                                                k * self.candidate_multiplier)
+        return self.rescorer.rescore(q_reps, candidates, min(k, self.ntotal))
+
+
+def read_index(path: str, mmap: bool = True):
+    """Read a FAISS index, memory mapping its storage when this FAISS version and index type allow it."""
+    mmap_flag = getattr(faiss, 'IO_FLAG_MMAP_IFC', None)
+    if mmap and mmap_flag is not None:
+        try:
+            return faiss.read_index(path, mmap_flag | faiss.IO_FLAG_READ_ONLY)
+        except RuntimeError:
+            logger.info(f"{path} cannot be memory mapped, reading it into memory")
+    return faiss.read_index(path)
+
+
+def decode_to_gpu_flat(searcher: FaissFlatSearcher, shard, device: int, use_float16: bool):
+    gpu_shard = searcher._new_gpu_index(device, use_float16)
+    for start in range(0, shard.ntotal, searcher.add_chunk_size):
+        gpu_shard.add(shard.reconstruct_n(start, min(searcher.add_chunk_size, shard.ntotal - start)))
+    return gpu_shard
+
+
+def load_index(path: str, use_gpu: Optional[bool] = None, use_float16: bool = True, mmap: bool = True):
+    """
+    Restore a searcher written by `FaissFlatSearcher.save`.
+    Returns the searcher and the docid lookup table. CPU shards are memory mapped where
+    possible; with `use_gpu` (or GPUs visible when it is None) the shards are copied to the GPUs.
+    """
+    with open(os.path.join(path, 'meta.json')) as f:
+        meta = json.load(f)
+    searcher_cls = {'FaissFlatSearcher': FaissFlatSearcher, 'FaissSearcher': FaissSearcher}[meta['searcher']]
+
+    num_gpus = get_num_gpus()
+    # an empty index of the same factory string tells whether the shards have a GPU version
+    cpu_only = meta['factory_str'] is not None and is_cpu_only_index(
+        faiss.index_factory(meta['dim'], meta['factory_str'], faiss.METRIC_INNER_PRODUCT))
+    use_gpu = resolve_use_gpu(use_gpu, cpu_only, meta['factory_str'])
+
+    searcher = searcher_cls.__new__(searcher_cls)
+    searcher.dim = meta['dim']
+    searcher.num_shards = meta['num_shards']
+    searcher.use_gpu = use_gpu
+    searcher.cpu_only = cpu_only
+    searcher.storage = meta.get('storage', 'float32')
+    if meta['factory_str'] is not None:
+        searcher.factory_str = meta['factory_str']
+
+    shards, shard_ids = [], []
+    for i in range(searcher.num_shards):
+        shard = read_index(os.path.join(path, f'shard_{i}.faiss'), mmap=mmap and not use_gpu)
+        shard_ids.append(np.load(os.path.join(path, f'shard_{i}_ids.npy')))
+        shards.append(shard)
+    scales = None
+    if searcher.storage == 'int8':
+        scales_path = os.path.join(path, 'scales.npy')
+        if os.path.exists(scales_path):
+            scales = np.load(scales_path)
+        else:
+            # indexes saved without their scales: QT_8bit keeps 255 * scale as the range of every dimension
+            scales = faiss.vector_to_array(faiss.downcast_index(shards[0]).sq.trained)[searcher.dim:] / 255
+    searcher.quantizer = EmbeddingQuantizer(searcher.storage, scales)
+    if use_gpu:
+        searcher.res = [faiss.StandardGpuResources() for _ in range(num_gpus)]
+        options = faiss.GpuClonerOptions()
+        options.useFloat16 = use_float16
+        if searcher.storage != 'float32':
+            # GPUs have no flat scalar quantizer index, decode the vectors into flat GPU shards
+            shards = [decode_to_gpu_flat(searcher, shard, i % num_gpus, use_float16) for i, shard in enumerate(shards)]
+            searcher.storage = 'float32'
+        else:
+            shards = [faiss.index_cpu_to_gpu(searcher.res[i % num_gpus], i % num_gpus, shard, options)
+                      for i, shard in enumerate(shards)]
+
+    searcher.shards = shards
+    searcher.max_vectors_per_shard = [None] * searcher.num_shards
+    searcher.vectors_per_shard = [len(ids) for ids in shard_ids]
+    searcher.shard_ids = [[ids] for ids in shard_ids]
+    searcher._shard_id_arrays = shard_ids
+    searcher.ntotal = meta['ntotal']
+    searcher._pool = ThreadPoolExecutor(max_workers=searcher.num_shards) if searcher.num_shards > 1 else None
+
+    lookup = np.load(os.path.join(path, 'lookup.npy'))
+    assert len(lookup) == searcher.ntotal, f"Lookup has {len(lookup)} ids but the index holds {searcher.ntotal} vectors"
+    logger.info(f"Loaded {searcher.num_shards} index shards with {searcher.ntotal} vectors from {path}")
+    return searcher, lookup
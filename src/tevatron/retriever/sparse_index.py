@@ -0,0 +1,427 @@
+import glob
+import json
+import os
+from collections import Counter
+from typing import Dict, Iterable, Iterator, List, Optional, Sequence, Tuple
+
+import numpy as np
+from tqdm import tqdm
+
+import logging
+logger = logging.getLogger(__name__)
+
+SPARSE_INDEX_FORMAT = 'tevatron-sparse-index'
+SPARSE_INDEX_VERSION = 1
+META_FILE = 'meta.json'
+
+
+def varint_encode(values: np.ndarray) -> np.ndarray:
+    """LEB128 varint bytes of non-negative integers below 2**35, 7 bits per byte, high bit set on all but the last."""
+    values = np.asarray(values, dtype=np.uint64)
+    num_bytes = np.ones(len(values), dtype=np.int64)
+    for shift in (7, 14, 21, 28):
+        num_bytes += values >= (1 << shift)
+    starts = np.cumsum(num_bytes) - num_bytes
+    out = np.empty(int(num_bytes.sum()), dtype=np.uint8)
+    for j in range(5):
+        has_byte = num_bytes > j
+        group = (values[has_byte] >> np.uint64(7 * j)) & np.uint64(0x7F)
+        more = (num_bytes[has_byte] > j + 1).astype(np.uint64) << np.uint64(7)
+        out[starts[has_byte] + j] = group | more
+    return out
+
+
+def varint_decode(buf: np.ndarray) -> np.ndarray:
+    """Inverse of varint_encode."""
+    buf = np.asarray(buf, dtype=np.uint8)
+    if len(buf) == 0:
+        return np.zeros(0, dtype=np.int64)
+    ends = (buf & 0x80) == 0
+    value_idx = np.cumsum(ends) - ends
+    value_starts = np.flatnonzero(np.concatenate([[True], ends[:-1]]))
+    shift = 7 * (np.arange(len(buf)) - value_starts[value_idx])
+    groups = (buf & 0x7F).astype(np.int64) << shift
+    # the 7-bit groups of a value do not overlap, so summing them assembles it
+    return np.bincount(value_idx, weights=groups, minlength=int(ends.sum())).astype(np.int64)
+
+
+def read_json_vectors(pattern: str) -> Iterator[Tuple[str, Dict[str, float]]]:
+    """(id, {term: weight}) from JsonVectorCollection files, e.g. written by examples/splade/encode_splade.py."""
+    for path in sorted(glob.glob(pattern)):
+        with open(path) as f:
+            for line in f:
+                doc = json.loads(line)
+                yield str(doc['id']), doc['vector']
+
+
+def read_tsv_queries(path: str) -> Iterator[Tuple[str, Dict[str, float]]]:
+    """(qid, {term: weight}) from `qid<TAB>term term ...` lines, where a term repeated n times has weight n."""
+    with open(path) as f:
+        for line in f:
+            qid, _, text = line.rstrip('\n').partition('\t')
+            yield qid, dict(Counter(text.split()))
+
+
+SPARSE_SHARD_FORMAT = 'tevatron-sparse-shard'
+
+
+class SparseShardWriter:
+    """
+    Append batches of sparse reps to a CSR shard directory: the column indices (int32)
+    and weights (float16 by default) of all rows go to flat binary files as they come,
+    and the row offsets, ids and vocabulary are written by `close`. Against one JSON
+    dict per text this stores 6 bytes per non-zero and needs no per-row Python.
+    """
+
+    def __init__(self, path: str, vocab: Sequence[str], value_dtype=np.float16):
+        os.makedirs(path, exist_ok=True)
+        self.path = path
+        self.vocab = list(vocab)
+        self.value_dtype = np.dtype(value_dtype)
+        self._indices = open(os.path.join(path, 'indices.bin'), 'wb')
+        self._values = open(os.path.join(path, 'values.bin'), 'wb')
+        self._row_nnz, self._ids = [], []
+
+    def write(self, ids: Sequence[str], reps):
+        """Write a batch given as a torch sparse CSR tensor or an (indptr, indices, values) triple."""
+        if isinstance(reps, tuple):
+            indptr, indices, values = (np.asarray(x) for x in reps)
+        else:
+            indptr, indices, values = (x.cpu().numpy() for x in
+                                       (reps.crow_indices(), reps.col_indices(), reps.values().float()))
+        assert len(indptr) == len(ids) + 1, f"{len(ids)} ids for {len(indptr) - 1} rows"
+        self._indices.write(np.ascontiguousarray(indices[indptr[0]:indptr[-1]], dtype=np.int32).tobytes())
+        self._values.write(np.ascontiguousarray(values[indptr[0]:indptr[-1]], dtype=self.value_dtype).tobytes())
+        self._row_nnz.append(np.diff(indptr))
+        self._ids.extend(str(x) for x in ids)
+
+    def close(self):
+        self._indices.close()
+        self._values.close()
+        row_nnz = np.concatenate(self._row_nnz) if self._row_nnz else np.zeros(0, dtype=np.int64)
+        np.save(os.path.join(self.path, 'indptr.npy'), np.concatenate([[0], np.cumsum(row_nnz)]).astype(np.int64))
+        np.save(os.path.join(self.path, 'ids.npy'), np.array(self._ids))
+        np.save(os.path.join(self.path, 'terms.npy'), np.array(self.vocab))
+        with open(os.path.join(self.path, META_FILE), 'w') as f:
+            json.dump({'format': SPARSE_SHARD_FORMAT, 'num_rows': len(self._ids), 'nnz': int(row_nnz.sum()),
+                       'value_dtype': self.value_dtype.name}, f)
+        logger.info(f"Wrote {len(self._ids)} sparse reps with {int(row_nnz.sum())} non-zeros to {self.path}")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def is_sparse_shard(path: str) -> bool:
+    meta_path = os.path.join(path, META_FILE)
+    if not os.path.isfile(meta_path):
+        return False
+    with open(meta_path) as f:
+        return json.load(f).get('format') == SPARSE_SHARD_FORMAT
+
+
+def read_sparse_shard(path: str):
+    """(ids, indptr, indices, values, terms) of a shard written by SparseShardWriter; indices and values are memory-mapped."""
+    with open(os.path.join(path, META_FILE)) as f:
+        meta = json.load(f)
+    indptr = np.load(os.path.join(path, 'indptr.npy'))
+    ids = np.load(os.path.join(path, 'ids.npy'))
+    terms = np.load(os.path.join(path, 'terms.npy'))
+    if meta['nnz'] == 0:
+        return ids, indptr, np.zeros(0, dtype=np.int32), np.zeros(0, dtype=meta['value_dtype']), terms
+    indices = np.memmap(os.path.join(path, 'indices.bin'), dtype=np.int32, mode='r', shape=(meta['nnz'],))
+    values = np.memmap(os.path.join(path, 'values.bin'), dtype=meta['value_dtype'], mode='r', shape=(meta['nnz'],))
+    return ids, indptr, indices, values, terms
+
+
+def iter_sparse_shard(path: str) -> Iterator[Tuple[str, Dict[str, float]]]:
+    ids, indptr, indices, values, terms = read_sparse_shard(path)
+    for i, text_id in enumerate(ids.tolist()):
+        row = slice(indptr[i], indptr[i + 1])
+        yield text_id, dict(zip(terms[indices[row]].tolist(), values[row].astype(np.float32).tolist()))
+
+
+class SparseIndexBuilder:
+    """
+    Collect sparse term-weight vectors and write them as a doc-ordered inverted index
+    (see SparseIndex). Postings are kept as compact (term, doc, weight) arrays
+    and bucketed by term with a counting sort when the index is written, so building needs
+    about 17 bytes per posting and no global sort.
+    """
+
+    def __init__(self, block_size: int = 128):
+        self.block_size = block_size
+        self.vocab: Dict[str, int] = {}
+        self.doc_ids: List[str] = []
+        self._terms, self._docs, self._weights = [], [], []
+
+    def add(self, doc_id: str, vector: Dict[str, float]):
+        self.add_batch([doc_id], [vector])
+
+    def add_batch(self, doc_ids: Sequence[str], vectors: Sequence[Dict[str, float]]):
+        terms, docs, weights = [], [], []
+        for doc_id, vector in zip(doc_ids, vectors):
+            doc = len(self.doc_ids)
+            self.doc_ids.append(str(doc_id))
+            for term, weight in vector.items():
+                if weight > 0:
+                    terms.append(self.vocab.setdefault(term, len(self.vocab)))
+                    docs.append(doc)
+                    weights.append(weight)
+        self._append(np.asarray(terms, dtype=np.uint32), np.asarray(docs, dtype=np.uint32),
+                     np.asarray(weights, dtype=np.float32))
+
+    def add_csr(self, doc_ids: Sequence[str], indptr: np.ndarray, indices: np.ndarray, data: np.ndarray,
+                vocab: Sequence[str]):
+        """Add rows of a CSR matrix whose column j is the term vocab[j]."""
+        indptr = np.asarray(indptr)
+        indices = np.asarray(indices[indptr[0]:indptr[-1]])
+        data = np.asarray(data[indptr[0]:indptr[-1]], dtype=np.float32)
+        keep = data > 0
+        rows = np.repeat(np.arange(len(doc_ids), dtype=np.uint32), np.diff(indptr))[keep] + len(self.doc_ids)
+        columns, inverse = np.unique(indices[keep], return_inverse=True)
+        column_terms = np.array([self.vocab.setdefault(vocab[c], len(self.vocab)) for c in columns.tolist()],
+                                dtype=np.uint32)
+        self.doc_ids.extend(str(x) for x in doc_ids)
+        self._append(column_terms[inverse.reshape(-1)], rows.astype(np.uint32), data[keep])
+
+    def add_sparse_shard(self, path: str, batch_size: int = 100000):
+        """Add the rows of a shard written by SparseShardWriter, batch_size rows at a time."""
+        ids, indptr, indices, values, terms = read_sparse_shard(path)
+        terms = terms.tolist()
+        for start in range(0, len(ids), batch_size):
+            end = min(start + batch_size, len(ids))
+            self.add_csr(ids[start:end].tolist(), indptr[start:end + 1], indices, values, terms)
+
+    def _append(self, terms, docs, weights):
+        if len(terms) > 0:
+            self._terms.append(terms)
+            self._docs.append(docs)
+            self._weights.append(weights)
+
+    def build(self, path: str, impact_scale: Optional[float] = None) -> 'SparseIndex':
+        """
+        Write the index to the directory `path`. Weights become uint8 impacts
+        round(weight * impact_scale); by default integer weights up to 255 are kept as they
+        are and anything else is scaled so that the largest weight maps to 255.
+        """
+        os.makedirs(path, exist_ok=True)
+        num_terms, num_docs = len(self.vocab), len(self.doc_ids)
+        max_weight = max((float(w.max()) for w in self._weights), default=1.0)
+        if impact_scale is None:
+            integral = all(np.array_equal(w, np.rint(w)) for w in self._weights)
+            impact_scale = 1.0 if integral and max_weight <= 255 else 255 / max_weight
+        logger.info(f"Building sparse index over {num_docs} docs and {num_terms} terms, impact scale {impact_scale:.4g}")
+
+        # counting sort of the postings by term; docs stay in ascending order within a term
+        df = np.zeros(num_terms, dtype=np.int64)
+        for terms in self._terms:
+            df += np.bincount(terms, minlength=num_terms)
+        term_starts = np.concatenate([[0], np.cumsum(df)])
+        docs = np.empty(int(term_starts[-1]), dtype=np.uint32)
+        impacts = np.empty(int(term_starts[-1]), dtype=np.uint8)
+        cursor = term_starts[:-1].copy()
+        for terms, chunk_docs, weights in zip(self._terms, self._docs, self._weights):
+            order = np.argsort(terms, kind='stable')
+            terms = terms[order]
+            counts = np.bincount(terms, minlength=num_terms)
+            run_starts = np.cumsum(counts) - counts
+            positions = cursor[terms] + np.arange(len(terms)) - run_starts[terms]
+            docs[positions] = chunk_docs[order]
+            impacts[positions] = np.clip(np.rint(weights[order] * impact_scale), 1, 255)
+            cursor += counts
+        self._terms, self._docs, self._weights = [], [], []
+
+        # blocks of block_size postings, each with its first and last doc for skipping
+        posting_term = np.repeat(np.arange(num_terms), df)
+        rank = np.arange(len(docs)) - term_starts[posting_term]
+        block_starts = np.flatnonzero(rank % self.block_size == 0)
+        term_blocks = np.concatenate([[0], np.cumsum(-(-df // self.block_size))])
+        block_ends = np.concatenate([block_starts[1:], [len(docs)]])
+
+        # doc gaps within each term, the first posting of a term holds its doc itself
+        gaps = docs.astype(np.int64)
+        gaps[1:] -= docs[:-1]
+        gaps[term_starts[:-1][df > 0]] = docs[term_starts[:-1][df > 0]]
+        encoded = varint_encode(gaps)
+        byte_ends = np.cumsum(1 + (gaps >= 1 << 7) + (gaps >= 1 << 14) + (gaps >= 1 << 21) + (gaps >= 1 << 28))
+        block_byte_offsets = np.concatenate([[0], byte_ends[block_ends - 1]]) if len(docs) else np.zeros(1, np.int64)
+
+        term_max_impact = np.zeros(num_terms, dtype=np.uint8)
+        if len(docs):
+            term_max_impact[df > 0] = np.maximum.reduceat(impacts, term_starts[:-1][df > 0])
+
+        arrays = {
+            'term_blocks': term_blocks.astype(np.int64),
+            'term_max_impact': term_max_impact,
+            'block_postings': np.concatenate([block_starts, [len(docs)]]).astype(np.int64),
+            'block_bytes': block_byte_offsets.astype(np.int64),
+            'block_first_doc': docs[block_starts],
+            'block_last_doc': docs[block_ends - 1] if len(docs) else np.zeros(0, np.uint32),
+            'impacts': impacts,
+            'gaps': encoded,
+            'doc_ids': np.array(self.doc_ids),
+            'terms': np.array(sorted(self.vocab, key=self.vocab.get)),
+        }
+        for name, array in arrays.items():
+            np.save(os.path.join(path, f'{name}.npy'), array)
+        meta = {
+            'format': SPARSE_INDEX_FORMAT,
+            'version': SPARSE_INDEX_VERSION,
+            'num_docs': num_docs,
+            'num_terms': num_terms,
+            'num_postings': int(len(docs)),
+            'block_size': self.block_size,
+            'impact_scale': impact_scale,
+        }
+        with open(os.path.join(path, META_FILE), 'w') as f:
+            json.dump(meta, f)
+        logger.info(f"Wrote {len(docs)} postings in {len(block_starts)} blocks, "
+                    f"{encoded.nbytes + impacts.nbytes} bytes of postings to {path}")
+        return SparseIndex.load(path)
+
+
+class SparseIndex:
+    """
+    Inverted index of learned sparse representations (SPLADE, uniCOIL).
+
+    Every term's postings are sorted by doc and stored in blocks of `block_size`:
+    the doc gaps as varint bytes (`gaps`), the uint8 quantized weights (`impacts`), and
+    per block the first and last doc. Scores are
+    sum(query weight * impact) / impact_scale, which approximates the dot product of the
+    original vectors. Two evaluation strategies give the same exact top-k:
+    - `accumulator`: term at a time into a dense score array over all docs.
+    - `maxscore`: terms in decreasing order of their score upper bound; once the bounds of
+      the remaining terms add up to less than the current k-th score, no new doc can
+      enter the top-k, so the remaining terms only decode the blocks that hold one of
+      the surviving candidates.
+    """
+
+    def __init__(self, path: str, meta: dict, arrays: Dict[str, np.ndarray]):
+        self.path = path
+        self.meta = meta
+        self.num_docs = meta['num_docs']
+        self.impact_scale = meta['impact_scale']
+        for name, array in arrays.items():
+            setattr(self, name, array)
+        self.vocab = {term: i for i, term in enumerate(self.terms.tolist())}
+        self._scores = np.zeros(self.num_docs, dtype=np.float32)
+        self._seen = np.zeros(self.num_docs, dtype=bool)
+
+    @classmethod
+    def load(cls, path: str, mmap: bool = True) -> 'SparseIndex':
+        with open(os.path.join(path, META_FILE)) as f:
+            meta = json.load(f)
+        if meta.get('format') != SPARSE_INDEX_FORMAT or meta.get('version', 0) > SPARSE_INDEX_VERSION:
+            raise ValueError(f"{path} is not a supported sparse index: {meta}")
+        names = ['term_blocks', 'term_max_impact', 'block_postings', 'block_bytes', 'block_first_doc',
+                 'block_last_doc', 'impacts', 'gaps', 'doc_ids', 'terms']
+        large = {'impacts', 'gaps'}
+        arrays = {name: np.load(os.path.join(path, f'{name}.npy'), mmap_mode='r' if mmap and name in large else None)
+                  for name in names}
+        return cls(path, meta, arrays)
+
+    def _decode_blocks(self, blocks: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """Docs and impacts of the given blocks, which must be sorted and belong to one term."""
+        if len(blocks) == 0:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.uint8)
+        contiguous = blocks[-1] - blocks[0] + 1 == len(blocks)
+        if contiguous:
+            gaps = varint_decode(self.gaps[self.block_bytes[blocks[0]]:self.block_bytes[blocks[-1] + 1]])
+            impacts = np.asarray(self.impacts[self.block_postings[blocks[0]]:self.block_postings[blocks[-1] + 1]])
+        else:
+            gaps = varint_decode(np.concatenate([self.gaps[self.block_bytes[b]:self.block_bytes[b + 1]] for b in blocks]))
+            impacts = np.concatenate([self.impacts[self.block_postings[b]:self.block_postings[b + 1]] for b in blocks])
+        sizes = self.block_postings[blocks + 1] - self.block_postings[blocks]
+        starts = np.cumsum(sizes) - sizes
+        # restart the running sum at every block from its stored first doc
+        previous_last = np.concatenate([[0], self.block_last_doc[blocks[:-1]].astype(np.int64)])
+        gaps[starts] = self.block_first_doc[blocks].astype(np.int64) - previous_last
+        return np.cumsum(gaps), impacts
+
+    def postings(self, term: int) -> Tuple[np.ndarray, np.ndarray]:
+        return self._decode_blocks(np.arange(self.term_blocks[term], self.term_blocks[term + 1]))
+
+    def _query_terms(self, query: Dict[str, float]) -> List[Tuple[int, float]]:
+        terms = [(self.vocab[term], float(weight)) for term, weight in query.items()
+                 if weight > 0 and term in self.vocab]
+        # decreasing score upper bound
+        return sorted(terms, key=lambda x: -x[1] * float(self.term_max_impact[x[0]]))
+
+    def search(self, query: Dict[str, float], k: int, method: str = 'maxscore') -> Tuple[np.ndarray, np.ndarray]:
+        """Top-k (scores, doc rows) of one {term: weight} query, sorted by descending score, -1 padded."""
+        terms = self._query_terms(query)
+        scores = self._scores
+        if method == 'accumulator':
+            touched = self._accumulate(terms, scores)
+        elif method == 'maxscore':
+            touched = self._maxscore(terms, scores, k)
+        else:
+            raise ValueError(f"Unknown sparse search method {method}")
+
+        top = touched[np.argsort(-scores[touched], kind='stable')[:k]]
+        final_scores = np.full(k, -np.inf, dtype=np.float32)
+        final_docs = np.full(k, -1, dtype=np.int64)
+        final_scores[:len(top)] = scores[top] / self.impact_scale
+        final_docs[:len(top)] = top
+        scores[touched] = 0
+        return final_scores, final_docs
+
+    def _accumulate(self, terms, scores) -> np.ndarray:
+        touched = []
+        for term, weight in terms:
+            docs, impacts = self.postings(term)
+            # a doc appears once per term, so plain fancy-index addition is safe
+            scores[docs] += weight * impacts
+            touched.append(docs)
+        return np.unique(np.concatenate(touched)) if touched else np.zeros(0, dtype=np.int64)
+
+    def _maxscore(self, terms, scores, k) -> np.ndarray:
+        upper_bounds = np.array([weight * float(self.term_max_impact[term]) for term, weight in terms])
+        remaining_bound = np.cumsum(upper_bounds[::-1])[::-1] - upper_bounds
+        seen_mask = self._seen
+        touched = []
+        candidates = None
+        threshold = 0
+        for i, (term, weight) in enumerate(terms):
+            if candidates is None:
+                docs, impacts = self.postings(term)
+                scores[docs] += weight * impacts
+                touched.append(docs[~seen_mask[docs]])
+                seen_mask[touched[-1]] = True
+                if remaining_bound[i] < threshold or i == len(terms) - 1:
+                    # no unseen doc can reach the top-k any more
+                    seen = np.sort(np.concatenate(touched))
+                    seen_mask[seen] = False
+                    touched = [seen]
+                    if len(seen) >= k:
+                        threshold = np.partition(scores[seen], len(seen) - k)[len(seen) - k]
+                    candidates = seen[scores[seen] + remaining_bound[i] >= threshold]
+                elif sum(map(len, touched)) >= k:
+                    # a lower bound of the final k-th score
+                    seen = np.concatenate(touched)
+                    threshold = np.partition(scores[seen], len(seen) - k)[len(seen) - k]
+                continue
+
+            blocks = np.arange(self.term_blocks[term], self.term_blocks[term + 1])
+            # blocks whose doc range holds a candidate
+            first = np.searchsorted(candidates, self.block_first_doc[blocks], side='left')
+            last = np.searchsorted(candidates, self.block_last_doc[blocks], side='right')
+            docs, impacts = self._decode_blocks(blocks[last > first])
+            seen_mask[candidates] = True
+            keep = seen_mask[docs]
+            seen_mask[candidates] = False
+            scores[docs[keep]] += weight * impacts[keep]
+            if len(candidates) >= k:
+                threshold = max(threshold, np.partition(scores[candidates], len(candidates) - k)[len(candidates) - k])
+            candidates = candidates[scores[candidates] + remaining_bound[i] >= threshold]
+        return touched[0] if touched else np.zeros(0, dtype=np.int64)
+
+    def batch_search(self, queries: Iterable[Dict[str, float]], k: int, method: str = 'maxscore',
+                     quiet: bool = False) -> Tuple[np.ndarray, np.ndarray]:
+        results = [self.search(query, k, method) for query in tqdm(queries, disable=quiet)]
+        if not results:
+            return np.zeros((0, k), dtype=np.float32), np.zeros((0, k), dtype=np.int64)
+        return np.stack([r[0] for r in results]), np.stack([r[1] for r in results])
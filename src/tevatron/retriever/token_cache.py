@@ -0,0 +1,139 @@
+import hashlib
+import json
+import os
+import shutil
+import uuid
+from typing import Callable, Iterable, List, Optional, Tuple
+
+import numpy as np
+from tqdm import tqdm
+
+import logging
+logger = logging.getLogger(__name__)
+
+TOKENS_FILE = 'tokens.bin'
+OFFSETS_FILE = 'offsets.npy'
+IDS_FILE = 'ids.npy'
+META_FILE = 'meta.json'
+
+
+class TokenizedTexts:
+    """
+    Token ids of many texts stored as one flat int32 buffer plus an offsets array, so that
+    the ids of text i are the view tokens[offsets[i]:offsets[i + 1]] (no copy, no re-tokenization).
+    """
+
+    def __init__(self, tokens: np.ndarray, offsets: np.ndarray, ids: np.ndarray):
+        self.tokens = tokens
+        self.offsets = offsets
+        self.ids = ids
+        self._rows = None
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, item: int) -> np.ndarray:
+        return self.tokens[self.offsets[item]:self.offsets[item + 1]]
+
+    def lengths(self) -> np.ndarray:
+        return np.diff(self.offsets)
+
+    def row_of(self, text_id: str) -> int:
+        if self._rows is None:
+            self._rows = {text_id: row for row, text_id in enumerate(self.ids.tolist())}
+        return self._rows[text_id]
+
+    def get_by_id(self, text_id: str) -> np.ndarray:
+        return self[self.row_of(text_id)]
+
+    @classmethod
+    def load(cls, path: str, mmap: bool = True) -> 'TokenizedTexts':
+        tokens = np.memmap(os.path.join(path, TOKENS_FILE), dtype=np.int32, mode='r') \
+            if mmap else np.fromfile(os.path.join(path, TOKENS_FILE), dtype=np.int32)
+        offsets = np.load(os.path.join(path, OFFSETS_FILE))
+        ids = np.load(os.path.join(path, IDS_FILE))
+        assert offsets[-1] == len(tokens), f"Token cache {path} is truncated"
+        return cls(tokens, offsets, ids)
+
+
+def tokenizer_fingerprint(tokenizer) -> str:
+    """Hash of everything that determines how a tokenizer maps text to ids."""
+    h = hashlib.sha1()
+    h.update(type(tokenizer).__name__.encode())
+    backend = getattr(tokenizer, 'backend_tokenizer', None)
+    if backend is not None:
+        h.update(backend.to_str().encode())
+    else:
+        h.update(json.dumps(sorted(tokenizer.get_vocab().items())).encode())
+    h.update(json.dumps(tokenizer.special_tokens_map, sort_keys=True, default=str).encode())
+    return h.hexdigest()
+
+
+def token_cache_key(tokenizer, max_length: int, prefix: str, append_eos_token: bool, *extra) -> str:
+    h = hashlib.sha1()
+    h.update(json.dumps([tokenizer_fingerprint(tokenizer), max_length, prefix, append_eos_token, *extra],
+                        default=str).encode())
+    return h.hexdigest()[:20]
+
+
+def build_tokenized_texts(
+        path: str,
+        texts: Iterable[Tuple[str, str]],
+        tokenize_fn: Callable[[List[str]], List[List[int]]],
+        chunk_size: int = 10000,
+        total: Optional[int] = None,
+):
+    """Tokenize (id, text) pairs chunk by chunk, appending their ids to the flat token file at `path`."""
+    os.makedirs(path, exist_ok=True)
+    offsets = [0]
+    ids = []
+    chunk_ids, chunk_texts = [], []
+
+    with open(os.path.join(path, TOKENS_FILE), 'wb') as f:
+        def _flush():
+            for input_ids in tokenize_fn(chunk_texts):
+                f.write(np.asarray(input_ids, dtype=np.int32).tobytes())
+                offsets.append(offsets[-1] + len(input_ids))
+            ids.extend(chunk_ids)
+            chunk_ids.clear()
+            chunk_texts.clear()
+
+        for text_id, text in tqdm(texts, desc='Tokenizing', total=total):
+            chunk_ids.append(str(text_id))
+            chunk_texts.append(text)
+            if len(chunk_texts) == chunk_size:
+                _flush()
+        if chunk_texts:
+            _flush()
+
+    np.save(os.path.join(path, OFFSETS_FILE), np.asarray(offsets, dtype=np.int64))
+    np.save(os.path.join(path, IDS_FILE), np.array(ids))
+
+
+def load_or_build_tokenized_texts(
+        cache_dir: str,
+        key: str,
+        texts_fn: Callable[[], Iterable[Tuple[str, str]]],
+        tokenize_fn: Callable[[List[str]], List[List[int]]],
+        total: Optional[int] = None,
+) -> TokenizedTexts:
+    """
+    Load the token cache stored under `cache_dir/key`, building it from `texts_fn()` first if needed.
+    The cache is built in a temporary directory and moved into place once complete, so an
+    interrupted build is never picked up.
+    """
+    path = os.path.join(cache_dir, key)
+    if not os.path.exists(os.path.join(path, META_FILE)):
+        logger.info(f"Building token cache {path}")
+        tmp_path = f'{path}.tmp-{uuid.uuid4().hex}'
+        build_tokenized_texts(tmp_path, texts_fn(), tokenize_fn, total=total)
+        with open(os.path.join(tmp_path, META_FILE), 'w') as f:
+            json.dump({'key': key}, f)
+        try:
+            os.rename(tmp_path, path)
+        except OSError:
+            # another process finished the same cache first
+            shutil.rmtree(tmp_path, ignore_errors=True)
+    else:
+        logger.info(f"Loading token cache {path}")
+    return TokenizedTexts.load(path)
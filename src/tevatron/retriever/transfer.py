@@ -0,0 +1,153 @@
+from typing import Callable, Dict, Iterable, Iterator, Optional, Sequence, Tuple
+
+import numpy as np
+import torch
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+def to_device(batch: Dict[str, torch.Tensor], device, non_blocking: bool = False) -> Dict[str, torch.Tensor]:
+    return {k: v.to(device, non_blocking=non_blocking) for k, v in batch.items()}
+
+
+class DevicePrefetcher:
+    """
+    Iterate over (ids, batch) pairs from a data loader with the batch already on `device`.
+
+    On CUDA the copy of the next batch is issued on a side stream with non-blocking
+    transfers (from pinned memory when the loader pins its batches) while the current
+    batch is being computed, so the model never waits on a host-to-device copy.
+    Elsewhere batches are simply moved to the device.
+    """
+
+    def __init__(self, loader: Iterable, device):
+        self.loader = loader
+        self.device = torch.device(device)
+
+    def __len__(self):
+        return len(self.loader)
+
+    def __iter__(self) -> Iterator[Tuple[Sequence, Dict[str, torch.Tensor]]]:
+        if self.device.type != 'cuda':
+            for ids, batch in self.loader:
+                yield ids, to_device(batch, self.device)
+            return
+
+        stream = torch.cuda.Stream(self.device)
+        batches = iter(self.loader)
+
+        def _load():
+            try:
+                ids, batch = next(batches)
+            except StopIteration:
+                return None
+            with torch.cuda.stream(stream):
+                return ids, to_device(batch, self.device, non_blocking=True)
+
+        next_batch = _load()
+        while next_batch is not None:
+            current_stream = torch.cuda.current_stream(self.device)
+            current_stream.wait_stream(stream)
+            ids, batch = next_batch
+            for v in batch.values():
+                # the tensors were allocated on the side stream but are used on the current one
+                v.record_stream(current_stream)
+            next_batch = _load()
+            yield ids, batch
+
+
+class DeviceOutputBuffer:
+    """
+    Collect embeddings computed on the device into a preallocated (num_rows, dim) host array.
+
+    Embeddings stay on the device until `chunk_size` rows are pending; the chunk is then
+    copied back into a pinned staging buffer without blocking, and only written into the
+    output array (and waited on) when the next chunk is flushed, so the copy overlaps with
+    the following batches. `rows` gives the output row of every appended embedding in
+    order (e.g. the order of a length grouped sampler); by default rows are filled in order.
+    The output is created by `allocate(shape, dtype)` once the first chunk arrives, an
+    in-memory array by default or e.g. a memory map on disk. `on_drain(start, end)` is
+    called once the embeddings appended in positions [start, end) are in the output, and
+    `convert` (e.g. a quantizer's encode) maps each chunk to the stored form first.
+    bfloat16 embeddings are stored as float32, since numpy has no bfloat16.
+    """
+
+    def __init__(self, num_rows: int, device, chunk_size: int = 8192, rows: Optional[np.ndarray] = None,
+                 allocate: Callable[[Tuple[int, int], np.dtype], np.ndarray] = np.empty,
+                 on_drain: Optional[Callable[[int, int], None]] = None,
+                 convert: Optional[Callable[[np.ndarray], np.ndarray]] = None):
+        self.num_rows = num_rows
+        self.device = torch.device(device)
+        self.chunk_size = chunk_size
+        self.rows = rows
+        self.allocate = allocate
+        self.on_drain = on_drain
+        self.convert = convert
+        self.output = None
+        self.offset = 0
+        self._pending = []
+        self._pending_rows = 0
+        self._in_flight = None
+
+    def append(self, reps: torch.Tensor):
+        self._pending.append(reps.detach())
+        self._pending_rows += reps.shape[0]
+        if self._pending_rows >= self.chunk_size:
+            self._flush()
+
+    def _flush(self):
+        if not self._pending:
+            return
+        chunk = torch.cat(self._pending) if len(self._pending) > 1 else self._pending[0]
+        if chunk.dtype == torch.bfloat16:
+            chunk = chunk.float()
+        self._pending = []
+        self._pending_rows = 0
+        self._drain()
+
+        if self.device.type == 'cuda':
+            host = torch.empty(chunk.shape, dtype=chunk.dtype, pin_memory=True)
+            host.copy_(chunk, non_blocking=True)
+            event = torch.cuda.Event()
+            event.record(torch.cuda.current_stream(self.device))
+        else:
+            host, event = chunk, None
+        self._in_flight = (host, event, self.offset)
+        self.offset += chunk.shape[0]
+
+    def _drain(self):
+        if self._in_flight is None:
+            return
+        host, event, start = self._in_flight
+        self._in_flight = None
+        if event is not None:
+            event.synchronize()
+        chunk = host.numpy()
+        if self.convert is not None:
+            chunk = self.convert(chunk)
+        self.allocate_output(chunk.shape[1], chunk.dtype)
+        end = start + chunk.shape[0]
+        assert end <= self.num_expected, f"Got more than the {self.num_expected} expected embeddings"
+        if self.rows is None:
+            self.output[start:end] = chunk
+        else:
+            self.output[self.rows[start:end]] = chunk
+        if self.on_drain is not None:
+            self.on_drain(start, end)
+
+    @property
+    def num_expected(self) -> int:
+        return len(self.rows) if self.rows is not None else self.num_rows
+
+    def allocate_output(self, dim: int, dtype) -> np.ndarray:
+        if self.output is None:
+            self.output = self.allocate((self.num_rows, dim), dtype)
+        return self.output
+
+    def finalize(self) -> np.ndarray:
+        """Copy back whatever is still pending and return the filled output array."""
+        self._flush()
+        self._drain()
+        assert self.offset == self.num_expected, f"Expected {self.num_expected} embeddings, got {self.offset}"
+        return self.output
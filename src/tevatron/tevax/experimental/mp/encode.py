@@ -140,7 +140,7 @@ def main():
         return reps
     
     
-    all_representations = []
+    all_representations = None
     
     assert args.input_type in ["passage", "question", "query"]
     
@@ -176,12 +176,15 @@ def main():
 
             encodings = encode(model_params, dict(batch))
 
-            representations = jax.device_put(encodings, jax.devices("cpu")[0])
-            all_representations.append(representations[:len(batch_ids)])
+            representations = np.asarray(jax.device_put(encodings, jax.devices("cpu")[0]))
+            if all_representations is None:
+                # filled in place, so only one copy of the corpus embeddings is ever held
+                all_representations = np.empty((len(dataset), representations.shape[-1]),
+                                               dtype=representations.dtype)
+            all_representations[idx:idx + len(batch_ids)] = representations[:len(batch_ids)]
             all_ids.extend(batch_ids)
             
         
-    all_representations = jnp.concatenate(all_representations, axis=0)
     logger.info(f"Shape of all representations: {all_representations.shape}")
     logger.info(f"Saving representations to {args.output_dir}")
     os.makedirs(args.output_dir, exist_ok=True)
@@ -192,7 +195,7 @@ def main():
         output_path = os.path.join(args.output_dir, f"emb_{args.shard_id}.pkl")
     
     with open(output_path, "wb") as f:
-        pickle.dump((all_representations, all_ids), f)
+        pickle.dump((all_representations, all_ids), f, protocol=5)
     
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -0,0 +1,53 @@
+import logging
+import os
+from typing import Callable, List
+
+import torch
+import torch.multiprocessing as mp
+
+logger = logging.getLogger(__name__)
+
+
+def worker_output_path(output_path: str, worker_index: int) -> str:
+    """The output path of one worker, e.g. `corpus.pkl` -> `corpus.3.pkl`."""
+    root, ext = os.path.splitext(output_path)
+    return f'{root}.{worker_index}{ext}'
+
+
+def worker_device(worker_index: int, num_workers: int, use_cpu: bool = False) -> torch.device:
+    """The device of a worker: GPUs round robin, or an equal share of the CPU cores."""
+    if torch.cuda.is_available() and not use_cpu:
+        device = torch.device('cuda', worker_index % torch.cuda.device_count())
+        torch.cuda.set_device(device)
+    else:
+        device = torch.device('cpu')
+        torch.set_num_threads(max(1, (os.cpu_count() or 1) // num_workers))
+    return device
+
+
+def _run_worker(worker_index, fn, num_workers, use_cpu, results, args):
+    logging.basicConfig(
+        format=f"%(asctime)s - %(levelname)s - %(name)s - worker {worker_index} -   %(message)s",
+        datefmt="%m/%d/%Y %H:%M:%S",
+        level=logging.INFO,
+    )
+    device = worker_device(worker_index, num_workers, use_cpu)
+    results.put((worker_index, fn(worker_index, device, *args)))
+
+
+def run_workers(fn: Callable, num_workers: int, use_cpu: bool, *args) -> List:
+    """
+    Run `fn(worker_index, device, *args)` in `num_workers` spawned processes, one per GPU (wrapping
+    around if there are more workers than GPUs) or on CPU, and return their results in worker order.
+    `fn` and `args` must be picklable, i.e. `fn` is a module level function.
+    """
+    context = mp.get_context('spawn')
+    results = context.SimpleQueue()
+    mp.start_processes(
+        _run_worker,
+        args=(fn, num_workers, use_cpu, results, args),
+        nprocs=num_workers,
+        join=True,
+        start_method='spawn',
+    )
+    return [result for _, result in sorted((results.get() for _ in range(num_workers)), key=lambda x: x[0])]
@@ -0,0 +1,14 @@
+from tevatron.retriever.embedding_io import encode_checkpoint_dir, resolve_shard_paths
+
+
+def test_resolve_shard_paths_is_sorted_and_skips_checkpoints(tmp_path):
+    for name in ['corpus.2', 'corpus.0', 'corpus.1']:
+        (tmp_path / name).mkdir()
+    (tmp_path / 'corpus.manifest.json').write_text('{}')
+    # a checkpoint left behind by an interrupted encoding run
+    (tmp_path / 'corpus.3').mkdir()
+    (tmp_path / 'corpus.3.parts').mkdir()
+    assert encode_checkpoint_dir(str(tmp_path / 'corpus.3')) == str(tmp_path / 'corpus.3.parts')
+
+    paths = resolve_shard_paths(str(tmp_path / 'corpus.*'))
+    assert paths == [str(tmp_path / f'corpus.{i}') for i in range(4)]
@@ -0,0 +1,108 @@
+import json
+import random
+import sys
+
+import numpy as np
+import pytest
+import torch
+from transformers import BertConfig, BertForMaskedLM, BertTokenizerFast
+
+from tevatron.retriever.driver import encode as encode_driver
+from tevatron.retriever.driver.sparse_search import build_index
+from tevatron.retriever.modeling import SpladeModel
+from tevatron.retriever.sparse_index import iter_sparse_shard
+
+WORDS = [f"w{i}" for i in range(100)]
+
+
+@pytest.fixture(scope='module')
+def splade_dir(tmp_path_factory):
+    root = tmp_path_factory.mktemp('splade')
+    vocab_file = root / 'vocab.txt'
+    vocab_file.write_text("\n".join(["[PAD]", "[UNK]", "[CLS]", "[SEP]", "[MASK]"] + WORDS))
+    model_dir = root / 'model'
+    BertTokenizerFast(str(vocab_file)).save_pretrained(model_dir)
+    torch.manual_seed(0)
+    config = BertConfig(vocab_size=len(WORDS) + 5, hidden_size=32, num_hidden_layers=2, num_attention_heads=2,
+                        intermediate_size=64)
+    BertForMaskedLM(config).save_pretrained(model_dir)
+
+    rng = random.Random(0)
+    with open(root / 'corpus.jsonl', 'w') as f:
+        for i in range(60):
+            text = " ".join(rng.choice(WORDS) for _ in range(rng.randint(1, 30)))
+            f.write(json.dumps({"docid": f"d{i}", "title": "", "text": text}) + "\n")
+    with open(root / 'queries.jsonl', 'w') as f:
+        for i in range(7):
+            query = " ".join(rng.choice(WORDS) for _ in range(rng.randint(1, 5)))
+            f.write(json.dumps({"query_id": f"q{i}", "query": query}) + "\n")
+    return root
+
+
+def run_encode(monkeypatch, root, data_file, output_path, *extra_args):
+    monkeypatch.setattr(sys, 'argv', [
+        'encode', '--output_dir', str(root / 'out'), '--model_name_or_path', str(root / 'model'),
+        '--dataset_path', str(root / data_file), '--dataset_cache_dir', str(root / 'cache'),
+        '--per_device_eval_batch_size', '8', '--passage_max_len', '32', '--use_cpu',
+        '--encode_output_format', 'sparse', '--encode_output_path', str(output_path), *extra_args,
+    ])
+    encode_driver.main()
+
+
+def dense_reps(root, data_file, is_query):
+    """SPLADE reps of every text of a jsonl file, computed without the encode driver."""
+    tokenizer = BertTokenizerFast.from_pretrained(root / 'model')
+    model = SpladeModel.load(str(root / 'model')).eval()
+    reps = {}
+    with open(root / data_file) as f:
+        rows = [json.loads(line) for line in f]
+    for row in rows:
+        text = row['query'] if is_query else row['title'] + ' ' + row['text']
+        batch = tokenizer([text.strip()], max_length=32, truncation=True, return_tensors='pt')
+        with torch.no_grad():
+            reps[row['query_id' if is_query else 'docid']] = model(query=dict(batch)).q_reps[0].numpy()
+    return reps
+
+
+def to_dense(vector, tokenizer):
+    rep = np.zeros(len(tokenizer), dtype=np.float32)
+    for term, weight in vector.items():
+        rep[tokenizer.convert_tokens_to_ids(term)] = weight
+    return rep
+
+
+def test_sparse_encode_matches_dense_top_k(monkeypatch, splade_dir):
+    output_path = splade_dir / 'corpus_topk'
+    run_encode(monkeypatch, splade_dir, 'corpus.jsonl', output_path,
+               '--encode_sparse_top_k', '5', '--encode_group_by_length')
+
+    tokenizer = BertTokenizerFast.from_pretrained(splade_dir / 'model')
+    expected = dense_reps(splade_dir, 'corpus.jsonl', is_query=False)
+    encoded = dict(iter_sparse_shard(str(output_path)))
+    assert sorted(encoded) == sorted(expected)
+    for doc_id, vector in encoded.items():
+        rep = expected[doc_id]
+        top = np.argsort(-rep)[:5]
+        top = top[rep[top] > 0]
+        assert sorted(tokenizer.convert_tokens_to_ids(list(vector))) == sorted(top.tolist())
+        np.testing.assert_allclose(to_dense(vector, tokenizer)[top], rep[top], rtol=1e-3)
+
+
+def test_sparse_encode_and_search(monkeypatch, splade_dir):
+    run_encode(monkeypatch, splade_dir, 'corpus.jsonl', splade_dir / 'corpus_csr')
+    run_encode(monkeypatch, splade_dir, 'queries.jsonl', splade_dir / 'query_csr', '--encode_is_query')
+
+    tokenizer = BertTokenizerFast.from_pretrained(splade_dir / 'model')
+    index = build_index(str(splade_dir / 'corpus_csr'), str(splade_dir / 'index'), block_size=16)
+    docs = dict(iter_sparse_shard(str(splade_dir / 'corpus_csr')))
+    doc_ids = list(docs)
+    doc_matrix = np.stack([to_dense(docs[doc_id], tokenizer) for doc_id in doc_ids])
+
+    queries = list(iter_sparse_shard(str(splade_dir / 'query_csr')))
+    assert [qid for qid, _ in queries] == [f"q{i}" for i in range(7)]
+    for _, vector in queries:
+        scores, rows = index.search(vector, 10)
+        exact = doc_matrix @ to_dense(vector, tokenizer)
+        # the index quantizes impacts, so compare the retrieved docs' exact scores with the exact top 10
+        retrieved = np.sort(exact[[doc_ids.index(doc_id) for doc_id in index.doc_ids[rows]]])[::-1]
+        np.testing.assert_allclose(retrieved, np.sort(exact)[::-1][:10], rtol=0.05)
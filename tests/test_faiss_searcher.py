@@ -0,0 +1,67 @@
+import os
+
+import numpy as np
+import pytest
+
+from tevatron.retriever import searcher as searcher_module
+from tevatron.retriever.searcher import FaissFlatSearcher, FaissSearcher, load_index
+
+
+def _reps(num, dim=16, seed=0):
+    return np.random.default_rng(seed).standard_normal((num, dim)).astype(np.float32)
+
+
+@pytest.mark.parametrize('factory_str', ['HNSW8', 'PCA8,HNSW8'])
+def test_graph_index_stays_on_cpu_when_a_gpu_is_visible(monkeypatch, tmp_path, factory_str):
+    monkeypatch.setattr(searcher_module, 'get_num_gpus', lambda: 1)
+    p_reps = _reps(200)
+    retriever = FaissSearcher(p_reps, factory_str)
+    assert not retriever.use_gpu
+    retriever.add(p_reps)
+    retriever.save(str(tmp_path), [f'd{i}' for i in range(200)])
+
+    loaded, _ = load_index(str(tmp_path))
+    assert not loaded.use_gpu
+    with pytest.raises(ValueError, match='no GPU implementation'):
+        load_index(str(tmp_path), use_gpu=True)
+
+
+def test_graph_index_refuses_explicit_gpu(monkeypatch):
+    monkeypatch.setattr(searcher_module, 'get_num_gpus', lambda: 1)
+    with pytest.raises(ValueError, match='no GPU implementation'):
+        FaissSearcher(_reps(200), 'HNSW8', use_gpu=True)
+
+
+@pytest.mark.parametrize('saved_scales', [True, False])
+def test_int8_index_keeps_its_scales_when_loaded(tmp_path, saved_scales):
+    p_reps = _reps(300)
+    retriever = FaissFlatSearcher(p_reps[:200], num_shards=2, use_gpu=False, storage='int8')
+    retriever.add(p_reps[:200])
+    retriever.save(str(tmp_path), [f'd{i}' for i in range(200)])
+    if not saved_scales:
+        os.remove(tmp_path / 'scales.npy')
+
+    loaded, _ = load_index(str(tmp_path), use_gpu=False)
+    np.testing.assert_allclose(loaded.quantizer.scales, retriever.quantizer.scales, rtol=1e-6)
+    # memory mapped shards are read only, a writable copy can be extended
+    loaded, _ = load_index(str(tmp_path), use_gpu=False, mmap=False)
+    # vectors added after loading are encoded like those added before saving
+    retriever.add(p_reps[200:])
+    loaded.add(p_reps[200:])
+    q_reps = _reps(5, seed=1)
+    expected_scores, expected_indices = retriever.search(q_reps, 20)
+    scores, indices = loaded.search(q_reps, 20)
+    np.testing.assert_array_equal(indices, expected_indices)
+    np.testing.assert_allclose(scores, expected_scores, rtol=1e-5)
+
+
+def test_sharded_search_limits_only_its_own_threads(monkeypatch):
+    monkeypatch.setattr(os, 'cpu_count', lambda: 8)
+    main_threads = searcher_module.faiss.omp_get_max_threads()
+    p_reps = _reps(100)
+    retriever = FaissFlatSearcher(p_reps, num_shards=2, use_gpu=False)
+    retriever.add(p_reps)
+    retriever.search(_reps(3, seed=1), 5)
+
+    assert searcher_module.faiss.omp_get_max_threads() == main_threads
+    assert retriever._map(lambda _: searcher_module.faiss.omp_get_max_threads(), range(2)) == [4, 4]
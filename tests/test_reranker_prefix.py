@@ -0,0 +1,47 @@
+import torch
+from transformers import LlamaConfig, LlamaForSequenceClassification
+
+from tevatron.reranker.modeling import RerankerModel
+
+PAD = 0
+
+
+def tiny_reranker():
+    torch.manual_seed(0)
+    config = LlamaConfig(vocab_size=50, hidden_size=32, num_hidden_layers=2, num_attention_heads=4,
+                         num_key_value_heads=2, intermediate_size=64, num_labels=1, pad_token_id=PAD,
+                         attn_implementation='eager')
+    hf_model = LlamaForSequenceClassification(config)
+    torch.nn.init.normal_(hf_model.score.weight)
+    return RerankerModel(hf_model).eval()
+
+
+def pad(sequences):
+    """Right padded input ids and attention mask of token id lists."""
+    width = max(len(x) for x in sequences)
+    input_ids = torch.full((len(sequences), width), PAD, dtype=torch.long)
+    attention_mask = torch.zeros((len(sequences), width), dtype=torch.long)
+    for i, x in enumerate(sequences):
+        input_ids[i, :len(x)] = torch.tensor(x)
+        attention_mask[i, :len(x)] = 1
+    return {'input_ids': input_ids, 'attention_mask': attention_mask}
+
+
+def test_score_with_prefix_matches_full_pairs():
+    model = tiny_reranker()
+    generator = torch.Generator().manual_seed(1)
+
+    def tokens(n):
+        return torch.randint(1, 50, (n,), generator=generator).tolist()
+
+    query_a, query_b = tokens(7), tokens(5)
+    # consecutive batches of one query with changing batch sizes, then a prefix that shares
+    # only part of the last one, then an unrelated prefix and back
+    prefixes = [query_a, query_a, query_a, query_a[:4] + query_b, query_b, query_a]
+    batch_sizes = [3, 3, 1, 4, 2, 3]
+    for prefix, batch_size in zip(prefixes, batch_sizes):
+        suffixes = [tokens(int(n)) for n in torch.randint(1, 6, (batch_size,), generator=generator)]
+        with torch.no_grad():
+            scores = model.score_with_prefix(torch.tensor(prefix), pad(suffixes))
+            expected = model(pad([prefix + suffix for suffix in suffixes])).scores
+        torch.testing.assert_close(scores, expected, rtol=1e-4, atol=1e-5)
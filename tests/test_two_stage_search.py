@@ -0,0 +1,60 @@
+import numpy as np
+
+from tevatron.retriever.searcher import ExactRescorer, FaissSearcher, TwoStageSearcher
+
+
+def _reps(num, dim=16, seed=0):
+    reps = np.random.default_rng(seed).standard_normal((num, dim)).astype(np.float32)
+    return reps / np.linalg.norm(reps, axis=1, keepdims=True)
+
+
+def test_rescore_matches_exact_scores():
+    p_reps, q_reps = _reps(300), _reps(8, seed=1)
+    rescorer = ExactRescorer([p_reps[:100], p_reps[100:]])
+    candidates = np.stack([np.random.default_rng(i).choice(300, 40, replace=False) for i in range(8)])
+
+    scores, indices = rescorer.rescore(q_reps, candidates, 10)
+
+    for q_rep, cands, q_scores, q_indices in zip(q_reps, candidates, scores, indices):
+        exact = p_reps[cands] @ q_rep
+        order = np.argsort(-exact)[:10]
+        np.testing.assert_array_equal(q_indices, cands[order])
+        np.testing.assert_allclose(q_scores, exact[order], rtol=1e-5)
+
+
+def test_rescore_pads_queries_with_fewer_candidates_than_k():
+    p_reps, q_reps = _reps(50), _reps(3, seed=1)
+    rescorer = ExactRescorer([p_reps])
+    candidates = np.full((3, 8), -1, dtype=np.int64)
+    candidates[0, :5] = [7, 3, 42, 11, 0]
+    candidates[1, :2] = [49, 1]
+
+    scores, indices = rescorer.rescore(q_reps, candidates, 6)
+
+    assert scores.shape == indices.shape == (3, 6)
+    for i, num_found in enumerate([5, 2, 0]):
+        assert sorted(indices[i, :num_found]) == sorted(candidates[i, :num_found])
+        np.testing.assert_allclose(scores[i, :num_found], p_reps[indices[i, :num_found]] @ q_reps[i], rtol=1e-5)
+        assert (indices[i, num_found:] == -1).all()
+        assert np.isneginf(scores[i, num_found:]).all()
+
+
+def test_two_stage_search_with_short_first_stage_lists():
+    p_reps, q_reps = _reps(400), _reps(5, seed=1)
+    first_stage = FaissSearcher(p_reps, 'IVF32,Flat', use_gpu=False)
+    first_stage.add(p_reps)
+    # a single probed list holds fewer vectors than the requested candidates
+    first_stage.set_search_params(nprobe=1)
+    searcher = TwoStageSearcher(first_stage, ExactRescorer([p_reps]), candidate_multiplier=4)
+
+    scores, indices = searcher.batch_search(q_reps, 50, batch_size=2, quiet=True)
+
+    assert scores.shape == indices.shape == (5, 50)
+    for q_rep, q_scores, q_indices in zip(q_reps, scores, indices):
+        found = q_indices >= 0
+        assert 0 < found.sum() < 50
+        # results come first, followed only by padding
+        assert found[:found.sum()].all()
+        assert len(np.unique(q_indices[found])) == found.sum()
+        np.testing.assert_allclose(q_scores[found], p_reps[q_indices[found]] @ q_rep, rtol=1e-5)
+        assert np.isneginf(q_scores[~found]).all()